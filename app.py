@@ -1,16 +1,39 @@
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, render_template, g, stream_with_context, url_for
 import xgboost as xgb
 import osmnx as ox
+import numpy as np
 import pandas as pd
 import networkx as nx
 from datetime import datetime
-from prepare_input import prepare_input_from_string
+from prepare_input import (prepare_features_from_string, prepare_inputs_batch, prepare_inputs_one_to_many,
+                           prepare_inputs_preview, request_deadline, route_between, route_cache, route_path_cache,
+                           routing_pool)
+from features import DISTANCE_COLUMN, finalize_fares, predict_inplace
+from graph_snapshot import NYC_BBOX, GraphSnapshot, compile_graph_snapshot, load_graph_snapshot
+from tiled_graph import TiledGraph, load_tiled_graph
+from spatial_index import get_node_index
+from connectivity import get_connectivity
+from ch_router import load_ch_router
+from route_cache import cache_from_env
+from sample_trips import synthetic_trips
+from fare_table import load_fare_table, model_fingerprint
+from zone_matrix import load_zone_matrix
+from metrics import METRICS_DIR, combined_metrics, log_event, metrics, process_rss_bytes
+from geometry import ROUTE_SIMPLIFY_M, route_geometry, simplify_route
+from stream_quotes import read_lines, stream_quotes
+from profiling import start_profile, tag as profile_tag
+from hot_reload import HOT_RELOAD_INTERVAL_S, ReloadWatcher, file_version
+import logging
 import os
+import threading
+import time
+from collections import deque
 
 # -----------------------------
 # 1️⃣ Buat Flask app
 # -----------------------------
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
 # -----------------------------
 # 2️⃣ Load Graph jalan NYC
@@ -19,35 +42,156 @@ ox.settings.log_console = True
 ox.settings.use_cache = True
 
 # NYC bounding box coordinates
-north, south = 40.9176, 40.4774
-east, west = -73.7004, -74.2591
+north, south, east, west = NYC_BBOX
 
 graph_file = "nyc_graph.graphml"
+snapshot_dir = "nyc_graph.snapshot"
+ch_dir = "nyc_graph.ch"
+tiles_dir = "nyc_graph.tiles"
+
+# "snapshot" (default) or "tiled": lazily loaded tiles, for hosts packing many workers (python tiled_graph.py)
+graph_backend = os.environ.get("GRAPH_BACKEND", "snapshot")
+zone_dir = "nyc_zones.matrix"
+
+# Form / JSON fields that describe a single trip
+REQUIRED_FIELDS = ["pickup_lat", "pickup_lon", "dropoff_lat", "dropoff_lon", "date", "hour", "passenger_count"]
+
+# Upper bound on trips accepted by one /api/quotes call
+MAX_BATCH_SIZE = 5000
+
+# Quote endpoints that can be profiled (PROFILE_SAMPLE_RATE / PROFILE_TOKEN, see profiling.py)
+PROFILED_ENDPOINTS = ("index", "api_quote", "api_quotes", "api_quotes_one_to_many")
+
+# Route branches quoted on the straight-line distance, reported as "fallback"
+FALLBACK_BRANCHES = ("euclidean", "timeout", "error")
+
+def _mtime(path):
+    return os.path.getmtime(path) if os.path.exists(path) else 0.0
+
+def graph_paths():
+    """
+    Compiled files whose change means a new graph version (watched for hot
+    reload). The GraphML is not watched: every worker would parse and
+    compile it at once and serve a private networkx copy, so a new GraphML
+    is compiled once (python graph_snapshot.py) and the workers load the
+    published snapshot.
+    """
+    if graph_backend == "tiled":
+        return [os.path.join(tiles_dir, "meta.json")]
+    return [os.path.join(snapshot_dir, "meta.json"), os.path.join(ch_dir, "meta.json")]
+
+def load_graph(compiled_only=False):
+    """
+    Load the road graph with its connectivity and spatial index built,
+    tagged with a `version` (content id of its files). At startup a
+    GraphML file newer than the snapshot is recompiled first; with
+    `compiled_only` (hot reload) only the compiled snapshot / tiles are
+    loaded, memory-mapped and shared like at startup.
+    """
+    graphml_newer = _mtime(graph_file) > _mtime(os.path.join(snapshot_dir, "meta.json"))
+    if graph_backend == "tiled" and os.path.exists(tiles_dir):
+        print("Tiled graph found, loading tiles on demand...")
+        G = load_tiled_graph(tiles_dir)
+        G.version = file_version(tiles_dir)
+    elif compiled_only and not os.path.exists(snapshot_dir):
+        raise FileNotFoundError(f"No compiled graph snapshot in {snapshot_dir} (python graph_snapshot.py)")
+    elif os.path.exists(snapshot_dir) and (compiled_only or not graphml_newer):
+        # Compiled binary snapshot: memory-mapped, shared between workers
+        print("Graph snapshot found, memory-mapping...")
+        G = load_graph_snapshot(snapshot_dir)
+        G.version = file_version(snapshot_dir)
+        if os.path.exists(ch_dir):
+            try:
+                G.router = load_ch_router(ch_dir, G)
+                # A rebuilt hierarchy is a new graph version too (cached routes are keyed on it)
+                G.version = f"{G.version}+{file_version(ch_dir)}"
+                print("Contraction hierarchy loaded for routing")
+            except Exception as e:
+                print(f"Could not load contraction hierarchy: {e}")
+    else:
+        if os.path.exists(graph_file):
+            print("GraphML file found, loading locally...")
+            G = ox.load_graphml(graph_file)
+        else:
+            print("GraphML not found, downloading from OSM...")
+            G = ox.graph_from_bbox(north, south, east, west, network_type="drive")
+            ox.save_graphml(G, filepath=graph_file)
+        G.version = file_version(graph_file)
+        # One-time compile so the next start skips the GraphML parse
+        try:
+            compile_graph_snapshot(G, snapshot_dir)
+            print(f"Graph snapshot compiled to {snapshot_dir}")
+        except Exception as e:
+            print(f"Could not compile graph snapshot: {e}")
+    # Build the connectivity components and the nearest-node index once, not per request
+    get_connectivity(G)
+    get_node_index(G)
+    return G
 
 print("Loading NYC road graph... this may take a minute")
 try:
-    if os.path.exists(graph_file):
-        print("GraphML file found, loading locally...")
-        G = ox.load_graphml(graph_file)
-    else:
-        print("GraphML not found, downloading from OSM...")
-        G = ox.graph_from_bbox(north, south, east, west, network_type="drive")
-        ox.save_graphml(G, filepath=graph_file)
+    G = load_graph()
     print("Graph loaded successfully!")
 except Exception as e:
     print(f"Error loading graph: {e}")
     G = None
 
+# Zone-to-zone distance matrix for approximate preview quotes (python zone_matrix.py)
+zone_matrix = None
+if os.path.exists(zone_dir):
+    try:
+        zone_matrix = load_zone_matrix(zone_dir)
+        print(f"Zone matrix loaded ({zone_matrix.rows}x{zone_matrix.cols} zones)")
+    except Exception as e:
+        print(f"Could not load zone matrix: {e}")
+
 # -----------------------------
 # 3️⃣ Load model XGBoost
 # -----------------------------
+model_file = "xgb_fare_model.json"
+# Precompiled exact lookup table (python fare_table.py), replaces the booster on the hot path
+fare_table_dir = "xgb_fare_model.table"
+
+# Booster threads, set per worker by serve.py (None = XGBoost default)
+booster_nthread = None
+
+class FareModel:
+    """One loaded model version: regressor, booster for in-place prediction, optional lookup table"""
+
+    def __init__(self, model, booster, table, version):
+        self.model = model
+        self.booster = booster
+        self.table = table
+        self.version = version
+
+def load_model():
+    """Load the XGBoost model (and its lookup table when one matches it) as a FareModel"""
+    model = xgb.XGBRegressor()
+    model.load_model(model_file)
+    # Booster used for in-place prediction on float32 feature matrices
+    booster = model.get_booster()
+    if booster_nthread:
+        booster.set_param({"nthread": booster_nthread})
+    table = None
+    if os.path.exists(fare_table_dir):
+        try:
+            table = load_fare_table(fare_table_dir, model_path=model_file)
+            print("Fare lookup table loaded")
+        except Exception as e:
+            print(f"Could not load fare lookup table: {e}")
+    return FareModel(model, booster, table, model_fingerprint(model_file)[:12])
+
 try:
-    xgb_model = xgb.XGBRegressor()
-    xgb_model.load_model("xgb_fare_model.json")
+    fare_model = load_model()
     print("XGBoost model loaded successfully!")
 except Exception as e:
     print(f"Error loading model: {e}")
-    xgb_model = None
+    fare_model = None
+
+# Module-level names kept for callers of the loaded model (serve.py, benchmark.py, checks below)
+xgb_model = fare_model.model if fare_model is not None else None
+xgb_booster = fare_model.booster if fare_model is not None else None
+fare_table = fare_model.table if fare_model is not None else None
 
 # -----------------------------
 # 4️⃣ Helper functions
@@ -92,6 +236,80 @@ def validate_inputs(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, date_str,
     
     return errors
 
+# Recent valid trips quoted by the endpoints, replayed to warm up a reloaded model or graph
+WARMUP_TRIPS = int(os.environ.get("WARMUP_TRIPS", 64))
+recent_trips = deque(maxlen=WARMUP_TRIPS)
+
+def parse_trip(data):
+    """
+    Convert one trip mapping (form or JSON) into typed values.
+    Returns (trip dict, list of errors)
+    """
+    missing_fields = [f for f in REQUIRED_FIELDS
+                      if f not in data or not str(data[f]).strip()]
+    if missing_fields:
+        return None, [f"Missing required fields: {', '.join(missing_fields)}"]
+
+    try:
+        trip = {
+            "pickup_lat": float(data["pickup_lat"]),
+            "pickup_lon": float(data["pickup_lon"]),
+            "dropoff_lat": float(data["dropoff_lat"]),
+            "dropoff_lon": float(data["dropoff_lon"]),
+            "passenger_count": int(data["passenger_count"]),
+            "date": str(data["date"]).strip(),
+            "hour": int(data["hour"]),
+        }
+    except (TypeError, ValueError) as e:
+        return None, [f"Invalid input format: {str(e)}"]
+
+    errors = validate_inputs(
+        trip["pickup_lat"], trip["pickup_lon"], trip["dropoff_lat"], trip["dropoff_lon"],
+        trip["date"], trip["hour"], trip["passenger_count"]
+    )
+    if errors:
+        return None, errors
+
+    trip["datetime_str"] = f"{trip['date']} {trip['hour']:02d}:00:00"
+    return trip, []
+
+# Model predictions keyed on the model version and the full feature row (distance, time, passengers)
+prediction_cache = cache_from_env("prediction", default_size=100000)
+
+@metrics.timed("predict")
+def predict_fares(X, model=None):
+    """
+    Raw model predictions for a float32 feature matrix. With a compiled
+    fare table this is a pure lookup; otherwise rows already seen are
+    served from the prediction cache and all misses go through one
+    in-place booster call. `model` defaults to the serving FareModel,
+    read once so a concurrent reload never mixes two versions.
+    """
+    model = model or fare_model
+    if model.table is not None:
+        return model.table.predict(X).astype(np.float64)
+
+    xgb_booster = model.booster
+    keys = [(model.version,) + tuple(row) for row in X.tolist()]
+    if len(keys) == 1:
+        return np.array([prediction_cache.get_or_compute(
+            keys[0], lambda: float(predict_inplace(xgb_booster, X)[0]))])
+
+    preds = np.empty(len(keys), dtype=np.float64)
+    missing = []
+    for i, key in enumerate(keys):
+        cached = prediction_cache.get(key)
+        if cached is None:
+            missing.append(i)
+        else:
+            preds[i] = cached
+    if missing:
+        new_preds = predict_inplace(xgb_booster, X[missing])
+        for i, pred in zip(missing, new_preds):
+            preds[i] = pred
+            prediction_cache.put(keys[i], float(pred))
+    return preds
+
 # -----------------------------
 # 5️⃣ Route utama
 # -----------------------------
@@ -100,100 +318,61 @@ def index():
     current_date = datetime.now().strftime('%Y-%m-%d')
     
     if request.method == "POST":
-        print("POST request received")
-        
         # Check if required components are loaded
         if G is None:
-            print("Graph not loaded")
+            logger.error("Quote requested but the road graph is not loaded")
             return render_template("index.html", 
                                  error="Road network data not available. Please try again later.",
                                  route_coords=[],
                                  current_date=current_date)
         
         if xgb_model is None:
-            print("Model not loaded")
+            logger.error("Quote requested but the model is not loaded")
             return render_template("index.html", 
                                  error="Prediction model not available. Please try again later.",
                                  route_coords=[],
                                  current_date=current_date)
         
         try:
-            # Check if all required form fields are present
-            required_fields = ["pickup_lat", "pickup_lon", "dropoff_lat", "dropoff_lon", "date", "hour", "passenger_count"]
-            missing_fields = []
-            
-            for field in required_fields:
-                if field not in request.form or not request.form[field].strip():
-                    missing_fields.append(field)
-            
-            if missing_fields:
-                error_msg = f"Missing required fields: {', '.join(missing_fields)}"
-                print(f"Missing fields: {missing_fields}")
-                return render_template("index.html", 
-                                     error=error_msg,
-                                     route_coords=[],
-                                     current_date=current_date)
-            
-            # Get and convert form data
-            print("Extracting form data...")
-            pickup_lat = float(request.form["pickup_lat"])
-            pickup_lon = float(request.form["pickup_lon"])
-            dropoff_lat = float(request.form["dropoff_lat"])
-            dropoff_lon = float(request.form["dropoff_lon"])
-            passenger_count = int(request.form["passenger_count"])
-            date_str = request.form["date"].strip()
-            hour = int(request.form["hour"])
-            
-            print(f"Form data: pickup=({pickup_lat}, {pickup_lon}), dropoff=({dropoff_lat}, {dropoff_lon})")
-            print(f"Date: {date_str}, Hour: {hour}, Passengers: {passenger_count}")
-            
-            # Validate inputs
-            validation_errors = validate_inputs(
-                pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, 
-                date_str, hour, passenger_count
-            )
-            
+            # Same fields and validation rules as the JSON API
+            trip, validation_errors = parse_trip(request.form)
             if validation_errors:
-                error_msg = "Validation errors: " + "; ".join(validation_errors)
-                print(f"Validation errors: {validation_errors}")
+                log_event(logger, logging.INFO, "invalid_form", errors=validation_errors)
                 return render_template("index.html", 
-                                     error=error_msg,
+                                     error="; ".join(validation_errors),
                                      route_coords=[],
                                      current_date=current_date)
+            recent_trips.append(trip)
             
-            # Create datetime string
-            datetime_str = f"{date_str} {hour:02d}:00:00"
-            print(f"DateTime string: {datetime_str}")
+            pickup_lat, pickup_lon = trip["pickup_lat"], trip["pickup_lon"]
+            dropoff_lat, dropoff_lon = trip["dropoff_lat"], trip["dropoff_lon"]
+            passenger_count = trip["passenger_count"]
+            datetime_str = trip["datetime_str"]
+            profile_tag(pickup=(pickup_lat, pickup_lon), dropoff=(dropoff_lat, dropoff_lon),
+                        datetime=datetime_str, passengers=passenger_count)
             
             # Prepare input and calculate route
             try:
-                print("Calling prepare_input_from_string...")
-                X_user, route_coords = prepare_input_from_string(
+                X_user, route_coords = prepare_features_from_string(
                     pickup_lat, pickup_lon,
                     dropoff_lat, dropoff_lon,
                     datetime_str, G,
-                    passenger_count
+                    passenger_count,
+                    deadline=request_deadline()
                 )
                 
-                print(f"Features prepared successfully. Shape: {X_user.shape}")
-                print(f"Feature columns: {list(X_user.columns)}")
-                print(f"Route coordinates: {len(route_coords) if route_coords else 0} points")
-                
                 # Check if route was found
-                distance_km = X_user['distance_km'].iloc[0]
+                distance_km = float(X_user[0, DISTANCE_COLUMN])
                 if distance_km <= 0:
-                    print("No valid route found (distance = 0)")
+                    log_event(logger, logging.WARNING, "no_route", pickup=(pickup_lat, pickup_lon),
+                              dropoff=(dropoff_lat, dropoff_lon))
                     return render_template("index.html", 
                                          error="No route found between these points. Please try different locations within NYC.",
                                          route_coords=[],
                                          current_date=current_date)
                 
                 # Make prediction
-                print("Making prediction...")
-                pred_fare = xgb_model.predict(X_user)[0]
-                
-                print(f"Raw prediction: {pred_fare}")
-                print(f"Distance: {distance_km:.2f} km")
+                pred_fare = predict_fares(X_user)[0]
                 
                 # Ensure positive fare prediction
                 if pred_fare < 0:
@@ -203,71 +382,554 @@ def index():
                 if pred_fare < 2.50:  # NYC minimum fare
                     pred_fare = 2.50
                 
-                print(f"Final prediction: ${pred_fare:.2f}")
+                log_event(logger, logging.INFO, "quote", pickup=(pickup_lat, pickup_lon),
+                          dropoff=(dropoff_lat, dropoff_lon), datetime=datetime_str,
+                          passengers=passenger_count, distance_km=round(distance_km, 3),
+                          fare=round(float(pred_fare), 2))
                 
-                return render_template(
-                    "index.html",
-                    predicted_fare=f"${pred_fare:.2f}",
-                    distance_km=f"{distance_km:.2f} km",
-                    route_coords=route_coords or [],  # <<< PENTING, pastikan selalu list
-                    success=True,
-                    current_date=current_date
-                )
+                with metrics.timer("render"):
+                    return render_template(
+                        "index.html",
+                        predicted_fare=f"${pred_fare:.2f}",
+                        distance_km=f"{distance_km:.2f} km",
+                        # Simplified: the map does not need one point per graph node
+                        route_coords=simplify_route(route_coords or []),  # <<< PENTING, pastikan selalu list
+                        success=True,
+                        current_date=current_date
+                    )
                 
             except nx.NetworkXNoPath:
-                print("NetworkX: No path found")
+                log_event(logger, logging.WARNING, "no_route", pickup=(pickup_lat, pickup_lon),
+                          dropoff=(dropoff_lat, dropoff_lon))
                 return render_template("index.html", 
                                      error="No route found between these points. Please try different locations.",
                                      route_coords=[],
                                      current_date=current_date)
             
             except Exception as route_error:
-                print(f"Route calculation error: {str(route_error)}")
-                print(f"Error type: {type(route_error)}")
+                logger.error(f"Route calculation error ({type(route_error).__name__}): {route_error}")
                 return render_template("index.html", 
                                     error="No route found between these points. Please try different locations within NYC.",
                                     route_coords=[],  # <<< tambahkan supaya tidak Undefined
                                     current_date=current_date)
         
         except ValueError as ve:
-            print(f"Value error: {str(ve)}")
+            log_event(logger, logging.INFO, "invalid_form", errors=[str(ve)])
             return render_template("index.html", 
                                  error=f"Invalid input format: {str(ve)}",
                                  route_coords=[],
                                  current_date=current_date)
         
         except Exception as e:
-            print(f"Unexpected error: {str(e)}")
-            print(f"Error type: {type(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception(f"Unexpected error ({type(e).__name__}): {e}")
             return render_template("index.html", 
                                  error=f"An unexpected error occurred: {str(e)}",
                                  route_coords=[],
                                  current_date=current_date)
     
     # GET request - show form
-    print("GET request - showing form")
     return render_template("index.html", 
                          predicted_fare=None, 
                          route_coords=[],
                          current_date=current_date)
 
 # -----------------------------
-# 6️⃣ Health check endpoint
+# 6️⃣ Batch quote API
 # -----------------------------
+@app.route("/api/quotes", methods=["POST"])
+def api_quotes():
+    """
+    Quote many trips in one call.
+
+    Body: {"trips": [{pickup_lat, pickup_lon, dropoff_lat, dropoff_lon,
+    date, hour, passenger_count}, ...]} (or the bare list).
+    All valid trips are snapped together, turned into one feature matrix
+    and scored with a single model call. Results keep the input order.
+
+    With "mode": "preview" distances come from the zone matrix instead of
+    graph routing (constant time, approximate); the measured error of the
+    matrix is returned as "expected_error".
+
+    Routed quotes carry their "route_branch"; straight-line estimates are
+    marked "fallback" ("euclidean", "timeout" or "error"), e.g. trips whose
+    route is not found within the routing budget (ROUTING_BUDGET_MS).
+    """
+    deadline = request_deadline()
+    payload = request.get_json(silent=True)
+    trips = payload.get("trips") if isinstance(payload, dict) else payload
+    preview = isinstance(payload, dict) and payload.get("mode") == "preview" and zone_matrix is not None
+
+    if xgb_model is None or (G is None and not preview):
+        return {"error": "Road network or prediction model not available"}, 503
+    if not isinstance(trips, list):
+        return {"error": "Expected a JSON list of trips or {\"trips\": [...]}"}, 400
+    if len(trips) > MAX_BATCH_SIZE:
+        return {"error": f"Batch too large: {len(trips)} trips (max {MAX_BATCH_SIZE})"}, 413
+    profile_tag(trips=len(trips), mode="preview" if preview else "exact")
+
+    try:
+        quotes = [{"index": i, **quote} for i, quote in enumerate(quote_trips(trips, deadline, preview))]
+    except Exception as e:
+        logger.exception(f"Batch quote error: {e}")
+        return {"error": f"Could not quote batch: {str(e)}"}, 500
+
+    response = {"count": len(quotes), "mode": "preview" if preview else "exact", "quotes": quotes}
+    if preview:
+        response["expected_error"] = zone_matrix.meta.get("error")
+    return response
+
+def quote_trips(trips, deadline=None, preview=False):
+    """
+    Quote a list of trip mappings with one snap / feature / model pass.
+    Returns one dict per trip, in input order: fare, distance_km and
+    route_branch (plus "fallback" for straight-line estimates, as in
+    /api/quote), or an error for trips that cannot be quoted.
+    Raises if the batch itself fails.
+    """
+    quotes = [{} for _ in trips]
+    valid_idx, valid_trips = [], []
+    for i, data in enumerate(trips):
+        if not isinstance(data, dict):
+            quotes[i]["error"] = "Trip must be a JSON object"
+            continue
+        trip, errors = parse_trip(data)
+        if errors:
+            quotes[i]["error"] = "; ".join(errors)
+        else:
+            valid_idx.append(i)
+            valid_trips.append(trip)
+    recent_trips.extend(valid_trips[-WARMUP_TRIPS:])
+
+    branches = []
+    if valid_trips:
+        if preview:
+            X_batch = prepare_inputs_preview(valid_trips, zone_matrix)
+        else:
+            X_batch, _ = prepare_inputs_batch(valid_trips, G, deadline=deadline, branches=branches,
+                                              with_coords=False)
+        fares = finalize_fares(predict_fares(X_batch))
+
+        distances = X_batch[:, DISTANCE_COLUMN]
+        for i, fare, distance_km in zip(valid_idx, fares, distances):
+            if distance_km <= 0:
+                quotes[i]["error"] = "No route found between these points"
+                continue
+            quotes[i]["fare"] = round(float(fare), 2)
+            quotes[i]["distance_km"] = round(float(distance_km), 3)
+        for i, branch in zip(valid_idx, branches):
+            if "fare" not in quotes[i]:
+                continue
+            quotes[i]["route_branch"] = branch
+            if branch in FALLBACK_BRANCHES:
+                quotes[i]["fallback"] = branch
+    return quotes
+
+@app.route("/api/quotes/stream", methods=["POST"])
+def api_quotes_stream():
+    """
+    Quote an NDJSON stream (one trip object per line, same fields as
+    /api/quotes). Trips are quoted in micro-batches (STREAM_BATCH_SIZE /
+    STREAM_BATCH_WAIT_MS) and every batch's results are streamed back as
+    NDJSON as soon as they are ready, so a stream of any length runs in
+    constant memory. Each result has the input "line" (and "id" if given).
+    """
+    if xgb_model is None or G is None:
+        return {"error": "Road network or prediction model not available"}, 503
+
+    def quote_batch(trips):
+        # The routing budget applies per batch, not to the whole stream
+        return quote_trips(trips, request_deadline())
+
+    chunks = stream_quotes(read_lines(request.stream), quote_batch)
+    return Response(stream_with_context(chunks), mimetype="application/x-ndjson")
+
+def _geometry_options(args):
+    """(format, tolerance_m) of a geometry request, or raise ValueError"""
+    fmt = args.get("format", "polyline")
+    if fmt not in ("polyline", "coords"):
+        raise ValueError("format must be 'polyline' or 'coords'")
+    tolerance_m = float(args.get("tolerance_m", ROUTE_SIMPLIFY_M))
+    if tolerance_m < 0:
+        raise ValueError("tolerance_m must be >= 0")
+    return fmt, tolerance_m
+
+@app.route("/api/quote", methods=["POST"])
+def api_quote():
+    """
+    Quote one trip as JSON, without rendering the page.
+
+    Body: the form fields as JSON, plus optional "geometry"
+    ("none" (default), "polyline" or "coords") and "tolerance_m".
+    Without geometry no route coordinates are built at all and the
+    response carries a "geometry_url" to fetch them later from /api/route.
+    Like /api/route, "route_branch" tells how the distance was found and
+    "fallback" marks straight-line estimates (euclidean, timeout, error).
+    """
+    payload = request.get_json(silent=True)
+    if xgb_model is None or G is None:
+        return {"error": "Road network or prediction model not available"}, 503
+    if not isinstance(payload, dict):
+        return {"error": "Expected a JSON object with the trip fields"}, 400
+    trip, errors = parse_trip(payload)
+    if errors:
+        return {"error": "; ".join(errors)}, 400
+    recent_trips.append(trip)
+    profile_tag(pickup=(trip["pickup_lat"], trip["pickup_lon"]), dropoff=(trip["dropoff_lat"], trip["dropoff_lon"]),
+                datetime=trip["datetime_str"], passengers=trip["passenger_count"])
+    geometry = payload.get("geometry") or "none"
+    try:
+        fmt, tolerance_m = _geometry_options({"format": geometry if geometry != "none" else "polyline",
+                                              "tolerance_m": payload.get("tolerance_m", ROUTE_SIMPLIFY_M)})
+    except (TypeError, ValueError) as e:
+        return {"error": f"Invalid geometry options: {e}"}, 400
+
+    branches = []
+    try:
+        X_user, route_coords = prepare_features_from_string(
+            trip["pickup_lat"], trip["pickup_lon"], trip["dropoff_lat"], trip["dropoff_lon"],
+            trip["datetime_str"], G, trip["passenger_count"],
+            deadline=request_deadline(), with_coords=geometry != "none", branches=branches
+        )
+        distance_km = float(X_user[0, DISTANCE_COLUMN])
+        fare = float(finalize_fares(predict_fares(X_user))[0])
+    except Exception as e:
+        logger.exception(f"Quote error: {e}")
+        return {"error": f"Could not quote trip: {str(e)}"}, 500
+
+    response = {"fare": round(fare, 2), "distance_km": round(distance_km, 3), "route_branch": branches[0]}
+    if branches[0] in FALLBACK_BRANCHES:
+        response["fallback"] = branches[0]
+    if geometry == "none":
+        response["geometry_url"] = url_for(
+            "api_route", pickup_lat=trip["pickup_lat"], pickup_lon=trip["pickup_lon"],
+            dropoff_lat=trip["dropoff_lat"], dropoff_lon=trip["dropoff_lon"])
+    else:
+        response["geometry"] = route_geometry(route_coords or [], fmt, tolerance_m)
+    return response
+
+@app.route("/api/route")
+def api_route():
+    """
+    Lazily fetched route geometry of a trip:
+    ?pickup_lat&pickup_lon&dropoff_lat&dropoff_lon[&format=polyline|coords][&tolerance_m].
+    The node path comes from the route path cache when the pair was mapped recently
+    (quotes without geometry only cache the distance).
+    """
+    if G is None:
+        return {"error": "Road network not available"}, 503
+    try:
+        pickup_lat, pickup_lon = float(request.args["pickup_lat"]), float(request.args["pickup_lon"])
+        dropoff_lat, dropoff_lon = float(request.args["dropoff_lat"]), float(request.args["dropoff_lon"])
+        fmt, tolerance_m = _geometry_options(request.args)
+    except (KeyError, TypeError, ValueError) as e:
+        return {"error": f"Invalid route query: {e}"}, 400
+    if not (validate_nyc_bounds(pickup_lat, pickup_lon) and validate_nyc_bounds(dropoff_lat, dropoff_lon)):
+        return {"error": "Pickup and dropoff must be within NYC boundaries"}, 400
+
+    try:
+        distance_km, route_coords, branch = route_between(
+            pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, G, request_deadline()
+        )
+    except Exception as e:
+        logger.exception(f"Route geometry error: {e}")
+        return {"error": f"Could not route trip: {str(e)}"}, 500
+    response = {"distance_km": round(distance_km, 3), "route_branch": branch,
+                "geometry": route_geometry(route_coords, fmt, tolerance_m)}
+    if branch in FALLBACK_BRANCHES:
+        response["fallback"] = branch
+    return response
+
+@app.route("/api/quotes/one-to-many", methods=["POST"])
+def api_quotes_one_to_many():
+    """
+    Quote one pickup against many dropoffs.
+
+    Body: {"pickup": {"lat", "lon"}, "dropoffs": [{"lat", "lon"}, ...],
+    "date", "hour", "passenger_count", optional "max_distance_km"}.
+    One shortest-path tree from the snapped pickup gives every road
+    distance and all fares come from a single model call. Dropoffs past
+    max_distance_km by road and dropoffs with no road connection from the
+    pickup get an error.
+    """
+    deadline = request_deadline()
+    payload = request.get_json(silent=True)
+    if xgb_model is None or G is None:
+        return {"error": "Road network or prediction model not available"}, 503
+    if not isinstance(payload, dict) or not isinstance(payload.get("pickup"), dict) \
+            or not isinstance(payload.get("dropoffs"), list):
+        return {"error": "Expected {\"pickup\": {...}, \"dropoffs\": [...], date, hour, passenger_count}"}, 400
+    dropoffs = payload["dropoffs"]
+    if len(dropoffs) > MAX_BATCH_SIZE:
+        return {"error": f"Too many dropoffs: {len(dropoffs)} (max {MAX_BATCH_SIZE})"}, 413
+
+    try:
+        pickup_lat, pickup_lon = float(payload["pickup"]["lat"]), float(payload["pickup"]["lon"])
+    except (TypeError, ValueError, KeyError):
+        return {"error": "Pickup must be an object with numeric lat and lon"}, 400
+    if not validate_nyc_bounds(pickup_lat, pickup_lon):
+        return {"error": "Pickup location must be within NYC boundaries"}, 400
+    # Date, hour and passenger count go through the usual trip rules (the pickup stands in for the dropoff)
+    trip, errors = parse_trip(dict(
+        {f: payload[f] for f in ("date", "hour", "passenger_count") if payload.get(f) is not None},
+        pickup_lat=pickup_lat, pickup_lon=pickup_lon, dropoff_lat=pickup_lat, dropoff_lon=pickup_lon,
+    ))
+    if errors:
+        return {"error": "; ".join(errors)}, 400
+    try:
+        max_distance_km = float(payload["max_distance_km"]) if payload.get("max_distance_km") is not None else None
+    except (TypeError, ValueError):
+        return {"error": "max_distance_km must be a number"}, 400
+    if max_distance_km is not None and not 0 < max_distance_km < float("inf"):
+        return {"error": "max_distance_km must be a positive number"}, 400
+    profile_tag(pickup=(trip["pickup_lat"], trip["pickup_lon"]), dropoffs=len(dropoffs),
+                datetime=trip["datetime_str"], passengers=trip["passenger_count"], max_distance_km=max_distance_km)
+
+    quotes = [{"index": i} for i in range(len(dropoffs))]
+    valid_idx, valid_points = [], []
+    for i, point in enumerate(dropoffs):
+        try:
+            lat, lon = float(point["lat"]), float(point["lon"])
+        except (TypeError, ValueError, KeyError):
+            quotes[i]["error"] = "Dropoff must be an object with numeric lat and lon"
+            continue
+        if not validate_nyc_bounds(lat, lon):
+            quotes[i]["error"] = "Dropoff location must be within NYC boundaries"
+            continue
+        valid_idx.append(i)
+        valid_points.append((lat, lon))
+
+    if valid_points:
+        try:
+            X_batch, branches = prepare_inputs_one_to_many(
+                trip["pickup_lat"], trip["pickup_lon"], valid_points, trip["datetime_str"], G,
+                trip["passenger_count"], max_distance_km=max_distance_km, deadline=deadline
+            )
+            fares = finalize_fares(predict_fares(X_batch))
+        except Exception as e:
+            logger.exception(f"One-to-many quote error: {e}")
+            return {"error": f"Could not quote dropoffs: {str(e)}"}, 500
+
+        distances = X_batch[:, DISTANCE_COLUMN]
+        for i, fare, distance_km, branch in zip(valid_idx, fares, distances, branches):
+            if branch == "cutoff":
+                quotes[i]["error"] = f"Farther than {max_distance_km:g} km by road"
+                continue
+            if branch == "unreachable":
+                quotes[i]["error"] = "No road route from the pickup to this dropoff"
+                continue
+            quotes[i]["fare"] = round(float(fare), 2)
+            quotes[i]["distance_km"] = round(float(distance_km), 3)
+            if branch == "timeout":
+                quotes[i]["fallback"] = branch
+
+    return {"count": len(quotes), "quotes": quotes}
+
+# -----------------------------
+# 7️⃣ Health check + metrics endpoints
+# -----------------------------
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if request.method == "POST" and request.endpoint in PROFILED_ENDPOINTS:
+        g.profile = start_profile(request.endpoint, request.headers)
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop("request_start", None)
+    if start is not None and request.endpoint != "metrics_endpoint":
+        metrics.record_request(request.endpoint or "unknown", response.status_code, time.perf_counter() - start)
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.finish(response.status_code)
+        response.headers["X-Profile-Id"] = profile.id
+    return response
+
+@app.teardown_request
+def finish_profile(error=None):
+    # Requests that raised never reach after_request
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.finish(500)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    Stage latency histograms (snap, route, features, predict, render),
+    route branch counters and request rates. Summed over all workers when
+    they publish to METRICS_DIR (serve.py), else of this process only;
+    ?scope=worker always reports this process ("pid").
+    JSON by default, Prometheus text with ?format=prometheus.
+    """
+    registry = metrics
+    if METRICS_DIR is not None and request.args.get("scope") != "worker":
+        registry = combined_metrics()
+    if request.args.get("format") == "prometheus":
+        return registry.prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+    return registry.snapshot()
+
 @app.route("/health")
 def health_check():
     """Simple health check endpoint"""
     status = {
         "graph_loaded": G is not None,
         "model_loaded": xgb_model is not None,
-        "status": "healthy" if (G is not None and xgb_model is not None) else "degraded"
+        "graph_backend": ("snapshot" if isinstance(G, GraphSnapshot)
+                          else "tiled" if isinstance(G, TiledGraph) else "networkx"),
+        "router": "contraction_hierarchy" if getattr(G, "router", None) is not None else "dijkstra",
+        "predictor": "fare_table" if fare_table is not None else "booster",
+        "model_version": fare_model.version if fare_model is not None else None,
+        "graph_version": getattr(G, "version", None),
+        "reload": reload_status,
+        "status": "healthy" if (G is not None and xgb_model is not None) else "degraded",
+        "caches": {
+            "route": route_cache.stats(),
+            "route_path": route_path_cache.stats(),
+            "prediction": prediction_cache.stats(),
+        },
+        "routing_pool": routing_pool.stats() if routing_pool is not None else None,
+        "connectivity": get_connectivity(G).stats() if G is not None else None,
+        "graph_memory": G.memory_usage() if isinstance(G, TiledGraph) else None,
+        "process_rss_bytes": process_rss_bytes(),
+        "pid": os.getpid(),
     }
     return status
 
 # -----------------------------
-# 7️⃣ Debug endpoint
+# 8️⃣ Hot reload (model / graph)
+# -----------------------------
+# A POST to /admin/reload with the header "X-Reload-Token: <RELOAD_TOKEN>" reloads (unset = endpoint off)
+RELOAD_TOKEN = os.environ.get("RELOAD_TOKEN") or None
+
+# One reload at a time per process
+_reload_lock = threading.Lock()
+_reload_watcher = None
+
+# Last reload of each source: version, when, how long loading + warm-up took, or the error
+reload_status = {}
+
+def warmup_trips():
+    """Recent real trips, topped up with synthetic ones, to replay against a new model / graph"""
+    trips = list(recent_trips)
+    if len(trips) < WARMUP_TRIPS:
+        trips += [parse_trip(t)[0] for t in synthetic_trips(WARMUP_TRIPS - len(trips), seed=len(trips))]
+    return trips
+
+def warm_up(graph, model):
+    """
+    Run the sample trips through a newly loaded graph / model before it
+    serves: fills the tile, spatial index and booster caches, and fails
+    the reload (keeping the old version) if the new one cannot quote.
+    Its timings and route branches stay out of the metrics.
+    """
+    with metrics.muted():
+        X, _ = prepare_inputs_batch(warmup_trips(), graph, with_coords=False)
+        predict_fares(X, model)
+        # The single-row path predicts separately
+        predict_fares(X[:1], model)
+
+def _record_reload(name, version, start):
+    reload_status[name] = {"version": version, "reloaded_at": datetime.now().isoformat(timespec="seconds"),
+                           "duration_s": round(time.perf_counter() - start, 3)}
+    metrics.count(f"reload_{name}")
+    logger.info(f"Reloaded {name} {version} in {reload_status[name]['duration_s']}s")
+
+def reload_model():
+    """
+    Load the model files in the background, warm the new version up and
+    swap it in with one assignment: requests in flight finish on the
+    version they started with. Cached predictions of the old version are
+    dropped. Raises (and keeps the current model) if loading fails.
+    """
+    global fare_model, xgb_model, xgb_booster, fare_table
+    with _reload_lock:
+        start = time.perf_counter()
+        old = fare_model
+        new = load_model()
+        if G is not None:
+            warm_up(G, new)
+        fare_model = new
+        xgb_model, xgb_booster, fare_table = new.model, new.booster, new.table
+        if old is not None and new.version != old.version:
+            dropped = prediction_cache.purge(lambda key: key[0] == old.version)
+            logger.info(f"Dropped {dropped} cached predictions of model {old.version}")
+        _record_reload("model", new.version, start)
+        return new.version
+
+def reload_graph():
+    """
+    Load the compiled road graph in the background (snapshot / tiles,
+    connectivity, spatial index), warm it up and swap it in with one
+    assignment. Cached routes of the old graph are dropped. Raises (and
+    keeps the current graph) if loading fails.
+    """
+    global G
+    with _reload_lock:
+        start = time.perf_counter()
+        old_version = getattr(G, "version", None)
+        new = load_graph(compiled_only=True)
+        if fare_model is not None:
+            warm_up(new, fare_model)
+        G = new
+        if old_version is not None and new.version != old_version:
+            dropped = sum(cache.purge(lambda key: key[0] == old_version)
+                          for cache in (route_cache, route_path_cache))
+            logger.info(f"Dropped {dropped} cached routes of graph {old_version}")
+        _record_reload("graph", new.version, start)
+        return new.version
+
+def try_reload(name):
+    """Reload "model" or "graph"; a failure is logged and shown in /health, the current version keeps serving"""
+    try:
+        return {"model": reload_model, "graph": reload_graph}[name]()
+    except Exception as e:
+        reload_status[name] = {"error": str(e).splitlines()[0] if str(e) else repr(e), "failed_at": datetime.now().isoformat(timespec="seconds")}
+        logger.exception(f"Reload of {name} failed, keeping the current version: {e}")
+
+def start_reload_watcher():
+    """
+    Watch the model and graph files (every HOT_RELOAD_INTERVAL_S seconds,
+    off when 0) and reload whatever changes. Called once per process:
+    from __main__ here, from post_fork in each serve.py worker.
+    """
+    global _reload_watcher
+    if HOT_RELOAD_INTERVAL_S <= 0 or _reload_watcher is not None:
+        return _reload_watcher
+    _reload_watcher = ReloadWatcher({
+        "model": (lambda: [model_file, os.path.join(fare_table_dir, "meta.json")], lambda: try_reload("model")),
+        "graph": (graph_paths, lambda: try_reload("graph")),
+    })
+    _reload_watcher.start()
+    return _reload_watcher
+
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """
+    Reload the model and / or graph ({"model": true, "graph": true},
+    default model only) of the worker serving this request, in the
+    background. Returns 202 with
+    the versions serving now; /health shows the outcome. Needs the
+    X-Reload-Token header; 404 when RELOAD_TOKEN is unset or wrong.
+    """
+    if RELOAD_TOKEN is None or request.headers.get("X-Reload-Token") != RELOAD_TOKEN:
+        return {"error": "Not found"}, 404
+    data = request.get_json(silent=True) or {}
+    # Default: the model only
+    targets = [name for name in ("model", "graph") if data.get(name, name == "model")]
+
+    def run():
+        for name in targets:
+            try_reload(name)
+
+    threading.Thread(target=run, name="reload", daemon=True).start()
+    return {
+        "reloading": targets,
+        "model_version": fare_model.version if fare_model is not None else None,
+        "graph_version": getattr(G, "version", None),
+        "pid": os.getpid(),
+    }, 202
+
+# -----------------------------
+# 9️⃣ Debug endpoint
 # -----------------------------
 @app.route("/debug", methods=["POST"])
 def debug_form():
@@ -282,8 +944,9 @@ def debug_form():
     }
 
 # -----------------------------
-# 8️⃣ Jalankan server
+# 🔟 Jalankan server
 # -----------------------------
 if __name__ == "__main__":
     print("Starting Flask application...")
+    start_reload_watcher()
     app.run(debug=True, use_reloader=False, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,62 @@
+import contextlib
+import glob
+import logging
+import os
+import re
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+# Versions of a compiled directory kept on disk (the current one included), so a
+# process still reading the previous version can finish before it is deleted
+KEEP_VERSIONS = 2
+
+@contextlib.contextmanager
+def publish_dir(out_dir):
+    """
+    Write a compiled directory (snapshot, hierarchy, table, ...) so that
+    readers in other processes never see it missing or half written.
+    Yields a fresh versioned directory (<out_dir>.v<ns>-<pid>) to fill;
+    once the block succeeds, `out_dir` is made a symlink to it with a
+    single rename. Concurrent writers each publish a complete version and
+    the last one wins. Versions older than KEEP_VERSIONS are deleted.
+    """
+    out_dir = os.path.normpath(out_dir)
+    version_dir = f"{out_dir}.v{time.time_ns()}-{os.getpid()}"
+    os.makedirs(version_dir)
+    try:
+        yield version_dir
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    link = f"{out_dir}.link-{os.getpid()}"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version_dir), link)
+    if os.path.isdir(out_dir) and not os.path.islink(out_dir):
+        # Written before versioning: moved aside once, then removed like any old version
+        os.replace(out_dir, f"{out_dir}.v0-{os.getpid()}")
+    os.replace(link, out_dir)
+    _remove_old_versions(out_dir)
+
+def _remove_old_versions(out_dir):
+    current = os.path.realpath(out_dir)
+    versions = []
+    for path in glob.glob(f"{glob.escape(out_dir)}.v*"):
+        match = re.search(r"\.v(\d+)-\d+$", path)
+        if match:
+            versions.append((int(match.group(1)), path))
+    for _, path in sorted(versions)[:-KEEP_VERSIONS]:
+        if os.path.realpath(path) != current:
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info(f"Removed old version {path}")
+
+def resolve_dir(path):
+    """
+    The version directory a published `path` points to. Loaders read every
+    file from it, so a load never mixes two versions even if a new one is
+    published meanwhile.
+    """
+    return os.path.realpath(path)
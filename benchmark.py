@@ -0,0 +1,268 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from sample_trips import synthetic_trips
+
+# Bumped when a stage measures something else (stages of other versions are not compared)
+BENCHMARK_VERSION = 2
+
+# Latency fields compared against a baseline
+COMPARED_FIELDS = ("p50_ms", "p95_ms")
+
+def latency_summary(samples_s):
+    """Percentiles (ms) of a list of durations in seconds"""
+    ms = np.asarray(samples_s, dtype=np.float64) * 1000
+    if len(ms) == 0:
+        return {"count": 0}
+    return {
+        "count": int(len(ms)),
+        "mean_ms": round(float(ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(ms, 99)), 4),
+        "max_ms": round(float(ms.max()), 4),
+        "total_s": round(float(ms.sum() / 1000), 4),
+    }
+
+def _timed(calls):
+    """Run each zero-argument callable, return (results, durations in seconds)"""
+    results, samples = [], []
+    for call in calls:
+        start = time.perf_counter()
+        results.append(call())
+        samples.append(time.perf_counter() - start)
+    return results, samples
+
+def benchmark_stages(fare_app, trips):
+    """
+    Time every stage of a quote on its own, in pipeline order, each stage
+    fed with the previous stage's output: datetime parsing, snapping,
+    routing as index() does it (node path and map coordinates; cold cache,
+    then warm), feature encoding, prediction and template rendering.
+    Only the in-process caches are cleared: with FARE_CACHE_DB the cold
+    stages read what other workers stored.
+    """
+    from features import encode_trip, finalize_fares, parse_trip_datetime
+    from prepare_input import (calculate_route_detailed, find_nearest_nodes_safe, route_cache, route_nodes_to_coords,
+                               route_path_cache)
+
+    G = fare_app.G
+    parsed = [fare_app.parse_trip(t)[0] for t in trips]
+    parsed = [t for t in parsed if t is not None]
+    stages = {}
+
+    datetimes, samples = _timed([lambda t=t: parse_trip_datetime(t["datetime_str"]) for t in parsed])
+    stages["parse_datetime"] = latency_summary(samples)
+
+    nodes, samples = _timed([
+        lambda t=t: find_nearest_nodes_safe(G, t["pickup_lon"], t["pickup_lat"], t["dropoff_lon"], t["dropoff_lat"])
+        for t in parsed
+    ])
+    stages["snap"] = latency_summary(samples)
+
+    def route(t, n):
+        # With the node path and its coordinates, as the form (index) routes
+        route_nodes, distance_m, branch = calculate_route_detailed(
+            G, n[0], n[1], t["pickup_lat"], t["pickup_lon"], t["dropoff_lat"], t["dropoff_lon"])
+        route_nodes_to_coords(G, route_nodes, t["pickup_lat"], t["pickup_lon"], t["dropoff_lat"], t["dropoff_lon"])
+        return route_nodes, distance_m, branch
+
+    route_calls = [lambda t=t, n=n: route(t, n) for t, n in zip(parsed, nodes)]
+    route_cache.clear(shared=False)
+    route_path_cache.clear(shared=False)
+    routes, samples = _timed(route_calls)
+    stages["route"] = latency_summary(samples)
+    _, samples = _timed(route_calls)
+    stages["route_cached"] = latency_summary(samples)
+
+    distances_km = [max(0.1, distance_m / 1000) for _, distance_m, _ in routes]
+    rows, samples = _timed([
+        lambda t=t, d=d, dt=dt: encode_trip(t["passenger_count"], d, dt).copy()
+        for t, d, dt in zip(parsed, distances_km, datetimes)
+    ])
+    stages["features"] = latency_summary(samples)
+
+    fare_app.prediction_cache.clear(shared=False)
+    fares, samples = _timed([lambda X=X: finalize_fares(fare_app.predict_fares(X))[0] for X in rows])
+    stages["predict"] = latency_summary(samples)
+
+    with fare_app.app.test_request_context("/"):
+        _, samples = _timed([
+            lambda fare=fare, d=d, t=t: fare_app.render_template(
+                "index.html", predicted_fare=f"${fare:.2f}", distance_km=f"{d:.2f} km",
+                route_coords=[(t["pickup_lat"], t["pickup_lon"]), (t["dropoff_lat"], t["dropoff_lon"])],
+                success=True, current_date=t["date"])
+            for fare, d, t in zip(fares, distances_km, parsed)
+        ])
+    stages["render"] = latency_summary(samples)
+    return stages
+
+def benchmark_load(fare_app, trips, concurrency, num_requests):
+    """
+    End-to-end load: `concurrency` threads POST the form to index() through
+    the Flask test client until `num_requests` requests are done.
+    In-process caches start empty so every level sees the same hit pattern.
+    """
+    from prepare_input import route_cache, route_path_cache
+
+    for cache in (route_cache, route_path_cache, fare_app.prediction_cache):
+        cache.clear(shared=False)
+    client = fare_app.app.test_client()
+    samples, statuses = [], {}
+    lock = threading.Lock()
+    counter = iter(range(num_requests))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            response = client.post("/", data=trips[i % len(trips)])
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_s = time.perf_counter() - start
+
+    result = latency_summary(samples)
+    result.update({
+        "concurrency": concurrency,
+        "wall_s": round(wall_s, 4),
+        "requests_per_sec": round(len(samples) / wall_s, 2) if wall_s > 0 else 0.0,
+        "status_codes": {str(code): count for code, count in sorted(statuses.items())},
+    })
+    return result
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+def run_benchmark(num_trips=200, seed=0, concurrency=(1, 4, 8), num_requests=200):
+    """Full run: stage timings plus one load test per concurrency level"""
+    # Importing app loads the graph and the model, the same way the server does
+    with contextlib.redirect_stdout(sys.stderr):
+        import app as fare_app
+    if fare_app.G is None or fare_app.xgb_model is None:
+        raise RuntimeError("Road graph or model not available, nothing to benchmark")
+
+    trips = synthetic_trips(num_trips, seed)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        stages = benchmark_stages(fare_app, trips)
+        load = {str(c): benchmark_load(fare_app, trips, c, num_requests) for c in concurrency}
+    health = fare_app.app.test_client().get("/health").get_json()
+
+    return {
+        "version": BENCHMARK_VERSION,
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "trips": num_trips,
+            "seed": seed,
+            "graph_backend": health["graph_backend"],
+            "router": health["router"],
+            "predictor": health["predictor"],
+            "duration_s": round(time.perf_counter() - start, 2),
+        },
+        "stages": stages,
+        "load": load,
+    }
+
+def compare_results(current, baseline, tolerance=0.25, min_delta_ms=0.05):
+    """
+    Regressions of `current` against `baseline`: every stage / load level
+    whose p50 or p95 grew by more than `tolerance` (relative) and
+    `min_delta_ms` (absolute, so microsecond stages do not flap).
+    Returns a list of human-readable findings (empty = no regression).
+    """
+    regressions = []
+    same_stages = baseline.get("version") == current.get("version")
+    for section in ("stages", "load") if same_stages else ("load",):
+        for name, base in baseline.get(section, {}).items():
+            now = current.get(section, {}).get(name)
+            if now is None:
+                continue
+            for field in COMPARED_FIELDS:
+                if field not in base or field not in now:
+                    continue
+                delta = now[field] - base[field]
+                if delta > min_delta_ms and now[field] > base[field] * (1 + tolerance):
+                    regressions.append(f"{section}.{name}.{field}: {base[field]:.3f} -> {now[field]:.3f} ms "
+                                       f"(+{delta / base[field] * 100 if base[field] else float('inf'):.0f}%)")
+    return regressions
+
+def format_report(result):
+    """Plain-text table of a benchmark result"""
+    lines = [f"{'stage':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'count':>8}"]
+    for name, s in result["stages"].items():
+        lines.append(f"{name:<18}{s.get('p50_ms', 0):>10.3f}{s.get('p95_ms', 0):>10.3f}"
+                     f"{s.get('p99_ms', 0):>10.3f}{s['count']:>8}")
+    lines.append(f"{'load':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>8}")
+    for level, s in result["load"].items():
+        lines.append(f"{'concurrency ' + level:<18}{s.get('p50_ms', 0):>10.3f}{s.get('p95_ms', 0):>10.3f}"
+                     f"{s.get('p99_ms', 0):>10.3f}{s['requests_per_sec']:>8.1f}")
+    return "\n".join(lines)
+
+# -----------------------------
+# Command line: benchmark + regression check
+#   python benchmark.py --output bench.json [--baseline old.json --tolerance 0.25]
+# -----------------------------
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Per-stage benchmark and load test of the fare app")
+    arg_parser.add_argument("--trips", type=int, default=200, help="synthetic trips per stage")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--concurrency", default="1,4,8", help="comma separated load levels")
+    arg_parser.add_argument("--requests", type=int, default=200, help="requests per load level")
+    arg_parser.add_argument("--output", default=None, help="write the JSON result here")
+    arg_parser.add_argument("--baseline", default=None, help="earlier JSON result to compare against")
+    arg_parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    arg_parser.add_argument("--verbose", action="store_true", help="keep per-trip routing logs")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.verbose:
+        logging.getLogger("prepare_input").setLevel(logging.ERROR)
+
+    result = run_benchmark(args.trips, args.seed, [int(c) for c in args.concurrency.split(",")], args.requests)
+    print(format_report(result))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(result, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regression against baseline")
@@ -0,0 +1,342 @@
+import argparse
+import heapq
+import json
+import logging
+import os
+import time
+
+import networkx as nx
+import numpy as np
+
+from artifacts import publish_dir, resolve_dir
+from graph_snapshot import load_graph_snapshot
+
+logger = logging.getLogger(__name__)
+
+CH_VERSION = 1
+
+CH_ARRAYS = ("rank",
+             "fwd_indptr", "fwd_indices", "fwd_weights", "fwd_mid",
+             "bwd_indptr", "bwd_indices", "bwd_weights", "bwd_mid")
+
+def build_contraction_hierarchy(snapshot, witness_settle_limit=60):
+    """
+    Contract every node of a GraphSnapshot (offline preprocessing).
+
+    Nodes are contracted in order of edge difference plus number of
+    already contracted neighbours. A shortcut u -> x via v is added only
+    when a limited witness search finds no path u -> x avoiding v that is
+    at least as short; an aborted witness search just adds the shortcut,
+    which keeps the hierarchy exact.
+
+    Returns a dict of numpy arrays (see CH_ARRAYS): node ranks and the
+    upward forward / backward graphs in CSR form. `*_mid` holds the
+    contracted middle node of a shortcut, or -1 for an original edge.
+    """
+    n = len(snapshot)
+    indptr = np.asarray(snapshot.indptr)
+    indices = np.asarray(snapshot.indices).tolist()
+    lengths = np.asarray(snapshot.lengths).tolist()
+
+    # Remaining graph: out_edges[u][v] = in_edges[v][u] = (weight, middle node)
+    out_edges = [dict() for _ in range(n)]
+    in_edges = [dict() for _ in range(n)]
+    for u in range(n):
+        for k in range(indptr[u], indptr[u + 1]):
+            v, w = indices[k], lengths[k]
+            if u == v:
+                continue
+            if v not in out_edges[u] or w < out_edges[u][v][0]:
+                out_edges[u][v] = (w, -1)
+                in_edges[v][u] = (w, -1)
+
+    contracted = bytearray(n)
+    deleted_neighbours = [0] * n
+
+    def witness_search(source, excluded, limit):
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = 0
+        while heap and settled < witness_settle_limit:
+            d, u = heapq.heappop(heap)
+            if d > dist.get(u, float('inf')):
+                continue
+            if d > limit:
+                break
+            settled += 1
+            for v, (w, _) in out_edges[u].items():
+                if v == excluded:
+                    continue
+                nd = d + w
+                if nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return dist
+
+    def needed_shortcuts(v):
+        shortcuts = []
+        outgoing = out_edges[v]
+        for u, (w_in, _) in in_edges[v].items():
+            targets = [(x, w_out) for x, (w_out, _) in outgoing.items() if x != u]
+            if not targets:
+                continue
+            limit = w_in + max(w for _, w in targets)
+            dist = witness_search(u, v, limit)
+            for x, w_out in targets:
+                via = w_in + w_out
+                if dist.get(x, float('inf')) > via:
+                    shortcuts.append((u, x, via))
+        return shortcuts
+
+    def priority(v):
+        return (len(needed_shortcuts(v)) - len(in_edges[v]) - len(out_edges[v])
+                + deleted_neighbours[v])
+
+    heap = [(priority(v), v) for v in range(n)]
+    heapq.heapify(heap)
+
+    rank = np.empty(n, dtype=np.int32)
+    fwd = [None] * n   # upward edges leaving v:   (x, weight, mid)
+    bwd = [None] * n   # upward edges entering v:  (u, weight, mid)
+    next_rank = 0
+    start = time.perf_counter()
+    while heap:
+        _, v = heapq.heappop(heap)
+        if contracted[v]:
+            continue
+        # Lazy update: re-evaluate and put back if it is no longer the minimum
+        current = priority(v)
+        if heap and current > heap[0][0]:
+            heapq.heappush(heap, (current, v))
+            continue
+
+        for u, x, via in needed_shortcuts(v):
+            if x not in out_edges[u] or via < out_edges[u][x][0]:
+                out_edges[u][x] = (via, v)
+                in_edges[x][u] = (via, v)
+
+        rank[v] = next_rank
+        next_rank += 1
+        contracted[v] = 1
+        fwd[v] = [(x, w, mid) for x, (w, mid) in out_edges[v].items()]
+        bwd[v] = [(u, w, mid) for u, (w, mid) in in_edges[v].items()]
+        for x in out_edges[v]:
+            del in_edges[x][v]
+            deleted_neighbours[x] += 1
+        for u in in_edges[v]:
+            del out_edges[u][v]
+            deleted_neighbours[u] += 1
+        out_edges[v] = {}
+        in_edges[v] = {}
+
+        if next_rank % 10000 == 0:
+            logger.info(f"Contracted {next_rank}/{n} nodes ({time.perf_counter() - start:.0f}s)")
+
+    arrays = {"rank": rank}
+    for prefix, lists in (("fwd", fwd), ("bwd", bwd)):
+        counts = [len(edges) for edges in lists]
+        arrays[f"{prefix}_indptr"] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        flat = [edge for edges in lists for edge in edges]
+        arrays[f"{prefix}_indices"] = np.array([e[0] for e in flat], dtype=np.int32)
+        arrays[f"{prefix}_weights"] = np.array([e[1] for e in flat], dtype=np.float64)
+        arrays[f"{prefix}_mid"] = np.array([e[2] for e in flat], dtype=np.int32)
+    return arrays
+
+def save_contraction_hierarchy(arrays, snapshot, out_dir):
+    """Write CH arrays as .npy files next to a meta.json (published atomically, see artifacts.py)"""
+    meta = {
+        "version": CH_VERSION,
+        "num_nodes": int(len(snapshot)),
+        "num_edges": int(snapshot.num_edges),
+        "snapshot_fingerprint": snapshot.fingerprint(),
+        "num_upward_edges": int(len(arrays["fwd_indices"]) + len(arrays["bwd_indices"])),
+    }
+    with publish_dir(out_dir) as version_dir:
+        for name in CH_ARRAYS:
+            np.save(os.path.join(version_dir, f"{name}.npy"), arrays[name])
+        with open(os.path.join(version_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+    return out_dir
+
+def load_ch_router(path, snapshot, mmap=True):
+    """
+    Load a saved hierarchy for `snapshot` (memory-mapped by default).
+    Raises ValueError if it was built from other graph contents, even
+    with the same node and edge counts (e.g. edge lengths changed).
+    """
+    path = resolve_dir(path)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != CH_VERSION:
+        raise ValueError(f"Unsupported CH version: {meta.get('version')}")
+    if (meta["num_nodes"] != len(snapshot) or meta["num_edges"] != snapshot.num_edges
+            or meta.get("snapshot_fingerprint") != snapshot.fingerprint()):
+        raise ValueError("Contraction hierarchy was built for a different graph snapshot, "
+                         "rebuild it with python ch_router.py")
+    mmap_mode = "r" if mmap else None
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+              for name in CH_ARRAYS}
+    return CHRouter(snapshot, arrays)
+
+class CHRouter:
+    """
+    Point-to-point queries on a contraction hierarchy: one bidirectional
+    upward search, then shortcut unpacking into the original node path.
+    Same interface as GraphSnapshot.shortest_path.
+    """
+
+    def __init__(self, snapshot, arrays):
+        self.snapshot = snapshot
+        for name in CH_ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def shortest_path(self, source, target):
+        """Returns (list of node ids, length in meters); raises NetworkXNoPath"""
+        s, t = self.snapshot.index_of(source), self.snapshot.index_of(target)
+        if s == t:
+            return [source], 0.0
+
+        dist = ({s: 0.0}, {t: 0.0})
+        parent = ({s: -1}, {t: -1})
+        heaps = ([(0.0, s)], [(0.0, t)])
+        graphs = ((self.fwd_indptr, self.fwd_indices, self.fwd_weights),
+                  (self.bwd_indptr, self.bwd_indices, self.bwd_weights))
+        best, meet = float('inf'), -1
+
+        while heaps[0] or heaps[1]:
+            for side in (0, 1):
+                heap = heaps[side]
+                if not heap:
+                    continue
+                d, u = heapq.heappop(heap)
+                if d > dist[side][u]:
+                    continue
+                if d >= best:
+                    heap.clear()
+                    continue
+                other = dist[1 - side].get(u)
+                if other is not None and d + other < best:
+                    best, meet = d + other, u
+                indptr, indices, weights = graphs[side]
+                a, b = indptr[u], indptr[u + 1]
+                for v, w in zip(indices[a:b].tolist(), weights[a:b].tolist()):
+                    nd = d + w
+                    if nd < dist[side].get(v, float('inf')):
+                        dist[side][v] = nd
+                        parent[side][v] = u
+                        heapq.heappush(heap, (nd, v))
+
+        if meet < 0:
+            raise nx.NetworkXNoPath(f"No path between {source} and {target}")
+
+        # Up-path s -> meet, then meet -> t (backward parents point towards t)
+        up = []
+        u = meet
+        while u != -1:
+            up.append(u)
+            u = parent[0][u]
+        up.reverse()
+        u = parent[1][meet]
+        while u != -1:
+            up.append(u)
+            u = parent[1][u]
+
+        path = [up[0]]
+        distance_m = 0.0
+        for a, b in zip(up[:-1], up[1:]):
+            for x, y, w in self._unpack(a, b):
+                path.append(y)
+                # Same left-to-right accumulation as networkx Dijkstra
+                distance_m += w
+        return self.snapshot.node_ids[path].tolist(), distance_m
+
+    def _edge(self, u, v):
+        """(weight, mid) of the hierarchy edge u -> v"""
+        if self.rank[u] < self.rank[v]:
+            a, b = self.fwd_indptr[u], self.fwd_indptr[u + 1]
+            hit = a + int(np.flatnonzero(self.fwd_indices[a:b] == v)[0])
+            return float(self.fwd_weights[hit]), int(self.fwd_mid[hit])
+        a, b = self.bwd_indptr[v], self.bwd_indptr[v + 1]
+        hit = a + int(np.flatnonzero(self.bwd_indices[a:b] == u)[0])
+        return float(self.bwd_weights[hit]), int(self.bwd_mid[hit])
+
+    def _unpack(self, u, v):
+        """Original edges (x, y, length) of the hierarchy edge u -> v, in order"""
+        stack = [(u, v)]
+        while stack:
+            x, y = stack.pop()
+            w, mid = self._edge(x, y)
+            if mid < 0:
+                yield x, y, w
+            else:
+                stack.append((mid, y))
+                stack.append((x, mid))
+
+def verify_against_networkx(router, G, pairs):
+    """
+    Compare CH distances with nx.shortest_path_length(weight='length')
+    on (source, target) node pairs. Returns a summary dict.
+    """
+    checked = mismatches = unreachable = 0
+    max_abs_diff = 0.0
+    for source, target in pairs:
+        try:
+            expected = nx.shortest_path_length(G, source, target, weight='length')
+        except nx.NetworkXNoPath:
+            expected = None
+        try:
+            _, actual = router.shortest_path(source, target)
+        except nx.NetworkXNoPath:
+            actual = None
+
+        checked += 1
+        if expected is None or actual is None:
+            unreachable += expected is None
+            mismatches += (expected is None) != (actual is None)
+            continue
+        diff = abs(expected - actual)
+        max_abs_diff = max(max_abs_diff, diff)
+        if diff > 1e-6:
+            mismatches += 1
+            logger.warning(f"CH mismatch {source}->{target}: networkx={expected} ch={actual}")
+    return {"checked": checked, "mismatches": mismatches,
+            "unreachable": unreachable, "max_abs_diff_m": max_abs_diff}
+
+def sample_trip_pairs(snapshot, count, seed=0):
+    """Random NYC-like trips: uniform points in the graph's extent, snapped to nodes"""
+    from spatial_index import get_node_index
+
+    rng = np.random.default_rng(seed)
+    x0, x1 = float(np.min(snapshot.node_x)), float(np.max(snapshot.node_x))
+    y0, y1 = float(np.min(snapshot.node_y)), float(np.max(snapshot.node_y))
+    X = rng.uniform(x0, x1, size=2 * count)
+    Y = rng.uniform(y0, y1, size=2 * count)
+    nodes = get_node_index(snapshot).nearest_nodes(X, Y).tolist()
+    return list(zip(nodes[:count], nodes[count:]))
+
+# -----------------------------
+# Command line: offline preprocessing (+ optional verification)
+#   python ch_router.py [snapshot_dir] [ch_dir] [--verify N]
+# -----------------------------
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Preprocess a contraction hierarchy from a graph snapshot")
+    arg_parser.add_argument("snapshot_dir", nargs="?", default="nyc_graph.snapshot")
+    arg_parser.add_argument("ch_dir", nargs="?", default="nyc_graph.ch")
+    arg_parser.add_argument("--verify", type=int, default=0, metavar="N",
+                            help="check N random trips against networkx on the GraphML")
+    arg_parser.add_argument("--graphml", default="nyc_graph.graphml", help="GraphML used by --verify")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    snapshot = load_graph_snapshot(args.snapshot_dir, mmap=False)
+    start = time.perf_counter()
+    arrays = build_contraction_hierarchy(snapshot)
+    save_contraction_hierarchy(arrays, snapshot, args.ch_dir)
+    print(f"Contraction hierarchy written to {args.ch_dir} in {time.perf_counter() - start:.1f}s")
+
+    if args.verify:
+        import osmnx as ox
+
+        G = ox.load_graphml(args.graphml)
+        router = load_ch_router(args.ch_dir, snapshot)
+        print(verify_against_networkx(router, G, sample_trip_pairs(snapshot, args.verify)))
@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+import weakref
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order, connected_components
+
+from graph_snapshot import graph_to_snapshot
+
+logger = logging.getLogger(__name__)
+
+# One Connectivity per graph object, computed once (at load time) and kept for its lifetime
+_connectivity = weakref.WeakKeyDictionary()
+_connectivity_lock = threading.Lock()
+
+def get_connectivity(G):
+    """Return the (cached) Connectivity of a networkx graph or GraphSnapshot"""
+    connectivity = _connectivity.get(G)
+    if connectivity is None:
+        with _connectivity_lock:
+            connectivity = _connectivity.get(G)
+            if connectivity is None:
+                connectivity = compute_connectivity(G)
+                _connectivity[G] = connectivity
+    return connectivity
+
+def register_connectivity(G, connectivity):
+    """Use a Connectivity computed elsewhere (e.g. stored with a tiled graph) for G"""
+    with _connectivity_lock:
+        _connectivity[G] = connectivity
+
+def _topological_order(num_components, src, dst):
+    """Position of every component in a topological order of the condensation (Kahn)"""
+    order = np.empty(num_components, dtype=np.int64)
+    graph = csr_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(num_components, num_components))
+    indptr, indices = graph.indptr, graph.indices
+    in_degree = np.bincount(indices, minlength=num_components)
+    ready = np.flatnonzero(in_degree == 0).tolist()
+    position = 0
+    while ready:
+        c = ready.pop()
+        order[c] = position
+        position += 1
+        for d in indices[indptr[c]:indptr[c + 1]].tolist():
+            in_degree[d] -= 1
+            if in_degree[d] == 0:
+                ready.append(d)
+    return order
+
+def compute_connectivity(G):
+    """
+    Strongly connected components of the directed road graph plus what is
+    needed to answer "can u reach v?" without searching: the largest
+    ("main") component, which components reach it / are reached from it,
+    and a topological order of the component DAG.
+    """
+    start = time.perf_counter()
+    snapshot = graph_to_snapshot(G)
+    n = len(snapshot)
+    indptr = np.asarray(snapshot.indptr)
+    indices = np.asarray(snapshot.indices)
+    graph = csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(n, n))
+    num_components, labels = connected_components(graph, directed=True, connection="strong")
+    main = int(np.argmax(np.bincount(labels)))
+
+    # Condensation: one edge per pair of components joined by a road
+    src = labels[np.repeat(np.arange(n), np.diff(indptr))]
+    dst = labels[indices]
+    cross = src != dst
+    src, dst = src[cross], dst[cross]
+    condensation = csr_matrix((np.ones(len(src), dtype=np.int8), (src, dst)),
+                              shape=(num_components, num_components))
+
+    from_main = np.zeros(num_components, dtype=bool)
+    from_main[breadth_first_order(condensation, main, directed=True, return_predecessors=False)] = True
+    reaches_main = np.zeros(num_components, dtype=bool)
+    reaches_main[breadth_first_order(condensation.T.tocsr(), main, directed=True,
+                                     return_predecessors=False)] = True
+
+    connectivity = Connectivity(np.asarray(snapshot.node_ids), labels, main, from_main, reaches_main,
+                                _topological_order(num_components, src, dst))
+    logger.info(f"{num_components} strongly connected components, main component "
+                f"{int(connectivity.main_mask.sum())}/{n} nodes ({time.perf_counter() - start:.2f}s)")
+    return connectivity
+
+class Connectivity:
+    """
+    Constant-time reachability checks between graph nodes. `reachable`
+    answers True / False for every pair involving the main component
+    (almost all real trips) and from the topological order otherwise;
+    only pairs it cannot decide return None and need a search.
+    """
+
+    def __init__(self, node_ids, labels, main, from_main, reaches_main, topo_order):
+        self.node_ids = node_ids
+        self.labels = labels
+        self.main = main
+        self.from_main = from_main
+        self.reaches_main = reaches_main
+        self.topo_order = topo_order
+        self.main_mask = labels == main
+        self.num_components = len(from_main)
+
+    def component_of(self, node):
+        return int(self.labels[np.searchsorted(self.node_ids, node)])
+
+    def in_main_component(self, nodes):
+        """Boolean mask: which of the given node ids are in the main component"""
+        return self.main_mask[np.searchsorted(self.node_ids, np.asarray(nodes, dtype=np.int64))]
+
+    def reachable(self, u, v):
+        """True / False if node u can / cannot reach node v, None if undecided"""
+        cu, cv = self.component_of(u), self.component_of(v)
+        if cu == cv:
+            return True
+        if cu == self.main:
+            return bool(self.from_main[cv])
+        if cv == self.main:
+            return bool(self.reaches_main[cu])
+        if self.reaches_main[cu] and self.from_main[cv]:
+            return True
+        # Downstream of main cannot reach what main cannot reach, and
+        # whatever reaches something upstream of main reaches main too
+        if self.from_main[cu] and not self.from_main[cv]:
+            return False
+        if self.reaches_main[cv] and not self.reaches_main[cu]:
+            return False
+        if self.topo_order[cu] > self.topo_order[cv]:
+            return False
+        return None
+
+    def unreachable_from(self, u, nodes):
+        """
+        Boolean mask over `nodes`: True where node u certainly cannot reach
+        it (reachable(u, v) is False), vectorized for one-to-many searches
+        """
+        cu = self.component_of(u)
+        cv = self.labels[np.searchsorted(self.node_ids, np.asarray(nodes, dtype=np.int64))]
+        if cu == self.main:
+            unreachable = ~self.from_main[cv]
+        else:
+            unreachable = ((self.from_main[cu] & ~self.from_main[cv])
+                           | (self.reaches_main[cv] & ~self.reaches_main[cu])
+                           | (self.topo_order[cu] > self.topo_order[cv]))
+            unreachable &= ~(self.reaches_main[cu] & self.from_main[cv])
+            unreachable[cv == self.main] = not self.reaches_main[cu]
+        return unreachable & (cv != cu)
+
+    def stats(self):
+        return {
+            "components": int(self.num_components),
+            "main_component_nodes": int(self.main_mask.sum()),
+            "nodes": int(len(self.labels)),
+        }
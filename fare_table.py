@@ -0,0 +1,222 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+from artifacts import publish_dir, resolve_dir
+from features import DISTANCE_COLUMN, FEATURE_COLUMNS, NUM_FEATURES
+
+logger = logging.getLogger(__name__)
+
+FARE_TABLE_VERSION = 1
+
+FARE_TABLE_ARRAYS = ("breakpoints", "values")
+
+# Discrete inputs of the model and the values they can take
+PASSENGER_COUNTS = np.arange(1, 7)
+HOURS = np.arange(24)
+WEEKEND_FLAGS = np.arange(2)
+MONTHS = np.arange(1, 13)
+WEEKDAYS = np.arange(7)
+NUM_COMBOS = len(PASSENGER_COUNTS) * len(HOURS) * len(WEEKEND_FLAGS) * len(MONTHS) * len(WEEKDAYS)
+
+def model_fingerprint(model_path):
+    """sha256 of the model file, used to pair a table with its model"""
+    with open(model_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def combo_index(passenger_count, hour, is_weekend, month, weekday):
+    """Row of the table for one combination of the discrete features (scalars or arrays)"""
+    return ((((passenger_count - 1) * 24 + hour) * 2 + is_weekend) * 12 + (month - 1)) * 7 + weekday
+
+def _combo_features():
+    """Feature vector (without distance) of every combination, in combo_index order"""
+    p, h, w, m, d = np.meshgrid(PASSENGER_COUNTS, HOURS, WEEKEND_FLAGS, MONTHS, WEEKDAYS, indexing="ij")
+    p, h, w, m, d = (a.ravel() for a in (p, h, w, m, d))
+    X = np.zeros((NUM_COMBOS, NUM_FEATURES), dtype=np.float32)
+    X[:, 0] = p
+    X[:, 2] = h
+    X[:, 3] = w
+    X[np.arange(NUM_COMBOS), FEATURE_COLUMNS.index('month_1') + m - 1] = 1
+    X[np.arange(NUM_COMBOS), FEATURE_COLUMNS.index('dow_0') + d] = 1
+    return X
+
+def compile_fare_table(model_path):
+    """
+    Walk the trees of an XGBoost JSON model and tabulate its prediction for
+    every combination of the discrete features and every distance interval
+    between consecutive `distance_km` split thresholds.
+
+    Leaf values are accumulated in float32 in tree order on top of the base
+    score, the same arithmetic the booster uses, so the table is exact.
+    The table is dense, (combinations x intervals) float32, and all
+    combinations share one sorted breakpoint array.
+    """
+    with open(model_path) as f:
+        model = json.load(f)
+    learner = model["learner"]
+    objective = learner["objective"]["name"]
+    if objective not in ("reg:squarederror", "reg:linear"):
+        raise ValueError(f"Fare table needs an identity-link objective, got {objective}")
+    trees = learner["gradient_booster"]["model"]["trees"]
+    base_score = np.float32(float(learner["learner_model_param"]["base_score"]))
+
+    # Global distance breakpoints: x < threshold goes left in every split
+    breakpoints = np.unique(np.array(
+        [c for t in trees for f, c, left in zip(t["split_indices"], t["split_conditions"], t["left_children"])
+         if left != -1 and f == DISTANCE_COLUMN],
+        dtype=np.float32,
+    ))
+    num_intervals = len(breakpoints) + 1
+    combos = _combo_features()
+
+    table = np.full((NUM_COMBOS, num_intervals), base_score, dtype=np.float32)
+    start = time.perf_counter()
+    for tree in trees:
+        left, right = tree["left_children"], tree["right_children"]
+        feature, condition = tree["split_indices"], tree["split_conditions"]
+        stack = [(0, np.arange(NUM_COMBOS), 0, num_intervals)]
+        while stack:
+            node, rows, lo, hi = stack.pop()
+            if len(rows) == 0 or lo >= hi:
+                continue
+            if left[node] == -1:
+                # Leaf: split_conditions holds the leaf value
+                table[rows[:, None], np.arange(lo, hi)] += np.float32(condition[node])
+                continue
+            threshold = np.float32(condition[node])
+            if feature[node] == DISTANCE_COLUMN:
+                # Intervals [breakpoints[k-1], breakpoints[k]) with breakpoints[k] <= threshold go left
+                split = int(np.searchsorted(breakpoints, threshold)) + 1
+                stack.append((left[node], rows, lo, min(hi, split)))
+                stack.append((right[node], rows, max(lo, split), hi))
+            else:
+                goes_left = combos[rows, feature[node]] < threshold
+                stack.append((left[node], rows[goes_left], lo, hi))
+                stack.append((right[node], rows[~goes_left], lo, hi))
+    logger.info(f"Tabulated {len(trees)} trees over {NUM_COMBOS} combinations x "
+                f"{num_intervals} intervals in {time.perf_counter() - start:.1f}s")
+
+    return {"breakpoints": breakpoints, "values": table}
+
+def save_fare_table(arrays, model_path, out_dir):
+    """Write the table as .npy files plus meta.json (published atomically, see artifacts.py)"""
+    meta = {
+        "version": FARE_TABLE_VERSION,
+        "model_sha256": model_fingerprint(model_path),
+        "num_combos": NUM_COMBOS,
+        "num_breakpoints": int(len(arrays["breakpoints"])),
+    }
+    with publish_dir(out_dir) as version_dir:
+        for name in FARE_TABLE_ARRAYS:
+            np.save(os.path.join(version_dir, f"{name}.npy"), arrays[name])
+        with open(os.path.join(version_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+    return out_dir
+
+def load_fare_table(path, model_path=None, mmap=True):
+    """
+    Load a compiled table. If `model_path` is given, refuse a table that
+    was compiled from a different model file.
+    """
+    path = resolve_dir(path)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != FARE_TABLE_VERSION:
+        raise ValueError(f"Unsupported fare table version: {meta.get('version')}")
+    if model_path is not None and meta["model_sha256"] != model_fingerprint(model_path):
+        raise ValueError("Fare table was compiled from a different model")
+    mmap_mode = "r" if mmap else None
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+              for name in FARE_TABLE_ARRAYS}
+    return FareTable(meta=meta, **arrays)
+
+class FareTable:
+    """
+    Raw model prediction = values[combination, interval], where the
+    interval comes from one binary search over the distance breakpoints.
+    """
+
+    def __init__(self, breakpoints, values, meta=None):
+        self.breakpoints = breakpoints
+        self.values = values
+        self.meta = meta or {}
+
+    def entry_breakpoints(self, combo):
+        """Sorted distances at which one combination's prediction changes"""
+        row = np.asarray(self.values[combo])
+        return np.asarray(self.breakpoints)[np.flatnonzero(row[1:] != row[:-1])]
+
+    def predict_one(self, passenger_count, distance_km, hour, is_weekend, month, weekday):
+        """Raw prediction for one trip"""
+        interval = bisect.bisect_right(self.breakpoints, np.float32(distance_km))
+        combo = combo_index(max(1, min(6, passenger_count)), hour, int(is_weekend), month, weekday)
+        return float(self.values[combo, interval])
+
+    def predict(self, X):
+        """Raw predictions for a (n, 23) feature matrix in FEATURE_COLUMNS order"""
+        X = np.asarray(X)
+        month_cols = X[:, FEATURE_COLUMNS.index('month_1'):FEATURE_COLUMNS.index('month_12') + 1]
+        dow_cols = X[:, FEATURE_COLUMNS.index('dow_0'):FEATURE_COLUMNS.index('dow_6') + 1]
+        combo = combo_index(
+            np.clip(X[:, 0].astype(np.int64), 1, 6), X[:, 2].astype(np.int64), X[:, 3].astype(np.int64),
+            np.argmax(month_cols, axis=1) + 1, np.argmax(dow_cols, axis=1),
+        )
+        interval = np.searchsorted(self.breakpoints, X[:, DISTANCE_COLUMN].astype(np.float32), side="right")
+        return self.values[combo, interval]
+
+def verify_fare_table(table, booster, num_samples=100000, seed=0):
+    """
+    Compare the table with booster predictions on random valid trips,
+    including distances placed exactly on and just below every breakpoint.
+    """
+    from features import predict_inplace
+
+    rng = np.random.default_rng(seed)
+    n = num_samples
+    X = np.zeros((n, NUM_FEATURES), dtype=np.float32)
+    weekday = rng.integers(0, 7, n)
+    X[:, 0] = rng.integers(1, 7, n)
+    X[:, 2] = rng.integers(0, 24, n)
+    X[:, 3] = weekday >= 5
+    X[np.arange(n), FEATURE_COLUMNS.index('month_1') + rng.integers(0, 12, n)] = 1
+    X[np.arange(n), FEATURE_COLUMNS.index('dow_0') + weekday] = 1
+    distances = rng.uniform(0, 60, n).astype(np.float32)
+    on_breakpoint = rng.random(n) < 0.3
+    picks = np.asarray(table.breakpoints)[rng.integers(0, len(table.breakpoints), n)]
+    below = rng.random(n) < 0.5
+    picks = np.where(below, np.nextafter(picks, np.float32(-np.inf)), picks)
+    X[:, DISTANCE_COLUMN] = np.where(on_breakpoint, picks, distances)
+
+    expected = predict_inplace(booster, X)
+    actual = table.predict(X)
+    diff = np.abs(expected.astype(np.float64) - actual)
+    return {
+        "checked": int(n),
+        "exact_matches": int(np.sum(expected == actual)),
+        "max_abs_diff": float(diff.max()),
+    }
+
+# -----------------------------
+# Command line: compile (+ verify)
+#   python fare_table.py [model.json] [table_dir]
+# -----------------------------
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    model_path = sys.argv[1] if len(sys.argv) > 1 else "xgb_fare_model.json"
+    table_dir = sys.argv[2] if len(sys.argv) > 2 else "xgb_fare_model.table"
+
+    import xgboost as xgb
+
+    start = time.perf_counter()
+    save_fare_table(compile_fare_table(model_path), model_path, table_dir)
+    print(f"Fare table written to {table_dir} in {time.perf_counter() - start:.1f}s")
+
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    print(verify_fare_table(load_fare_table(table_dir, model_path), booster))
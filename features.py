@@ -0,0 +1,90 @@
+import threading
+from datetime import datetime
+
+import numpy as np
+from dateutil import parser
+
+# Exact feature layout expected by xgb_fare_model.json (23 columns)
+FEATURE_COLUMNS = ['passenger_count', 'distance_km', 'hour', 'is_weekend'] + \
+                  [f'month_{m}' for m in range(1, 13)] + \
+                  [f'dow_{d}' for d in range(7)]
+
+NUM_FEATURES = len(FEATURE_COLUMNS)
+DISTANCE_COLUMN = FEATURE_COLUMNS.index('distance_km')
+_MONTH_OFFSET = FEATURE_COLUMNS.index('month_1') - 1   # month m -> column _MONTH_OFFSET + m
+_DOW_OFFSET = FEATURE_COLUMNS.index('dow_0')           # weekday d -> column _DOW_OFFSET + d
+
+# NYC minimum fare
+MIN_FARE = 2.50
+
+# Preallocated per-thread buffers, reused by every request on that thread
+_buffers = threading.local()
+
+def parse_trip_datetime(dt_str):
+    """
+    Parse a trip datetime. The fixed 'YYYY-MM-DD HH:MM:SS' format built by
+    app.py is sliced directly; anything else goes through dateutil.
+    """
+    if (len(dt_str) == 19 and dt_str[4] == '-' and dt_str[7] == '-'
+            and dt_str[10] == ' ' and dt_str[13] == ':' and dt_str[16] == ':'):
+        try:
+            return datetime(int(dt_str[0:4]), int(dt_str[5:7]), int(dt_str[8:10]),
+                            int(dt_str[11:13]), int(dt_str[14:16]), int(dt_str[17:19]))
+        except ValueError:
+            pass
+    return parser.parse(dt_str)
+
+def row_buffer():
+    """This thread's reusable (1, 23) float32 feature row"""
+    row = getattr(_buffers, 'row', None)
+    if row is None:
+        row = _buffers.row = np.zeros((1, NUM_FEATURES), dtype=np.float32)
+    return row
+
+def matrix_buffer(n):
+    """This thread's reusable (n, 23) float32 feature matrix (grown on demand)"""
+    matrix = getattr(_buffers, 'matrix', None)
+    if matrix is None or len(matrix) < n:
+        matrix = _buffers.matrix = np.zeros((max(n, 64), NUM_FEATURES), dtype=np.float32)
+    return matrix[:n]
+
+def encode_row(out, passenger_count, distance_km, dt):
+    """Write one trip's features into `out` (a float32 row) in model column order"""
+    weekday = dt.weekday()
+    out[:] = 0
+    out[0] = max(1, min(6, passenger_count))
+    out[DISTANCE_COLUMN] = max(0, distance_km)
+    out[2] = dt.hour
+    out[3] = weekday >= 5
+    out[_MONTH_OFFSET + dt.month] = 1
+    out[_DOW_OFFSET + weekday] = 1
+    return out
+
+def encode_matrix(out, passenger_counts, distances_km, datetimes):
+    """Write many trips' features into `out` (float32, shape (n, 23))"""
+    n = len(datetimes)
+    months = np.fromiter((dt.month for dt in datetimes), dtype=np.int64, count=n)
+    weekdays = np.fromiter((dt.weekday() for dt in datetimes), dtype=np.int64, count=n)
+    rows = np.arange(n)
+    out[:] = 0
+    out[:, 0] = np.clip(passenger_counts, 1, 6)
+    out[:, DISTANCE_COLUMN] = np.maximum(distances_km, 0)
+    out[:, 2] = np.fromiter((dt.hour for dt in datetimes), dtype=np.float32, count=n)
+    out[:, 3] = weekdays >= 5
+    out[rows, _MONTH_OFFSET + months] = 1
+    out[rows, _DOW_OFFSET + weekdays] = 1
+    return out
+
+def encode_trip(passenger_count, distance_km, dt):
+    """Features of a single trip in this thread's preallocated row"""
+    row = row_buffer()
+    encode_row(row[0], passenger_count, distance_km, dt)
+    return row
+
+def predict_inplace(booster, X):
+    """Score a float32 feature matrix straight through the booster, no DataFrame"""
+    return booster.inplace_predict(X, validate_features=False)
+
+def finalize_fares(pred_fares):
+    """Raw predictions -> quoted fares: positive and at least the NYC minimum fare"""
+    return np.maximum(np.abs(np.asarray(pred_fares, dtype=np.float64)), MIN_FARE)
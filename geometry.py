@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+
+from spatial_index import EARTH_RADIUS_M
+
+# Default Douglas-Peucker tolerance (meters) for route geometry sent to clients
+ROUTE_SIMPLIFY_M = float(os.environ.get("ROUTE_SIMPLIFY_M", 5))
+
+def _project_m(coords):
+    """(lat, lon) pairs -> local equirectangular x / y in meters"""
+    pts = np.asarray(coords, dtype=np.float64)
+    lat0 = np.deg2rad(pts[:, 0].mean())
+    y = np.deg2rad(pts[:, 0]) * EARTH_RADIUS_M
+    x = np.deg2rad(pts[:, 1]) * EARTH_RADIUS_M * np.cos(lat0)
+    return x, y
+
+def simplify_route(coords, tolerance_m=ROUTE_SIMPLIFY_M):
+    """
+    Douglas-Peucker simplification of a (lat, lon) polyline: drop every
+    point closer than tolerance_m to the line between the points kept
+    around it. The first and last points are always kept.
+    Returns a list of (lat, lon) tuples.
+    """
+    coords = [tuple(c) for c in coords]
+    if len(coords) <= 2 or not tolerance_m or tolerance_m <= 0:
+        return coords
+    x, y = _project_m(coords)
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(coords) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        seg2 = dx * dx + dy * dy
+        if seg2 == 0:
+            dist = np.hypot(px, py)
+        else:
+            # Distance to the segment (projection clamped to its ends)
+            t = np.clip((px * dx + py * dy) / seg2, 0, 1)
+            dist = np.hypot(px - t * dx, py - t * dy)
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance_m:
+            split = first + 1 + k
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return [c for c, kept in zip(coords, keep) if kept]
+
+def encode_polyline(coords, precision=5):
+    """Encoded polyline (Google format) of (lat, lon) pairs"""
+    factor = 10 ** precision
+    chunks = []
+    prev_lat = prev_lon = 0
+    for lat, lon in coords:
+        ilat, ilon = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (ilat - prev_lat, ilon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        prev_lat, prev_lon = ilat, ilon
+    return "".join(chunks)
+
+def decode_polyline(encoded, precision=5):
+    """Inverse of encode_polyline: list of (lat, lon)"""
+    factor = 10 ** precision
+    coords, values = [], []
+    value = shift = 0
+    for char in encoded:
+        b = ord(char) - 63
+        value |= (b & 0x1f) << shift
+        shift += 5
+        if b < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    lat = lon = 0
+    for dlat, dlon in zip(values[0::2], values[1::2]):
+        lat += dlat
+        lon += dlon
+        coords.append((lat / factor, lon / factor))
+    return coords
+
+def route_geometry(coords, fmt="polyline", tolerance_m=ROUTE_SIMPLIFY_M, precision=5):
+    """
+    JSON geometry of a route: simplified, then encoded as a polyline
+    (fmt="polyline") or kept as [lat, lon] pairs (fmt="coords").
+    """
+    simplified = simplify_route(coords, tolerance_m)
+    geometry = {"points": len(simplified), "original_points": len(coords), "tolerance_m": tolerance_m}
+    if fmt == "coords":
+        geometry["coordinates"] = [[round(float(lat), 6), round(float(lon), 6)] for lat, lon in simplified]
+    else:
+        geometry["polyline"] = encode_polyline(simplified, precision)
+        geometry["precision"] = precision
+    return geometry
@@ -0,0 +1,270 @@
+import hashlib
+import heapq
+import json
+import logging
+import os
+import sys
+import time
+
+import networkx as nx
+import numpy as np
+
+from artifacts import publish_dir, resolve_dir
+from routing_pool import RoutingTimeout
+
+logger = logging.getLogger(__name__)
+
+# NYC bounding box (north, south, east, west) used to download the drive graph
+NYC_BBOX = (40.9176, 40.4774, -73.7004, -74.2591)
+
+SNAPSHOT_VERSION = 1
+
+# One .npy file per array so every array can be memory-mapped on its own
+SNAPSHOT_ARRAYS = ("node_ids", "node_x", "node_y", "indptr", "indices", "lengths")
+
+# Arrays that determine routing results, hashed into GraphSnapshot.fingerprint()
+ROUTING_ARRAYS = ("node_ids", "indptr", "indices", "lengths")
+
+# Searches with a deadline look at the clock once per this many settled nodes
+DEADLINE_CHECK_INTERVAL = 256
+
+def _check_deadline(deadline):
+    if time.monotonic() > deadline:
+        raise RoutingTimeout("routing budget exhausted")
+
+def graph_to_snapshot(G):
+    """
+    Convert a networkx road graph into an in-memory GraphSnapshot
+    (returned unchanged if it already is one).
+
+    Nodes are stored sorted by OSM id together with their coordinates,
+    edges as CSR arrays (indptr / indices / lengths). Parallel edges are
+    collapsed to the shortest one, which is what a `weight='length'`
+    shortest path on the MultiDiGraph would use anyway.
+    """
+    if isinstance(G, GraphSnapshot):
+        return G
+    node_ids = np.array(sorted(G.nodes), dtype=np.int64)
+    node_x = np.array([G.nodes[n]['x'] for n in node_ids.tolist()], dtype=np.float64)
+    node_y = np.array([G.nodes[n]['y'] for n in node_ids.tolist()], dtype=np.float64)
+    position = {n: i for i, n in enumerate(node_ids.tolist())}
+
+    indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+    indices, lengths = [], []
+    for i, u in enumerate(node_ids.tolist()):
+        for v, edge_data in G[u].items():
+            if G.is_multigraph():
+                length = min(edge.get('length', 1) for edge in edge_data.values())
+            else:
+                length = edge_data.get('length', 1)
+            indices.append(position[v])
+            lengths.append(length)
+        indptr[i + 1] = len(indices)
+
+    meta = {"version": SNAPSHOT_VERSION, "crs": str(G.graph.get("crs", "epsg:4326"))}
+    return GraphSnapshot(node_ids, node_x, node_y, indptr,
+                         np.array(indices, dtype=np.int32), np.array(lengths, dtype=np.float64),
+                         meta=meta)
+
+def compile_graph_snapshot(G, out_dir):
+    """Compile a networkx road graph into a binary snapshot directory"""
+    snapshot = graph_to_snapshot(G)
+    arrays = {name: getattr(snapshot, name) for name in SNAPSHOT_ARRAYS}
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "num_nodes": int(len(snapshot)),
+        "num_edges": int(snapshot.num_edges),
+        "fingerprint": snapshot.fingerprint(),
+        "crs": snapshot.meta.get("crs", "epsg:4326"),
+    }
+    # Readers never see half a snapshot (see artifacts.publish_dir)
+    with publish_dir(out_dir) as version_dir:
+        for name, array in arrays.items():
+            np.save(os.path.join(version_dir, f"{name}.npy"), array)
+        with open(os.path.join(version_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+    logger.info(f"Graph snapshot written to {out_dir}: {meta['num_nodes']} nodes, {meta['num_edges']} edges")
+    return out_dir
+
+def load_graph_snapshot(path, mmap=True):
+    """
+    Load a snapshot directory. With mmap=True the arrays are memory-mapped
+    read-only, so several worker processes share the same physical pages.
+    """
+    path = resolve_dir(path)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported graph snapshot version: {meta.get('version')}")
+
+    mmap_mode = "r" if mmap else None
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+              for name in SNAPSHOT_ARRAYS}
+    return GraphSnapshot(path=path, meta=meta, **arrays)
+
+class _NodeView:
+    """Minimal `G.nodes` look-alike: len(), `in` and G.nodes[n]['x'/'y']"""
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __len__(self):
+        return len(self._snapshot.node_ids)
+
+    def __contains__(self, node):
+        return self._snapshot.has_node(node)
+
+    def __getitem__(self, node):
+        i = self._snapshot.index_of(node)
+        return {'x': float(self._snapshot.node_x[i]), 'y': float(self._snapshot.node_y[i])}
+
+    def __iter__(self):
+        return iter(self._snapshot.node_ids.tolist())
+
+class GraphSnapshot:
+    """
+    Read-only road graph backed by (memory-mapped) numpy arrays.
+    Node ids are OSM ids; internally nodes are addressed by their
+    position in the sorted `node_ids` array.
+    """
+
+    def __init__(self, node_ids, node_x, node_y, indptr, indices, lengths, path=None, meta=None):
+        self.node_ids = node_ids
+        self.node_x = node_x
+        self.node_y = node_y
+        self.indptr = indptr
+        self.indices = indices
+        self.lengths = lengths
+        self.path = path
+        self.meta = meta or {}
+        self.nodes = _NodeView(self)
+        # Optional preprocessed point-to-point router (see ch_router.py)
+        self.router = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    def fingerprint(self):
+        """
+        Content id of the routing arrays (nodes, adjacency, edge lengths).
+        Written to meta.json by compile_graph_snapshot, hashed here for
+        older snapshots; data derived from a snapshot (contraction
+        hierarchy) records it to detect a snapshot that changed since.
+        """
+        if "fingerprint" not in self.meta:
+            digest = hashlib.sha1()
+            for name in ROUTING_ARRAYS:
+                digest.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+            self.meta["fingerprint"] = digest.hexdigest()[:16]
+        return self.meta["fingerprint"]
+
+    def index_of(self, node):
+        """Position of an OSM node id, KeyError if it is not in the graph"""
+        i = int(np.searchsorted(self.node_ids, node))
+        if i >= len(self.node_ids) or self.node_ids[i] != node:
+            raise KeyError(node)
+        return i
+
+    def has_node(self, node):
+        try:
+            self.index_of(node)
+            return True
+        except (KeyError, TypeError):
+            return False
+
+    def shortest_path(self, source, target, deadline=None):
+        """
+        Dijkstra on the CSR arrays, stopping as soon as the target is settled.
+        Returns (list of node ids, length in meters); raises NetworkXNoPath,
+        or RoutingTimeout once time.monotonic() passes `deadline`.
+        """
+        s, t = self.index_of(source), self.index_of(target)
+        dist = {s: 0.0}
+        parent = {s: -1}
+        heap = [(0.0, s)]
+        settled = set()
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if u == t:
+                return self._unwind(parent, t), d
+            settled.add(u)
+            if deadline is not None and len(settled) % DEADLINE_CHECK_INTERVAL == 0:
+                _check_deadline(deadline)
+            a, b = self.indptr[u], self.indptr[u + 1]
+            for v, w in zip(self.indices[a:b].tolist(), self.lengths[a:b].tolist()):
+                nd = d + w
+                if v not in settled and nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    parent[v] = u
+                    heapq.heappush(heap, (nd, v))
+        raise nx.NetworkXNoPath(f"No path between {source} and {target}")
+
+    def shortest_path_lengths(self, source, targets, cutoff=None, deadline=None):
+        """
+        One-to-many Dijkstra: road distance (meters) from `source` to each
+        node id in `targets`, from a single search that stops once every
+        target is settled or the frontier passes `cutoff` meters.
+        Returns a float64 array aligned with `targets` (inf = not reached).
+        """
+        s = self.index_of(source)
+        wanted = {}
+        for k, target in enumerate(targets):
+            wanted.setdefault(self.index_of(target), []).append(k)
+        lengths = np.full(len(targets), np.inf)
+        limit = float('inf') if cutoff is None else cutoff
+        dist = {s: 0.0}
+        heap = [(0.0, s)]
+        settled = set()
+        while heap and wanted:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if d > limit:
+                break
+            settled.add(u)
+            if u in wanted:
+                lengths[wanted.pop(u)] = d
+            if deadline is not None and len(settled) % DEADLINE_CHECK_INTERVAL == 0:
+                _check_deadline(deadline)
+            a, b = self.indptr[u], self.indptr[u + 1]
+            for v, w in zip(self.indices[a:b].tolist(), self.lengths[a:b].tolist()):
+                nd = d + w
+                if v not in settled and nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return lengths
+
+    def _unwind(self, parent, t):
+        path = []
+        while t != -1:
+            path.append(t)
+            t = parent[t]
+        return self.node_ids[path[::-1]].tolist()
+
+# -----------------------------
+# Command line: one-time compile step
+# -----------------------------
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    graph_file = sys.argv[1] if len(sys.argv) > 1 else "nyc_graph.graphml"
+    snapshot_dir = sys.argv[2] if len(sys.argv) > 2 else "nyc_graph.snapshot"
+
+    import osmnx as ox
+
+    start = time.perf_counter()
+    if os.path.exists(graph_file):
+        print(f"Loading {graph_file}...")
+        G = ox.load_graphml(graph_file)
+    else:
+        print("GraphML not found, downloading from OSM...")
+        G = ox.graph_from_bbox(*NYC_BBOX, network_type="drive")
+        ox.save_graphml(G, filepath=graph_file)
+    compile_graph_snapshot(G, snapshot_dir)
+    print(f"Snapshot compiled to {snapshot_dir} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,81 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the model / graph files (HOT_RELOAD_INTERVAL_S, 0 = no watcher)
+HOT_RELOAD_INTERVAL_S = float(os.environ.get("HOT_RELOAD_INTERVAL_S", 0))
+
+def file_version(path):
+    """
+    Short content id of a model / graph file or directory: SHA-1 of a file,
+    or of the names, sizes and mtimes of a directory's files. Identical
+    files give identical ids in every worker (cache keys include it).
+    """
+    digest = hashlib.sha1()
+    if os.path.isdir(path):
+        for root, _, files in sorted(os.walk(path)):
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                digest.update(f"{os.path.relpath(os.path.join(root, name), path)}:{stat.st_size}:"
+                              f"{stat.st_mtime_ns}\n".encode())
+    else:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()[:12]
+
+def _signature(paths):
+    """Cheap change check: (path, mtime, size) of every existing path"""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+class ReloadWatcher:
+    """
+    Background thread that polls the files behind each reloadable source
+    and calls its reload function when they change. Every worker process
+    runs its own watcher, so a file replaced on disk reaches all of them.
+    A reload that fails keeps the old version and is retried on the next
+    change.
+    """
+
+    def __init__(self, sources, interval_s=HOT_RELOAD_INTERVAL_S):
+        # name -> (function returning the watched paths, reload function)
+        self.sources = sources
+        self.interval_s = interval_s
+        self._seen = {name: _signature(paths()) for name, (paths, _) in sources.items()}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="reload-watcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Watching {', '.join(self.sources)} for changes every {self.interval_s:g}s")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            for name, (paths, reload) in self.sources.items():
+                signature = _signature(paths())
+                if signature == self._seen[name]:
+                    continue
+                # Wait for writers to finish before loading
+                time.sleep(min(self.interval_s, 1.0))
+                if _signature(paths()) != signature:
+                    continue
+                try:
+                    reload()
+                except Exception as e:
+                    logger.exception(f"Reload of {name} failed, keeping the current version: {e}")
+                # Files the reload itself wrote (a recompiled snapshot) are not a new change
+                self._seen[name] = _signature(paths())
@@ -0,0 +1,353 @@
+import bisect
+import functools
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, suppress
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Hot-path stages with a latency histogram
+STAGES = ("snap", "route", "features", "predict", "render")
+
+# Fraction of sampled log events that are written (LOG_SAMPLE_RATE, errors are never sampled)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.01))
+
+# Directory where every worker process publishes its registry (METRICS_DIR, set by serve.py),
+# so /metrics can add up all workers; unset = each process reports only itself
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+
+# Seconds between two publications of a worker's registry
+METRICS_PUBLISH_S = 1.0
+
+class Histogram:
+    """Fixed-bucket latency histogram (cumulative counts are built on export)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (None when empty)"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum_s": round(self.sum, 6),
+            "mean_ms": round(self.sum / self.count * 1000, 4) if self.count else None,
+            "p50_le_ms": _ms(self.quantile(0.5)),
+            "p99_le_ms": _ms(self.quantile(0.99)),
+            "buckets": {_bucket_label(b): n for b, n in zip(self.buckets + (float("inf"),), self.counts)},
+        }
+
+class RateMeter:
+    """Events per second over a sliding window of one-second slots"""
+
+    def __init__(self, window_s=60):
+        self.window_s = window_s
+        self.slots = deque()  # [second, count]
+        self.total = 0
+
+    def mark(self, now=None):
+        second = int(now if now is not None else time.time())
+        if self.slots and self.slots[-1][0] == second:
+            self.slots[-1][1] += 1
+        else:
+            self.slots.append([second, 1])
+        self.total += 1
+        self._trim(second)
+
+    def _trim(self, second):
+        while self.slots and self.slots[0][0] <= second - self.window_s:
+            self.slots.popleft()
+
+    def rate(self, now=None):
+        second = int(now if now is not None else time.time())
+        self._trim(second)
+        return sum(n for _, n in self.slots) / self.window_s
+
+    def merge(self, slots, total):
+        """Add another meter's slots and total (slots in time order)"""
+        merged = {}
+        for second, n in list(self.slots) + list(slots):
+            merged[second] = merged.get(second, 0) + n
+        self.slots = deque([second, n] for second, n in sorted(merged.items()))
+        self.total += total
+
+class Metrics:
+    """
+    In-process metrics registry: per-stage latency histograms, named
+    counters (route branches, fallbacks) and per-endpoint request rates.
+    Every gunicorn worker keeps its own registry; with METRICS_DIR each
+    one publishes it there (`start_publishing`) and `combined_metrics`
+    adds them all up, as Prometheus' multiprocess mode does.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.counters = {}
+        self.requests = {}  # endpoint -> (Histogram, RateMeter)
+        self.statuses = {}
+        self.workers = None  # pids of a combined registry
+        self._publisher_pid = None
+        self._muted = threading.local()
+
+    @contextmanager
+    def muted(self):
+        """Drop everything recorded by the current thread inside the block (reload warm-up)"""
+        self._muted.on = True
+        try:
+            yield
+        finally:
+            self._muted.on = False
+
+    def _is_muted(self):
+        return getattr(self._muted, "on", False)
+
+    def observe(self, stage, seconds):
+        if self._is_muted():
+            return
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the body of a `with` block into the stage histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage):
+        """Decorator: time every call of the function into the stage histogram"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        if self._is_muted():
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_request(self, endpoint, status, seconds):
+        if self._is_muted():
+            return
+        with self._lock:
+            if endpoint not in self.requests:
+                self.requests[endpoint] = (Histogram(), RateMeter())
+            histogram, meter = self.requests[endpoint]
+            histogram.observe(seconds)
+            meter.mark()
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def snapshot(self):
+        """JSON-friendly view of every metric"""
+        with self._lock:
+            uptime = time.time() - self.started
+            scope = {"pid": os.getpid()} if self.workers is None else {"workers": self.workers}
+            return {
+                **scope,
+                "uptime_s": round(uptime, 1),
+                "stages": {stage: h.snapshot() for stage, h in self.stages.items()},
+                "counters": dict(self.counters),
+                "requests": {
+                    endpoint: {
+                        "total": meter.total,
+                        "rate_1m": round(meter.rate(), 3),
+                        "rate_lifetime": round(meter.total / uptime, 3) if uptime > 0 else 0.0,
+                        "latency": histogram.snapshot(),
+                    }
+                    for endpoint, (histogram, meter) in self.requests.items()
+                },
+                "status_codes": dict(self.statuses),
+            }
+
+    def prometheus(self):
+        """The same metrics in the Prometheus text exposition format"""
+        with self._lock:
+            lines = []
+            lines += _prometheus_histograms("fare_stage_seconds", "stage", self.stages)
+            lines += _prometheus_histograms("fare_request_seconds", "endpoint",
+                                            {e: h for e, (h, _) in self.requests.items()})
+            lines.append("# TYPE fare_events_total counter")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'fare_events_total{{event="{name}"}} {value}')
+            lines.append("# TYPE fare_request_rate_1m gauge")
+            for endpoint, (_, meter) in self.requests.items():
+                lines.append(f'fare_request_rate_1m{{endpoint="{endpoint}"}} {meter.rate():.3f}')
+            return "\n".join(lines) + "\n"
+
+    def state(self):
+        """Raw registry contents, as published to METRICS_DIR"""
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "started": self.started,
+                "stages": {stage: [h.counts, h.sum, h.count] for stage, h in self.stages.items()},
+                "counters": dict(self.counters),
+                "requests": {endpoint: [h.counts, h.sum, h.count, [list(slot) for slot in meter.slots], meter.total]
+                             for endpoint, (h, meter) in self.requests.items()},
+                "statuses": dict(self.statuses),
+            }
+
+    def merge_state(self, state):
+        """Add a published registry (see `state`) to this one"""
+        def add(histogram, counts, total, count):
+            histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+            histogram.sum += total
+            histogram.count += count
+
+        with self._lock:
+            self.started = min(self.started, state["started"])
+            for stage, (counts, total, count) in state["stages"].items():
+                add(self.stages.setdefault(stage, Histogram()), counts, total, count)
+            for name, n in state["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for endpoint, (counts, total, count, slots, meter_total) in state["requests"].items():
+                histogram, meter = self.requests.setdefault(endpoint, (Histogram(), RateMeter()))
+                add(histogram, counts, total, count)
+                meter.merge(slots, meter_total)
+            for status, n in state["statuses"].items():
+                self.statuses[status] = self.statuses.get(status, 0) + n
+
+    def publish(self, directory=METRICS_DIR):
+        """
+        Write this process's registry to <directory>/<pid>.json (atomic
+        rename). Each call writes its own temporary file, so the publisher
+        thread and /metrics requests can publish at the same time.
+        """
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.getpid()}-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.state(), f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def start_publishing(self, directory=METRICS_DIR, interval_s=METRICS_PUBLISH_S):
+        """Publish the registry every `interval_s` from a background thread (once per process)"""
+        if directory is None or self._publisher_pid == os.getpid():
+            return
+        self._publisher_pid = os.getpid()
+
+        def run():
+            while True:
+                try:
+                    self.publish(directory)
+                except OSError as e:
+                    logging.getLogger(__name__).warning(f"Could not publish metrics to {directory}: {e}")
+                time.sleep(interval_s)
+
+        threading.Thread(target=run, name="metrics-publisher", daemon=True).start()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.stages = {stage: Histogram() for stage in STAGES}
+            self.counters.clear()
+            self.requests.clear()
+            self.statuses.clear()
+
+def _ms(seconds):
+    if seconds is None:
+        return None
+    return "inf" if seconds == float("inf") else round(seconds * 1000, 4)
+
+def _bucket_label(bound):
+    return "+Inf" if bound == float("inf") else f"{bound:g}"
+
+def _prometheus_histograms(metric, label, histograms):
+    lines = [f"# TYPE {metric} histogram"]
+    for key, h in histograms.items():
+        cumulative = 0
+        for bound, n in zip(h.buckets + (float("inf"),), h.counts):
+            cumulative += n
+            lines.append(f'{metric}_bucket{{{label}="{key}",le="{_bucket_label(bound)}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{{label}="{key}"}} {h.sum:.6f}')
+        lines.append(f'{metric}_count{{{label}="{key}"}} {h.count}')
+    return lines
+
+def process_rss_bytes():
+    """Resident set size of this process (peak RSS where /proc is not available)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Process-wide registry used by app.py and prepare_input.py
+metrics = Metrics()
+
+def combined_metrics(directory=METRICS_DIR):
+    """
+    One registry adding up every worker published in `directory`, this
+    process's current numbers included. Workers that exited keep their
+    last numbers, so counters never go backwards.
+    """
+    metrics.publish(directory)
+    combined = Metrics()
+    combined.workers = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        combined.merge_state(state)
+        combined.workers.append(state["pid"])
+    return combined
+
+def log_event(logger, level, event, sample_rate=None, **fields):
+    """
+    Structured (JSON) log line for hot-path events. Nothing is formatted
+    unless the level is enabled, and below ERROR only a `sample_rate`
+    fraction (default LOG_SAMPLE_RATE) of the events is written, so the
+    logging cost stays flat as traffic grows. Counts belong in `metrics`.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if level < logging.ERROR:
+        rate = LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+        if rate < 1 and random.random() >= rate:
+            return
+    logger.log(level, json.dumps({"event": event, **fields}, default=str))
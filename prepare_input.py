@@ -1,21 +1,50 @@
 import networkx as nx
 import osmnx as ox
+import numpy as np
 import pandas as pd
-from dateutil import parser
 import logging
+import os
+import time
+from connectivity import get_connectivity
+from graph_snapshot import GraphSnapshot
+from tiled_graph import TiledGraph
+from spatial_index import get_node_index
+from route_cache import cache_from_env
+from routing_pool import RoutingTimeout, pool_from_env
+from features import FEATURE_COLUMNS, encode_matrix, encode_trip, matrix_buffer, parse_trip_datetime
+from metrics import log_event, metrics
+from profiling import record_branch
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+# Set up logging (per-trip events are sampled, see metrics.log_event)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
+# Road distances keyed on (graph version, snapped pickup_node, dropoff_node): (distance_m, branch),
+# or None when not connected. Node paths are not kept, they would cost KBs per entry
+route_cache = cache_from_env("route", default_size=20000, schema=2)
+
+# Node paths for map requests, same keys: (node ids as an int64 array, distance_m, branch), or None.
+# Smaller and in-process only, a path costs a few KB
+route_path_cache = cache_from_env("route_path", default_size=2000, shared=False)
+
+_UNCACHED = object()
+
+# Bounded pool running graph searches under a per-request time budget
+# (ROUTING_BUDGET_MS / ROUTING_WORKERS); None routes inline without a budget
+routing_pool = pool_from_env()
+
+def request_deadline():
+    """Routing deadline for a request starting now (None = no budget)"""
+    return routing_pool.deadline() if routing_pool is not None else None
+
 def euclidean_distance_km(lat1, lon1, lat2, lon2):
     """
-    Calculate approximate distance using OSMnx euclidean distance
+    Calculate approximate straight-line distance using OSMnx
     Returns distance in kilometers
     """
     try:
-        # Use OSMnx built-in distance calculation
-        distance_m = ox.distance.euclidean_dist_vec(lat1, lon1, lat2, lon2)
+        # Great-circle distance in meters (euclidean_dist_vec would return degrees here)
+        distance_m = ox.distance.great_circle_vec(lat1, lon1, lat2, lon2)
         return distance_m / 1000  # Convert to kilometers
     except Exception as e:
         logger.error(f"Error calculating euclidean distance: {e}")
@@ -25,9 +54,12 @@ def validate_coordinates(lat, lon):
     """Validate if coordinates are reasonable"""
     return (-90 <= lat <= 90) and (-180 <= lon <= 180)
 
-def find_nearest_nodes_safe(G, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat):
+def find_nearest_nodes_safe(G, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat, edge_fallback_m=None):
     """
-    Safely find nearest nodes with fallback options
+    Safely find nearest nodes with fallback options.
+    Both points are snapped in one query on the graph's persistent spatial
+    index; points farther than `edge_fallback_m` from any node are snapped
+    onto their nearest edge instead.
     """
     try:
         # Validate coordinates first
@@ -36,69 +68,232 @@ def find_nearest_nodes_safe(G, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat)
             raise ValueError("Invalid coordinate values")
         
         # Find nearest nodes
-        pickup_node = ox.distance.nearest_nodes(G, pickup_lon, pickup_lat)
-        dropoff_node = ox.distance.nearest_nodes(G, dropoff_lon, dropoff_lat)
+        with metrics.timer("snap"):
+            pickup_node, dropoff_node = get_node_index(G).snap_pair(
+                pickup_lon, pickup_lat, dropoff_lon, dropoff_lat, edge_fallback_m=edge_fallback_m
+            )
         
         # Verify nodes exist in graph
         if pickup_node not in G.nodes or dropoff_node not in G.nodes:
             raise ValueError("Nodes not found in graph")
         
-        logger.info(f"Found nodes: pickup={pickup_node}, dropoff={dropoff_node}")
+        log_event(logger, logging.DEBUG, "snap", pickup_node=pickup_node, dropoff_node=dropoff_node)
         return pickup_node, dropoff_node
         
     except Exception as e:
         logger.error(f"Error finding nearest nodes: {e}")
         raise
 
-def calculate_route_with_fallback(G, pickup_node, dropoff_node, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+def search_route(G, pickup_node, dropoff_node, deadline=None):
     """
-    Calculate route with multiple fallback strategies
+    Graph part of the routing: shortest path by length.
+    Returns (route_nodes, distance_m, "weighted"), or None if the dropoff
+    cannot be reached from the pickup. Pairs in different strongly
+    connected components are answered from the precomputed connectivity
+    without searching, so a request runs at most one graph search.
+    Snapshot Dijkstra searches stop with RoutingTimeout at `deadline`.
     """
-    route_nodes = []
-    distance_m = 0
-    
+    if get_connectivity(G).reachable(pickup_node, dropoff_node) is False:
+        metrics.count("route_unreachable_precheck")
+        log_event(logger, logging.DEBUG, "route_unreachable", pickup_node=pickup_node, dropoff_node=dropoff_node)
+        return None
+
     try:
-        # Primary method: shortest path by length
-        route_nodes = nx.shortest_path(G, pickup_node, dropoff_node, weight='length')
-        distance_m = nx.shortest_path_length(G, pickup_node, dropoff_node, weight='length')
-        logger.info(f"Route found with {len(route_nodes)} nodes, distance: {distance_m:.2f}m")
+        if isinstance(G, (GraphSnapshot, TiledGraph)):
+            # Contraction hierarchy when available, plain Dijkstra otherwise
+            if G.router is not None:
+                route_nodes, distance_m = G.router.shortest_path(pickup_node, dropoff_node)
+            else:
+                route_nodes, distance_m = G.shortest_path(pickup_node, dropoff_node, deadline=deadline)
+        else:
+            route_nodes = nx.shortest_path(G, pickup_node, dropoff_node, weight='length')
+            distance_m = nx.shortest_path_length(G, pickup_node, dropoff_node, weight='length')
+        log_event(logger, logging.DEBUG, "route", branch="weighted",
+                  nodes=len(route_nodes), distance_m=round(distance_m, 2))
+        return route_nodes, distance_m, "weighted"
         
     except nx.NetworkXNoPath:
-        logger.warning("No path found with length weight, trying without weight")
-        try:
-            # Fallback 1: shortest path without weight
-            route_nodes = nx.shortest_path(G, pickup_node, dropoff_node)
-            # Calculate distance manually
-            total_distance = 0
-            for i in range(len(route_nodes) - 1):
-                node1, node2 = route_nodes[i], route_nodes[i + 1]
-                if G.has_edge(node1, node2):
-                    edge_data = G[node1][node2]
-                    if isinstance(edge_data, dict):
-                        # Multiple edges case
-                        edge_length = min(edge.get('length', 0) for edge in edge_data.values())
-                    else:
-                        edge_length = edge_data.get('length', 0)
-                    total_distance += edge_length
-            distance_m = total_distance
-            logger.info(f"Fallback route found with {len(route_nodes)} nodes")
-            
-        except nx.NetworkXNoPath:
-            logger.warning("No path found, using euclidean distance")
-            # Fallback 2: use straight-line distance
-            distance_km = euclidean_distance_km(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
-            distance_m = distance_km * 1000
-            route_nodes = [pickup_node, dropoff_node]  # Simple direct connection
+        # A path by hop count exists exactly when a path by length does,
+        # so there is nothing left to search
+        return None
+
+def calculate_route_detailed(G, pickup_node, dropoff_node, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon,
+                             deadline=None, with_path=True):
+    """
+    Calculate route with multiple fallback strategies.
+    Graph results (distance and branch, or "not connected") are cached per
+    snapped (pickup_node, dropoff_node) pair and looked up before any
+    search or deadline, so hot pairs skip routing entirely: requests that
+    only need the distance (`with_path=False`, route_nodes is then None)
+    read route_cache, map requests read the node path from the smaller
+    route_path_cache.
+    With a `deadline` (see request_deadline) a search runs in the routing
+    pool and the caller gives up waiting when the deadline passes; the
+    search itself has a full budget from when it starts, so one the caller
+    abandoned still finishes and fills the cache for the next request.
+    Returns (route_nodes, distance_m, branch), branch being one of
+    "weighted", "euclidean", "timeout" or "error"
+    (the last three use the euclidean distance)
+    Latency goes to the "route" histogram and the branch to a counter.
+    """
+    start = time.perf_counter()
+    route_nodes, distance_m, branch = _route_with_fallback(
+        G, pickup_node, dropoff_node, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, deadline, with_path
+    )
+    metrics.observe("route", time.perf_counter() - start)
+    metrics.count(f"route_branch_{branch}")
+    record_branch(branch)
+    return route_nodes, distance_m, branch
+
+def _route_summary(route):
+    """Cached form of a search_route result"""
+    return None if route is None else (route[1], route[2])
+
+def _search_and_cache(G, key, pickup_node, dropoff_node, deadline, with_path):
+    """Search a pair missing from the route (path) cache and cache its result"""
+    if not with_path:
+        summary = route_cache.fill(key, lambda: _route_summary(search_route(G, pickup_node, dropoff_node, deadline)))
+        return None if summary is None else (None,) + tuple(summary)
+
+    def search():
+        route = search_route(G, pickup_node, dropoff_node, deadline)
+        route_cache.put(key, _route_summary(route))
+        return None if route is None else (np.asarray(route[0], dtype=np.int64),) + tuple(route[1:])
+    return route_path_cache.fill(key, search)
+
+def _route_with_fallback(G, pickup_node, dropoff_node, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, deadline,
+                         with_path=True):
+    """Body of calculate_route_detailed"""
+    # Keyed on the graph version too, so routes of a replaced graph are never served
+    key = (getattr(G, "version", None), int(pickup_node), int(dropoff_node))
+    try:
+        # Looked up in the request thread: a cached pair never waits on the pool or the deadline
+        if with_path:
+            route = route_path_cache.get(key, _UNCACHED)
+        else:
+            summary = route_cache.get(key, _UNCACHED)
+            route = summary if summary is None or summary is _UNCACHED else (None,) + tuple(summary)
+        if route is _UNCACHED:
+            if deadline is not None and routing_pool is not None:
+                # The search's own deadline starts when a pool thread picks it up
+                route = routing_pool.run(
+                    lambda: _search_and_cache(G, key, pickup_node, dropoff_node, routing_pool.deadline(), with_path),
+                    deadline)
+            else:
+                route = _search_and_cache(G, key, pickup_node, dropoff_node, deadline, with_path)
+        if route is not None:
+            route_nodes, distance_m, branch = route
+            return (route_nodes.tolist() if route_nodes is not None else None), distance_m, branch
+        log_event(logger, logging.WARNING, "route_fallback", branch="euclidean",
+                  pickup_node=pickup_node, dropoff_node=dropoff_node)
+        branch = "euclidean"
+    
+    except RoutingTimeout as e:
+        log_event(logger, logging.WARNING, "route_fallback", branch="timeout", reason=str(e),
+                  pickup_node=pickup_node, dropoff_node=dropoff_node)
+        branch = "timeout"
     
     except Exception as e:
         logger.error(f"Error calculating route: {e}")
-        # Final fallback: euclidean distance
-        distance_km = euclidean_distance_km(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
-        distance_m = distance_km * 1000
-        route_nodes = [pickup_node, dropoff_node]
+        branch = "error"
     
+    # Final fallback: use straight-line distance
+    distance_km = euclidean_distance_km(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+    distance_m = distance_km * 1000
+    route_nodes = [pickup_node, dropoff_node]  # Simple direct connection
+    return route_nodes, distance_m, branch
+
+def calculate_route_with_fallback(G, pickup_node, dropoff_node, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+    """
+    Calculate route with multiple fallback strategies (see calculate_route_detailed)
+    """
+    route_nodes, distance_m, _ = calculate_route_detailed(
+        G, pickup_node, dropoff_node, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon
+    )
     return route_nodes, distance_m
 
+def route_nodes_to_coords(G, route_nodes, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+    """
+    Convert a list of route nodes to (lat, lon) tuples for the map,
+    falling back to a straight line when no route is available
+    """
+    if route_nodes and len(route_nodes) > 0:
+        try:
+            return [(G.nodes[n]['y'], G.nodes[n]['x']) for n in route_nodes
+                    if n in G.nodes and 'y' in G.nodes[n] and 'x' in G.nodes[n]]
+        except Exception as e:
+            logger.warning(f"Error converting route to coordinates: {e}")
+    # No route found, use straight line
+    return [(pickup_lat, pickup_lon), (dropoff_lat, dropoff_lon)]
+
+def route_trip(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, dt_str, G, deadline=None, with_coords=True,
+               branches=None):
+    """
+    Shared part of feature preparation: parse the datetime, snap and route.
+    If `branches` is a list, the route branch is appended to it.
+    Returns (datetime, distance_km, route_coords)
+    """
+    # Parse datetime
+    try:
+        dt = parse_trip_datetime(dt_str)
+    except Exception as e:
+        logger.error(f"Error parsing datetime '{dt_str}': {e}")
+        raise ValueError(f"Invalid datetime format: {dt_str}")
+    
+    distance_km, route_coords, branch = route_between(
+        pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, G, deadline, with_coords
+    )
+    if branches is not None:
+        branches.append(branch)
+    return dt, distance_km, route_coords
+
+def route_between(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, G, deadline=None, with_coords=True):
+    """
+    Snap and route one trip. Route coordinates for the map are only built
+    when `with_coords` is set (None otherwise).
+    Returns (distance_km, route_coords, route branch)
+    """
+    # Validate graph
+    if G is None or len(G.nodes) == 0:
+        raise ValueError("Invalid or empty graph provided")
+    
+    # Validate coordinates
+    if not all([validate_coordinates(pickup_lat, pickup_lon),
+               validate_coordinates(dropoff_lat, dropoff_lon)]):
+        raise ValueError("Invalid coordinate values")
+    
+    # Check if pickup and dropoff are the same
+    if abs(pickup_lat - dropoff_lat) < 0.0001 and abs(pickup_lon - dropoff_lon) < 0.0001:
+        log_event(logger, logging.INFO, "close_pickup", pickup=(pickup_lat, pickup_lon))
+        metrics.count("route_branch_minimal")
+        record_branch("minimal")
+        # Minimal trip
+        return 0.1, [(pickup_lat, pickup_lon), (dropoff_lat, dropoff_lon)], "minimal"
+    
+    # Find nearest nodes
+    pickup_node, dropoff_node = find_nearest_nodes_safe(
+        G, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat
+    )
+    
+    # Calculate route
+    route_nodes, distance_m, branch = calculate_route_detailed(
+        G, pickup_node, dropoff_node, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, deadline,
+        with_path=with_coords
+    )
+    
+    # Convert distance to kilometers
+    distance_km = distance_m / 1000 if distance_m else 0.0
+    
+    # Ensure minimum distance for very short trips
+    if distance_km < 0.1:
+        distance_km = max(0.1, euclidean_distance_km(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon))
+    
+    # Convert route nodes to coordinates for visualization
+    route_coords = route_nodes_to_coords(
+        G, route_nodes, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon
+    ) if with_coords else None
+    return distance_km, route_coords, branch
+
 def prepare_input_from_string(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, 
                             dt_str, G, passenger_count=1):
     """
@@ -106,106 +301,254 @@ def prepare_input_from_string(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon,
     EXACTLY matching the original model's expected features
     """
     try:
-        # Parse datetime
-        try:
-            dt = parser.parse(dt_str)
-        except Exception as e:
-            logger.error(f"Error parsing datetime '{dt_str}': {e}")
-            raise ValueError(f"Invalid datetime format: {dt_str}")
-        
-        # Validate graph
-        if G is None or len(G.nodes) == 0:
-            raise ValueError("Invalid or empty graph provided")
-        
-        # Validate coordinates
-        if not all([validate_coordinates(pickup_lat, pickup_lon),
-                   validate_coordinates(dropoff_lat, dropoff_lon)]):
-            raise ValueError("Invalid coordinate values")
-        
-        # Check if pickup and dropoff are the same
-        if abs(pickup_lat - dropoff_lat) < 0.0001 and abs(pickup_lon - dropoff_lon) < 0.0001:
-            logger.warning("Pickup and dropoff locations are very close")
-            # Return minimal trip with exact original features
-            df = pd.DataFrame({
-                'passenger_count': [max(1, min(6, passenger_count))],
-                'distance_km': [0.1],  # Minimum distance
-                'hour': [dt.hour],
-                'is_weekend': [int(dt.weekday() in [5, 6])],
-            })
-            
-            # Add month one-hot encoding (exactly 12 features)
-            for m in range(1, 13):
-                df[f'month_{m}'] = int(m == dt.month)
-            
-            # Add day of week one-hot encoding (exactly 7 features)
-            for d in range(7):
-                df[f'dow_{d}'] = int(d == dt.weekday())
-            
-            route_coords = [(pickup_lat, pickup_lon), (dropoff_lat, dropoff_lon)]
-            return df, route_coords
-        
-        # Find nearest nodes
-        pickup_node, dropoff_node = find_nearest_nodes_safe(
-            G, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat
+        dt, distance_km, route_coords = route_trip(
+            pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, dt_str, G
         )
-        
-        # Calculate route
-        route_nodes, distance_m = calculate_route_with_fallback(
-            G, pickup_node, dropoff_node, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon
-        )
-        
-        # Convert distance to kilometers
-        distance_km = distance_m / 1000 if distance_m else 0.0
-        
-        # Ensure minimum distance for very short trips
-        if distance_km < 0.1:
-            distance_km = max(0.1, euclidean_distance_km(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon))
-        
-        # Convert route nodes to coordinates for visualization
-        route_coords = []
-        if route_nodes and len(route_nodes) > 0:
-            try:
-                route_coords = [(G.nodes[n]['y'], G.nodes[n]['x']) for n in route_nodes 
-                              if n in G.nodes and 'y' in G.nodes[n] and 'x' in G.nodes[n]]
-            except Exception as e:
-                logger.warning(f"Error converting route to coordinates: {e}")
-                # Fallback to straight line
-                route_coords = [(pickup_lat, pickup_lon), (dropoff_lat, dropoff_lon)]
-        else:
-            # No route found, use straight line
-            route_coords = [(pickup_lat, pickup_lon), (dropoff_lat, dropoff_lon)]
-        
         # Create feature dataframe with EXACT original features only
-        df = pd.DataFrame({
-            'passenger_count': [max(1, min(6, passenger_count))],  # Clamp between 1-6
-            'distance_km': [max(0, distance_km)],  # Ensure non-negative
-            'hour': [dt.hour],
-            'is_weekend': [int(dt.weekday() in [5, 6])],
-        })
-        
-        # One-hot encode months (1-12) - exactly as in original
-        for m in range(1, 13):
-            df[f'month_{m}'] = int(m == dt.month)
-        
-        # One-hot encode days of week (0-6) - exactly as in original
-        for d in range(7):
-            df[f'dow_{d}'] = int(d == dt.weekday())
-        
-        # Verify feature count (should be exactly 23 features)
-        expected_features = ['passenger_count', 'distance_km', 'hour', 'is_weekend'] + \
-                          [f'month_{m}' for m in range(1, 13)] + \
-                          [f'dow_{d}' for d in range(7)]
-        
-        logger.info(f"Created feature dataframe with shape: {df.shape}")
-        logger.info(f"Feature columns: {list(df.columns)}")
-        logger.info(f"Expected features: {len(expected_features)}, Actual features: {len(df.columns)}")
-        
-        if len(df.columns) != 23:
-            logger.error(f"Feature count mismatch! Expected 23, got {len(df.columns)}")
-            logger.error(f"Missing or extra features: {set(expected_features) - set(df.columns)} | {set(df.columns) - set(expected_features)}")
-        
+        df = build_feature_matrix([passenger_count], [distance_km], [dt])
         return df, route_coords
     
     except Exception as e:
         logger.error(f"Error in prepare_input_from_string: {e}")
-        raise
\ No newline at end of file
+        raise
+
+def prepare_features_from_string(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon,
+                                 dt_str, G, passenger_count=1, deadline=None, with_coords=True, branches=None):
+    """
+    Same as prepare_input_from_string, but the features are written into
+    this thread's preallocated (1, 23) float32 row instead of a DataFrame.
+    The row is reused by the next call on the same thread.
+    If `branches` is a list, the route branch is appended to it.
+    Returns (feature row, route_coords); route_coords is None without `with_coords`
+    """
+    try:
+        dt, distance_km, route_coords = route_trip(
+            pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, dt_str, G, deadline, with_coords, branches
+        )
+        with metrics.timer("features"):
+            row = encode_trip(passenger_count, distance_km, dt)
+        return row, route_coords
+    
+    except Exception as e:
+        logger.error(f"Error in prepare_features_from_string: {e}")
+        raise
+
+def build_feature_matrix(passenger_counts, distances_km, datetimes):
+    """
+    Build the 23-column feature DataFrame for many trips at once.
+    Columns and dtypes match prepare_input_from_string row for row.
+    """
+    n = len(datetimes)
+    months = np.fromiter((dt.month for dt in datetimes), dtype=np.int64, count=n)
+    weekdays = np.fromiter((dt.weekday() for dt in datetimes), dtype=np.int64, count=n)
+    hours = np.fromiter((dt.hour for dt in datetimes), dtype=np.int64, count=n)
+
+    columns = {
+        'passenger_count': np.clip(np.asarray(passenger_counts, dtype=np.int64), 1, 6),
+        'distance_km': np.maximum(np.asarray(distances_km, dtype=np.float64), 0),
+        'hour': hours,
+        'is_weekend': (weekdays >= 5).astype(np.int64),
+    }
+    for m in range(1, 13):
+        columns[f'month_{m}'] = (months == m).astype(np.int64)
+    for d in range(7):
+        columns[f'dow_{d}'] = (weekdays == d).astype(np.int64)
+
+    return pd.DataFrame(columns, columns=FEATURE_COLUMNS)
+
+def _batch_arrays(trips):
+    """Parsed datetimes and validated coordinate arrays of a batch of trips"""
+    datetimes = []
+    for trip in trips:
+        try:
+            datetimes.append(parse_trip_datetime(trip['datetime_str']))
+        except Exception as e:
+            logger.error(f"Error parsing datetime '{trip['datetime_str']}': {e}")
+            raise ValueError(f"Invalid datetime format: {trip['datetime_str']}")
+
+    pickup_lat = np.array([t['pickup_lat'] for t in trips], dtype=np.float64)
+    pickup_lon = np.array([t['pickup_lon'] for t in trips], dtype=np.float64)
+    dropoff_lat = np.array([t['dropoff_lat'] for t in trips], dtype=np.float64)
+    dropoff_lon = np.array([t['dropoff_lon'] for t in trips], dtype=np.float64)
+
+    if not all(validate_coordinates(lat, lon) for lat, lon in
+               zip(np.concatenate([pickup_lat, dropoff_lat]),
+                   np.concatenate([pickup_lon, dropoff_lon]))):
+        raise ValueError("Invalid coordinate values")
+    return datetimes, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon
+
+def prepare_inputs_batch(trips, G, deadline=None, branches=None, with_coords=True):
+    """
+    Batch version of prepare_input_from_string.
+
+    `trips` is a list of dicts with pickup_lat, pickup_lon, dropoff_lat,
+    dropoff_lon, datetime_str and passenger_count. All points are snapped
+    in a single nearest-node query and the features of every trip are
+    written into this thread's preallocated float32 matrix, so the model
+    can be called once per batch (the matrix is reused by the next call).
+    The batch waits for its searches until one shared `deadline` (cached
+    pairs are answered regardless, and abandoned searches still fill the
+    cache); if `branches` is a list, the route branch of each trip is
+    appended to it.
+    Returns (feature matrix, list of route coordinates per trip); without
+    `with_coords` no node paths are built and the list is None.
+    """
+    if G is None or len(G.nodes) == 0:
+        raise ValueError("Invalid or empty graph provided")
+
+    n = len(trips)
+    datetimes, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon = _batch_arrays(trips)
+
+    # Pickup and dropoff practically identical -> minimal trip, no routing
+    close = (np.abs(pickup_lat - dropoff_lat) < 0.0001) & (np.abs(pickup_lon - dropoff_lon) < 0.0001)
+    routed = np.flatnonzero(~close)
+
+    # Snap every pickup and dropoff of the batch in one query
+    snapped = {}
+    if len(routed) > 0:
+        X = np.concatenate([pickup_lon[routed], dropoff_lon[routed]])
+        Y = np.concatenate([pickup_lat[routed], dropoff_lat[routed]])
+        with metrics.timer("snap_batch"):
+            nodes = get_node_index(G).nearest_nodes(X, Y).tolist()
+        k = len(routed)
+        for j, i in enumerate(routed):
+            snapped[i] = (nodes[j], nodes[k + j])
+
+    distances_km = np.full(n, 0.1)
+    route_coords = [] if with_coords else None
+    for i in range(n):
+        p_lat, p_lon, d_lat, d_lon = pickup_lat[i], pickup_lon[i], dropoff_lat[i], dropoff_lon[i]
+        if i not in snapped:
+            if with_coords:
+                route_coords.append([(p_lat, p_lon), (d_lat, d_lon)])
+            metrics.count("route_branch_minimal")
+            record_branch("minimal")
+            if branches is not None:
+                branches.append("minimal")
+            continue
+
+        pickup_node, dropoff_node = snapped[i]
+        route_nodes, distance_m, branch = calculate_route_detailed(
+            G, pickup_node, dropoff_node, p_lat, p_lon, d_lat, d_lon, deadline, with_path=with_coords
+        )
+        if branches is not None:
+            branches.append(branch)
+        distance_km = distance_m / 1000 if distance_m else 0.0
+        if distance_km < 0.1:
+            distance_km = max(0.1, euclidean_distance_km(p_lat, p_lon, d_lat, d_lon))
+        distances_km[i] = distance_km
+        if with_coords:
+            route_coords.append(route_nodes_to_coords(G, route_nodes, p_lat, p_lon, d_lat, d_lon))
+
+    with metrics.timer("features_batch"):
+        X = encode_matrix(matrix_buffer(n), [t['passenger_count'] for t in trips], distances_km, datetimes)
+    log_event(logger, logging.INFO, "batch_prepared", trips=n, routed=len(routed))
+    return X, route_coords
+
+def prepare_inputs_preview(trips, zones):
+    """
+    Approximate version of prepare_inputs_batch for price previews:
+    distance_km is read from the zone-to-zone matrix (see zone_matrix.py)
+    plus the snap offsets, without touching the road graph.
+    Returns the feature matrix (reused by the next call on this thread).
+    """
+    n = len(trips)
+    datetimes, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon = _batch_arrays(trips)
+
+    distances_km = zones.estimate_km(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+    # Zones not connected by road: same straight-line fallback as exact routing
+    for i in np.flatnonzero(np.isnan(distances_km)):
+        distances_km[i] = euclidean_distance_km(pickup_lat[i], pickup_lon[i], dropoff_lat[i], dropoff_lon[i])
+
+    close = (np.abs(pickup_lat - dropoff_lat) < 0.0001) & (np.abs(pickup_lon - dropoff_lon) < 0.0001)
+    distances_km = np.where(close, 0.1, np.maximum(distances_km, 0.1))
+
+    return encode_matrix(matrix_buffer(n), [t['passenger_count'] for t in trips], distances_km, datetimes)
+
+def one_to_many_lengths(G, pickup_node, dropoff_nodes, cutoff_m=None, deadline=None):
+    """
+    Road distance (meters) from one pickup node to many dropoff nodes with a
+    single Dijkstra search, bounded by `cutoff_m`. inf where not reached.
+    """
+    if isinstance(G, (GraphSnapshot, TiledGraph)):
+        return G.shortest_path_lengths(pickup_node, dropoff_nodes, cutoff=cutoff_m, deadline=deadline)
+    reached = nx.single_source_dijkstra_path_length(G, pickup_node, cutoff=cutoff_m, weight='length')
+    return np.array([reached.get(node, np.inf) for node in dropoff_nodes], dtype=np.float64)
+
+def prepare_inputs_one_to_many(pickup_lat, pickup_lon, dropoffs, dt_str, G, passenger_count=1,
+                               max_distance_km=None, deadline=None):
+    """
+    Features of many trips sharing one pickup, for "what does it cost from
+    here" quotes. `dropoffs` is a list of (lat, lon). The pickup and every
+    dropoff are snapped in one query; dropoffs the connectivity rules out
+    get branch "unreachable" and are left out of the search, so they never
+    make it cover the whole graph. A single shortest-path tree from the
+    pickup node (bounded by `max_distance_km`) gives the other road
+    distances. Dropoffs it does not reach are "cutoff" when a bound was
+    given (they may just be farther), "unreachable" otherwise; both use the
+    straight-line distance, as in calculate_route_detailed.
+    Returns (feature matrix, route branch per dropoff); the matrix is
+    reused by the next call on this thread.
+    """
+    if G is None or len(G.nodes) == 0:
+        raise ValueError("Invalid or empty graph provided")
+    try:
+        dt = parse_trip_datetime(dt_str)
+    except Exception as e:
+        logger.error(f"Error parsing datetime '{dt_str}': {e}")
+        raise ValueError(f"Invalid datetime format: {dt_str}")
+
+    n = len(dropoffs)
+    dropoff_lat = np.array([d[0] for d in dropoffs], dtype=np.float64)
+    dropoff_lon = np.array([d[1] for d in dropoffs], dtype=np.float64)
+    if not validate_coordinates(pickup_lat, pickup_lon) or not all(
+            validate_coordinates(lat, lon) for lat, lon in zip(dropoff_lat, dropoff_lon)):
+        raise ValueError("Invalid coordinate values")
+
+    with metrics.timer("snap_batch"):
+        nodes = get_node_index(G).nearest_nodes(
+            np.concatenate([[pickup_lon], dropoff_lon]), np.concatenate([[pickup_lat], dropoff_lat])
+        ).tolist()
+    pickup_node, dropoff_nodes = nodes[0], nodes[1:]
+
+    branches = ["weighted"] * n
+    cutoff_m = max_distance_km * 1000 if max_distance_km else None
+    unreachable = get_connectivity(G).unreachable_from(pickup_node, dropoff_nodes)
+    searched = np.flatnonzero(~unreachable)
+    lengths_m = np.full(n, np.inf)
+    if unreachable.any():
+        metrics.count("route_unreachable_precheck", int(unreachable.sum()))
+    try:
+        if len(searched):
+            with metrics.timer("route_one_to_many"):
+                lengths_m[searched] = one_to_many_lengths(
+                    G, pickup_node, [dropoff_nodes[i] for i in searched], cutoff_m, deadline)
+    except RoutingTimeout as e:
+        log_event(logger, logging.WARNING, "route_fallback", branch="timeout", reason=str(e),
+                  pickup_node=pickup_node, dropoffs=n)
+        for i in searched:
+            branches[i] = "timeout"
+
+    distances_km = lengths_m / 1000
+    for i in np.flatnonzero(~np.isfinite(lengths_m)):
+        if branches[i] == "weighted":
+            branches[i] = "cutoff" if cutoff_m and not unreachable[i] else "unreachable"
+        distances_km[i] = euclidean_distance_km(pickup_lat, pickup_lon, dropoff_lat[i], dropoff_lon[i])
+
+    # Same minimum-distance rules as route_trip
+    short = distances_km < 0.1
+    for i in np.flatnonzero(short):
+        distances_km[i] = max(0.1, euclidean_distance_km(pickup_lat, pickup_lon, dropoff_lat[i], dropoff_lon[i]))
+    close = (np.abs(pickup_lat - dropoff_lat) < 0.0001) & (np.abs(pickup_lon - dropoff_lon) < 0.0001)
+    distances_km[close] = 0.1
+    for i in np.flatnonzero(close):
+        branches[i] = "minimal"
+    for branch in set(branches):
+        metrics.count(f"route_branch_{branch}", branches.count(branch))
+        record_branch(branch, branches.count(branch))
+
+    with metrics.timer("features_batch"):
+        X = encode_matrix(matrix_buffer(n), np.full(n, passenger_count), distances_km, [dt] * n)
+    log_event(logger, logging.INFO, "one_to_many_prepared", pickup_node=pickup_node, dropoffs=n,
+              reached=int(np.isfinite(lengths_m).sum()))
+    return X, branches
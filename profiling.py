@@ -0,0 +1,170 @@
+import cProfile
+import itertools
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Fraction of requests profiled at random (PROFILE_SAMPLE_RATE, default off)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+
+# A request sent with the header "X-Profile: <PROFILE_TOKEN>" is always profiled (unset = off)
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN") or None
+
+# Where profiles are written: <id>.prof (cProfile), <id>.collapsed (stacks), <id>.json (tags + timings)
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+# Stack sampling period (ms) for the collapsed stacks
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 1))
+
+# Functions listed in the JSON summary
+TOP_FUNCTIONS = 25
+
+_active = threading.local()
+# One profile at a time per process, so sampling never stacks up overhead
+_busy = threading.Lock()
+_sequence = itertools.count(1)
+
+def start_profile(name, headers=None):
+    """
+    Start profiling the current thread if this request is selected (its
+    X-Profile header matches PROFILE_TOKEN, or it falls in the
+    PROFILE_SAMPLE_RATE sample). Returns the RequestProfile, or None.
+    Costs one comparison when profiling is off.
+    """
+    if not PROFILE_SAMPLE_RATE and PROFILE_TOKEN is None:
+        return None
+    forced = PROFILE_TOKEN is not None and headers is not None and headers.get("X-Profile") == PROFILE_TOKEN
+    if not forced and not (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+        return None
+    if not _busy.acquire(blocking=False):
+        return None
+    profile = RequestProfile(name, "requested" if forced else "sampled")
+    _active.profile = profile
+    profile.start()
+    return profile
+
+def tag(**fields):
+    """Attach fields (trip inputs, ...) to the current thread's profile, if any"""
+    profile = getattr(_active, "profile", None)
+    if profile is not None:
+        profile.tags.update(fields)
+
+def record_branch(branch, n=1):
+    """Count a route branch (weighted, euclidean, timeout, ...) in the current thread's profile, if any"""
+    profile = getattr(_active, "profile", None)
+    if profile is not None:
+        profile.branches[branch] += n
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """Samples one thread's Python stack every `interval_s` into collapsed-stack counts"""
+
+    def __init__(self, thread_id, interval_s):
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+class RequestProfile:
+    """
+    cProfile (exact per-function timings) plus a stack sampler (collapsed
+    stacks for flamegraph.pl / speedscope) over one request. Graph
+    searches that run in the routing pool show up as the wait in
+    RoutingPool.run.
+    """
+
+    def __init__(self, name, reason):
+        self.name = name
+        self.reason = reason
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{os.getpid()}-{next(_sequence)}"
+        self.tags = {}
+        self.branches = Counter()
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+        self.finished = False
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.sampler.start()
+        self.profiler.enable()
+
+    def finish(self, status=None):
+        """Stop profiling and write the profile files (once); never raises"""
+        if self.finished:
+            return
+        self.finished = True
+        try:
+            self.profiler.disable()
+            self.sampler.stop()
+            self.duration_s = time.perf_counter() - self.started
+            self._write(status)
+        except Exception as e:
+            logger.error(f"Could not write profile {self.id}: {e}")
+        finally:
+            _active.profile = None
+            _busy.release()
+
+    def _root_frame(self):
+        branches = ",".join(sorted(self.branches)) or "none"
+        return f"{self.name} [branch={branches}]"
+
+    def _write(self, status):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.id)
+        self.profiler.dump_stats(f"{base}.prof")
+
+        root = self._root_frame()
+        with open(f"{base}.collapsed", "w") as f:
+            for stack, count in self.sampler.stacks.most_common():
+                f.write(f"{root};{stack} {count}\n")
+
+        stats = pstats.Stats(self.profiler)
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+        summary = {
+            "id": self.id,
+            "endpoint": self.name,
+            "reason": self.reason,
+            "status": status,
+            "duration_ms": round(self.duration_s * 1000, 3),
+            "branches": dict(self.branches),
+            "tags": self.tags,
+            "samples": sum(self.sampler.stacks.values()),
+            "top_functions": [{
+                "function": f"{func} ({os.path.basename(filename)}:{line})",
+                "calls": calls,
+                "tottime_ms": round(tottime * 1000, 3),
+                "cumtime_ms": round(cumtime * 1000, 3),
+            } for (filename, line, func), (_, calls, tottime, cumtime, _) in functions],
+        }
+        with open(f"{base}.json", "w") as f:
+            json.dump(summary, f, indent=2, default=str)
+        logger.info(f"Profile {self.id} written to {PROFILE_DIR} ({summary['duration_ms']} ms)")
@@ -0,0 +1,284 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Writes to the shared store are queued and committed in batches this often (seconds)
+STORE_FLUSH_INTERVAL_S = 0.05
+
+class SQLiteStore:
+    """
+    Small key/value store in a local SQLite file, shared by every worker
+    process on the host. Keys and values must be JSON serializable.
+    Writes are queued and committed by a background thread, so requests
+    never wait on a commit.
+    """
+
+    def __init__(self, path, namespace):
+        self.path = path
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._pending = {}  # encoded key -> (encoded value, expires), not yet committed
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._writer_pid = None
+
+    def _connection(self):
+        """Open the connection lazily, and again after a fork"""
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT, key TEXT, value TEXT, expires REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        encoded = json.dumps(key)
+        with self._pending_lock:
+            row = self._pending.get(encoded)
+        if row is None:
+            with self._lock:
+                row = self._connection().execute(
+                    "SELECT value, expires FROM cache WHERE namespace = ? AND key = ?",
+                    (self.namespace, encoded),
+                ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return _MISSING
+        return json.loads(row[0])
+
+    def put(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._pending_lock:
+            self._pending[json.dumps(key)] = (json.dumps(value), expires)
+            if self._writer_pid != os.getpid():
+                # First write in this process (threads do not survive a fork)
+                self._writer_pid = os.getpid()
+                threading.Thread(target=self._write_loop, name=f"cache-writer-{self.namespace}",
+                                 daemon=True).start()
+        self._wakeup.set()
+
+    def _write_loop(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(STORE_FLUSH_INTERVAL_S)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"{self.namespace} cache: could not write to shared store: {e}")
+
+    def flush(self):
+        """Commit the queued writes in one transaction"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                [(self.namespace, key, value, expires) for key, (value, expires) in pending.items()],
+            )
+            conn.commit()
+
+    def clear(self):
+        with self._pending_lock:
+            self._pending.clear()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+            conn.commit()
+
+class _Pending:
+    """A computation other threads with the same key are waiting on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class LRUCache:
+    """
+    Thread-safe bounded LRU cache with optional TTL and an optional shared
+    SQLiteStore behind it. `get_or_compute` coalesces concurrent misses on
+    the same key into a single computation.
+    """
+
+    def __init__(self, name, maxsize=10000, ttl=None, store=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = store
+        self._data = OrderedDict()  # key -> (value, expires)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.store_hits = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _lookup(self, key):
+        """Local lookup, caller must hold the lock"""
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        value, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def _insert(self, key, value):
+        """Local insert, caller must hold the lock"""
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+        if self.store is not None:
+            value = self.store.get(key)
+            if value is not _MISSING:
+                with self._lock:
+                    self.hits += 1
+                    self.store_hits += 1
+                    self._insert(key, value)
+                return value
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._insert(key, value)
+        if self.store is not None:
+            try:
+                self.store.put(key, value, self.ttl)
+            except Exception as e:
+                logger.warning(f"{self.name} cache: could not write to shared store: {e}")
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached value for `key`, or compute and cache it.
+        Concurrent callers missing on the same key wait for the first one.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        return self.fill(key, compute)
+
+    def fill(self, key, compute):
+        """
+        Compute and cache the value of a key that just missed (without
+        counting another lookup). Concurrent callers on the same key wait
+        for the first one.
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                return value
+            pending = self._inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._inflight[key] = _Pending()
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            value = compute()
+            self.put(key, value)
+            pending.value = value
+            return value
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            pending.event.set()
+
+    def values(self):
+        """Locally cached values (no TTL check, no LRU update)"""
+        with self._lock:
+            return [value for value, _ in self._data.values()]
+
+    def purge(self, predicate):
+        """Drop the local entries whose key matches (e.g. of a replaced version); returns how many"""
+        with self._lock:
+            stale = [key for key in self._data if predicate(key)]
+            for key in stale:
+                del self._data[key]
+        return len(stale)
+
+    def clear(self, shared=True):
+        """Drop every entry; with `shared=False` the shared store (other workers' entries) is kept"""
+        with self._lock:
+            self._data.clear()
+        if shared and self.store is not None:
+            self.store.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "store_hits": self.store_hits,
+                "coalesced": self.coalesced,
+            }
+
+def cache_from_env(name, default_size, schema=1, shared=True):
+    """
+    Build an LRUCache configured from the environment:
+    {NAME}_CACHE_SIZE, {NAME}_CACHE_TTL (seconds, 0 = no expiry) and
+    FARE_CACHE_DB, an optional SQLite file shared by all local workers.
+    Bump `schema` when the cached values change shape, so entries written
+    by older code in the shared file are not read back. Caches that are
+    not `shared` stay in-process (values need not be JSON serializable).
+    """
+    prefix = name.upper()
+    maxsize = int(os.environ.get(f"{prefix}_CACHE_SIZE", default_size))
+    ttl = float(os.environ.get(f"{prefix}_CACHE_TTL", 0)) or None
+    db_path = os.environ.get("FARE_CACHE_DB") if shared else None
+    store = SQLiteStore(db_path, name if schema == 1 else f"{name}/{schema}") if db_path else None
+    return LRUCache(name, maxsize=maxsize, ttl=ttl, store=store)
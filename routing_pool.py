@@ -0,0 +1,93 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+class RoutingTimeout(Exception):
+    """The request's routing budget ran out before a route was found"""
+
+class RoutingPool:
+    """
+    Bounded thread pool that runs graph searches against a deadline.
+
+    At most `max_workers` searches run at once and at most `max_queue`
+    more wait for a slot; a caller that cannot get a slot or a result
+    before its deadline gets RoutingTimeout and falls back to an
+    estimate. The search itself is not cancelled: snapshot searches check
+    a deadline of their own and stop, a search that cannot (networkx,
+    contraction hierarchy) keeps its slot until it finishes, so slow pairs
+    never pile up more work than the pool allows.
+    """
+
+    def __init__(self, max_workers=4, budget_s=None, max_queue=None):
+        self.max_workers = max_workers
+        self.budget_s = budget_s
+        self.max_queue = max_workers * 4 if max_queue is None else max_queue
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def _pool(self):
+        """Start the threads lazily, and again after a fork (threads do not survive it)"""
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="routing")
+                self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+                self._pid = os.getpid()
+            return self._executor
+
+    def deadline(self):
+        """Deadline (time.monotonic) of a request starting now, or None without a budget"""
+        return time.monotonic() + self.budget_s if self.budget_s else None
+
+    def run(self, fn, deadline):
+        """Result of fn(), or RoutingTimeout if it is not available by `deadline`"""
+        executor = self._pool()
+        slots = self._slots
+        if not slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            with self._lock:
+                self.rejected += 1
+            raise RoutingTimeout("routing pool saturated")
+        try:
+            future = executor.submit(fn)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        with self._lock:
+            self.submitted += 1
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except (FutureTimeoutError, RoutingTimeout):
+            with self._lock:
+                self.timeouts += 1
+            raise RoutingTimeout("routing budget exhausted")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "budget_ms": round(self.budget_s * 1000) if self.budget_s else None,
+                "submitted": self.submitted,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+            }
+
+def pool_from_env():
+    """
+    RoutingPool configured from the environment: ROUTING_WORKERS threads
+    per process and ROUTING_BUDGET_MS per request. Without a budget
+    (the default) routes are computed inline and no pool is used.
+    """
+    budget_ms = float(os.environ.get("ROUTING_BUDGET_MS", 0))
+    if budget_ms <= 0:
+        return None
+    workers = int(os.environ.get("ROUTING_WORKERS", 4))
+    return RoutingPool(max_workers=workers, budget_s=budget_ms / 1000)
@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from graph_snapshot import NYC_BBOX
+
+def synthetic_trips(num_trips, seed=0, bbox=NYC_BBOX):
+    """
+    Reproducible random trips (form fields) with both ends inside the
+    validate_nyc_bounds box, dates within 2024 and every hour / passenger count.
+    """
+    north, south, east, west = bbox
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(south, north, size=(2, num_trips))
+    lon = rng.uniform(west, east, size=(2, num_trips))
+    days = rng.integers(0, 366, num_trips)
+    hours = rng.integers(0, 24, num_trips)
+    passengers = rng.integers(1, 7, num_trips)
+    return [{
+        "pickup_lat": f"{lat[0, i]:.6f}",
+        "pickup_lon": f"{lon[0, i]:.6f}",
+        "dropoff_lat": f"{lat[1, i]:.6f}",
+        "dropoff_lon": f"{lon[1, i]:.6f}",
+        "date": (datetime(2024, 1, 1) + timedelta(days=int(days[i]))).strftime("%Y-%m-%d"),
+        "hour": str(hours[i]),
+        "passenger_count": str(passengers[i]),
+    } for i in range(num_trips)]
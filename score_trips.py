@@ -0,0 +1,334 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from features import NUM_FEATURES, encode_row, finalize_fares, parse_trip_datetime, predict_inplace
+from graph_snapshot import NYC_BBOX, graph_to_snapshot, load_graph_snapshot
+from prepare_input import calculate_route_detailed, euclidean_distance_km
+from spatial_index import get_node_index
+from connectivity import get_connectivity
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_COLUMNS = ["key", "distance_km", "predicted_fare", "route_branch", "error"]
+
+# Column names accepted for each trip field: Kaggle dataset first, then the app's form names
+COLUMN_ALIASES = {
+    "pickup_lat": ("pickup_latitude", "pickup_lat"),
+    "pickup_lon": ("pickup_longitude", "pickup_lon"),
+    "dropoff_lat": ("dropoff_latitude", "dropoff_lat"),
+    "dropoff_lon": ("dropoff_longitude", "dropoff_lon"),
+}
+
+# Road graph shared by the workers. Set in the parent before the pool is
+# forked, so every worker reads the same (memory-mapped / copy-on-write) arrays.
+_graph = None
+
+def load_scoring_graph(path, ch_dir=None):
+    """
+    Graph used for bulk scoring: a compiled snapshot directory (memory-mapped)
+    or a GraphML file converted to an in-memory snapshot. Plain arrays are
+    shared by forked workers, a networkx graph would be copied page by page.
+    """
+    if os.path.isdir(path):
+        G = load_graph_snapshot(path)
+        if ch_dir and os.path.exists(ch_dir):
+            from ch_router import load_ch_router
+            G.router = load_ch_router(ch_dir, G)
+    else:
+        import osmnx as ox
+        G = graph_to_snapshot(ox.load_graphml(path))
+    get_connectivity(G)
+    get_node_index(G)
+    return G
+
+def read_trip_chunks(path, chunk_size):
+    """Yield DataFrames of at most chunk_size rows from a CSV or Parquet file"""
+    if path.endswith(".parquet") or path.endswith(".pq"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Reading Parquet files requires pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size)
+
+def _pick_column(df, field):
+    for name in COLUMN_ALIASES[field]:
+        if name in df.columns:
+            return df[name]
+    raise ValueError(f"Input has no column for {field} (expected one of {', '.join(COLUMN_ALIASES[field])})")
+
+def normalize_chunk(df, first_row):
+    """
+    Plain arrays of one input chunk. Accepts the Kaggle columns
+    (pickup_latitude, ..., pickup_datetime) or the app's form fields
+    (pickup_lat, ..., date, hour). Rows are keyed by `key` if present,
+    otherwise by their row number in the input file.
+    """
+    chunk = {field: pd.to_numeric(_pick_column(df, field), errors="coerce").to_numpy(np.float64)
+             for field in COLUMN_ALIASES}
+    chunk["passenger_count"] = pd.to_numeric(df["passenger_count"], errors="coerce").to_numpy(np.float64)
+
+    if "pickup_datetime" in df.columns:
+        dt = df["pickup_datetime"].astype(str).str.replace(" UTC", "", regex=False)
+    elif "date" in df.columns and "hour" in df.columns:
+        hour = pd.to_numeric(df["hour"], errors="coerce")
+        # A missing or out-of-range hour gives no datetime (rejected per row), never midnight
+        valid_hour = hour.notna() & (hour >= 0) & (hour <= 23) & (hour == hour.round())
+        dt = (df["date"].astype(str).str.strip() + " "
+              + hour.where(valid_hour, 0).astype(int).map("{:02d}:00:00".format)).where(valid_hour, None)
+    else:
+        raise ValueError("Input needs pickup_datetime, or date and hour columns")
+    chunk["datetime_str"] = dt.tolist()
+
+    if "key" in df.columns:
+        chunk["key"] = df["key"].astype(str).to_numpy()
+    else:
+        chunk["key"] = np.arange(first_row, first_row + len(df))
+    return chunk
+
+def _trip_error(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon, passenger_count, datetime_str):
+    """Same checks as the web form, or None for a valid trip"""
+    north, south, east, west = NYC_BBOX
+    if not np.isfinite([pickup_lat, pickup_lon, dropoff_lat, dropoff_lon]).all():
+        return "Invalid coordinate values"
+    if not (south <= pickup_lat <= north and west <= pickup_lon <= east):
+        return "Pickup location must be within NYC boundaries"
+    if not (south <= dropoff_lat <= north and west <= dropoff_lon <= east):
+        return "Dropoff location must be within NYC boundaries"
+    if not (1 <= passenger_count <= 6):
+        return "Passenger count must be between 1 and 6"
+    if datetime_str is None:
+        return "Hour must be between 0 and 23"
+    return None
+
+def route_chunk(chunk, G=None):
+    """
+    Validate, snap and route every trip of a normalized chunk (runs in a
+    worker). All points of the chunk are snapped in one nearest-node query.
+    Returns (feature matrix, distances_km, route branches, errors); rows
+    with an error keep a zero feature row and are not scored.
+    """
+    G = _graph if G is None else G
+    n = len(chunk["key"])
+    plat, plon = chunk["pickup_lat"], chunk["pickup_lon"]
+    dlat, dlon = chunk["dropoff_lat"], chunk["dropoff_lon"]
+    passenger_counts = chunk["passenger_count"]
+
+    X = np.zeros((n, NUM_FEATURES), dtype=np.float32)
+    distances_km = np.full(n, np.nan)
+    branches = [""] * n
+    errors = [""] * n
+    datetimes = [None] * n
+
+    valid = []
+    for i in range(n):
+        error = _trip_error(plat[i], plon[i], dlat[i], dlon[i], passenger_counts[i], chunk["datetime_str"][i])
+        if error is None:
+            try:
+                datetimes[i] = parse_trip_datetime(chunk["datetime_str"][i])
+            except Exception:
+                error = f"Invalid datetime format: {chunk['datetime_str'][i]}"
+        if error is None:
+            valid.append(i)
+        else:
+            errors[i] = error
+
+    valid = np.array(valid, dtype=np.int64)
+    close = (np.abs(plat[valid] - dlat[valid]) < 0.0001) & (np.abs(plon[valid] - dlon[valid]) < 0.0001)
+    routed = valid[~close]
+    nodes = get_node_index(G).nearest_nodes(
+        np.concatenate([plon[routed], dlon[routed]]), np.concatenate([plat[routed], dlat[routed]])
+    ).tolist() if len(routed) else []
+
+    for i in valid[close]:
+        # Pickup and dropoff practically identical -> minimal trip, no routing
+        distances_km[i] = 0.1
+        branches[i] = "minimal"
+    for j, i in enumerate(routed):
+        try:
+            _, distance_m, branch = calculate_route_detailed(
+                G, nodes[j], nodes[len(routed) + j], plat[i], plon[i], dlat[i], dlon[i], with_path=False
+            )
+        except Exception as e:
+            errors[i] = f"Routing failed: {e}"
+            continue
+        distance_km = distance_m / 1000 if distance_m else 0.0
+        if distance_km < 0.1:
+            distance_km = max(0.1, euclidean_distance_km(plat[i], plon[i], dlat[i], dlon[i]))
+        distances_km[i] = distance_km
+        branches[i] = branch
+
+    for i in valid:
+        if not errors[i]:
+            encode_row(X[i], int(passenger_counts[i]), distances_km[i], datetimes[i])
+    return X, distances_km, branches, errors
+
+def load_predictor(model_path, table_dir=None):
+    """
+    Raw-prediction function for (n, 23) float32 matrices: the compiled fare
+    table when it matches the model, otherwise the booster in place.
+    """
+    if table_dir and os.path.exists(table_dir):
+        try:
+            from fare_table import load_fare_table
+            table = load_fare_table(table_dir, model_path=model_path)
+            return lambda X: table.predict(X).astype(np.float64), "fare_table"
+        except Exception as e:
+            logger.warning(f"Could not load fare lookup table: {e}")
+
+    import xgboost as xgb
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    return lambda X: predict_inplace(booster, X), "booster"
+
+def score_chunk(chunk, routed, predict):
+    """Output DataFrame of one chunk: predictions for valid rows, errors for the rest"""
+    X, distances_km, branches, errors = routed
+    ok = np.array([not e for e in errors], dtype=bool)
+    fares = np.full(len(errors), np.nan)
+    if ok.any():
+        fares[ok] = finalize_fares(predict(X[ok]))
+    return pd.DataFrame({
+        "key": chunk["key"],
+        "distance_km": np.round(distances_km, 3),
+        "predicted_fare": np.round(fares, 2),
+        "route_branch": branches,
+        "error": errors,
+    }, columns=OUTPUT_COLUMNS)
+
+class OutputWriter:
+    """Appends scored chunks to a CSV or Parquet file as they complete"""
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith(".parquet") or path.endswith(".pq")
+        self._writer = None
+        self._first = True
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode="w" if self._first else "a", header=self._first, index=False)
+        self._first = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+def _numbered(frames):
+    """(index of the first row, frame) for consecutive frames"""
+    first_row = 0
+    for df in frames:
+        yield first_row, df
+        first_row += len(df)
+
+def score_file(input_path, output_path, G, predict, workers=None, chunk_size=5000, max_inflight=None):
+    """
+    Score every trip of input_path into output_path. Chunks are routed by a
+    pool of forked workers sharing G, predicted in the parent (one model call
+    per chunk) and written in input order. At most max_inflight chunks are
+    read ahead, so memory stays bounded whatever the file size.
+    Returns a summary dict (trips, seconds, trips_per_sec, branches, errors).
+    """
+    global _graph
+    workers = workers or os.cpu_count() or 1
+    max_inflight = max_inflight or 2 * workers
+    _graph = G
+
+    writer = OutputWriter(output_path)
+    branches, trips, failed = Counter(), 0, 0
+    start = time.perf_counter()
+
+    def finish(chunk, routed):
+        nonlocal trips, failed
+        df = score_chunk(chunk, routed, predict)
+        writer.write(df)
+        trips += len(df)
+        failed += int((df["error"] != "").sum())
+        branches.update(b for b in df["route_branch"] if b)
+        elapsed = time.perf_counter() - start
+        logger.info(f"{trips} trips scored, {trips / elapsed:.0f} trips/s")
+
+    chunks = (normalize_chunk(df, first_row)
+              for first_row, df in _numbered(read_trip_chunks(input_path, chunk_size)))
+    try:
+        if workers == 1:
+            for chunk in chunks:
+                finish(chunk, route_chunk(chunk))
+        else:
+            # fork: workers inherit the loaded graph and spatial index instead of reloading them
+            context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                pending = deque()
+                for chunk in chunks:
+                    if len(pending) >= max_inflight:
+                        done_chunk, future = pending.popleft()
+                        finish(done_chunk, future.result())
+                    pending.append((chunk, pool.submit(route_chunk, chunk)))
+                while pending:
+                    done_chunk, future = pending.popleft()
+                    finish(done_chunk, future.result())
+    finally:
+        writer.close()
+        _graph = None
+
+    seconds = time.perf_counter() - start
+    return {
+        "trips": trips,
+        "seconds": round(seconds, 2),
+        "trips_per_sec": round(trips / seconds, 1) if seconds > 0 else 0.0,
+        "workers": workers,
+        "branches": dict(branches),
+        "errors": failed,
+    }
+
+# -----------------------------
+# Command line: bulk scoring
+#   python score_trips.py trips.csv scored.csv [--workers N] [--chunk-size N]
+# -----------------------------
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Score a CSV / Parquet file of trips offline")
+    arg_parser.add_argument("input", help="trips file (.csv or .parquet)")
+    arg_parser.add_argument("output", help="scored file (.csv or .parquet)")
+    arg_parser.add_argument("--workers", type=int, default=None, help="routing processes (default: all cores)")
+    arg_parser.add_argument("--chunk-size", type=int, default=5000, help="trips per chunk")
+    arg_parser.add_argument("--max-inflight", type=int, default=None, help="chunks read ahead (default: 2 x workers)")
+    arg_parser.add_argument("--graph", default=None, help="snapshot directory or GraphML file")
+    arg_parser.add_argument("--ch", default="nyc_graph.ch", help="contraction hierarchy directory")
+    arg_parser.add_argument("--model", default="xgb_fare_model.json")
+    arg_parser.add_argument("--table", default="xgb_fare_model.table", help="compiled fare table directory")
+    arg_parser.add_argument("--verbose", action="store_true", help="log every routed trip")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # Per-trip routing logs would dominate the run; the route_branch column records the same
+    logging.getLogger("prepare_input").setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    graph_path = args.graph or ("nyc_graph.snapshot" if os.path.exists("nyc_graph.snapshot") else "nyc_graph.graphml")
+    start = time.perf_counter()
+    G = load_scoring_graph(graph_path, args.ch)
+    predict, predictor = load_predictor(args.model, args.table)
+    print(f"Graph ({graph_path}) and model ({predictor}) loaded in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    summary = score_file(args.input, args.output, G, predict, workers=args.workers,
+                         chunk_size=args.chunk_size, max_inflight=args.max_inflight)
+    print(f"Scored {summary['trips']} trips in {summary['seconds']}s "
+          f"({summary['trips_per_sec']} trips/s, {summary['workers']} workers)", file=sys.stderr)
+    print(f"Route branches: {summary['branches']}, rows with errors: {summary['errors']}", file=sys.stderr)
@@ -0,0 +1,77 @@
+import argparse
+import glob
+import os
+import tempfile
+
+def build_options(args):
+    """gunicorn settings for the production server"""
+    return {
+        "bind": args.bind,
+        "workers": args.workers,
+        "worker_class": "gthread",
+        "threads": args.threads,
+        # Load app.py (graph, spatial index, model, tables) once in the master;
+        # workers are forked afterwards and share those pages copy-on-write
+        "preload_app": True,
+        "timeout": args.timeout,
+        "post_fork": post_fork,
+    }
+
+def post_fork(server, worker):
+    """Per-worker setup after the fork"""
+    import app as fare_app
+    # One OpenMP thread per worker: the processes already use every core
+    fare_app.booster_nthread = 1
+    if fare_app.xgb_booster is not None:
+        fare_app.xgb_booster.set_param({"nthread": 1})
+    # Each worker watches the model / graph files itself (HOT_RELOAD_INTERVAL_S)
+    fare_app.start_reload_watcher()
+    # ... and publishes its own metrics (not the master's, copied by the fork) for /metrics to add up
+    fare_app.metrics.reset()
+    fare_app.metrics.start_publishing()
+    server.log.info(f"Worker {worker.pid} ready")
+
+def run(args):
+    from gunicorn.app.base import BaseApplication
+
+    class FareServer(BaseApplication):
+        """gunicorn application serving the already-imported Flask app"""
+
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    # The routing pool reads its budget when prepare_input is imported
+    os.environ.setdefault("ROUTING_BUDGET_MS", str(args.budget_ms))
+    os.environ.setdefault("ROUTING_WORKERS", str(args.routing_threads))
+    # Workers publish their metrics here; numbers of a previous run are dropped
+    metrics_dir = os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp(prefix="fare-metrics-"))
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")) + glob.glob(os.path.join(metrics_dir, ".*.tmp")):
+        os.remove(path)
+    from app import app
+
+    FareServer(app, build_options(args)).run()
+
+# -----------------------------
+# Command line: production server
+#   python serve.py [--workers N] [--threads N] [--budget-ms MS]
+# -----------------------------
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Serve the fare app with several gunicorn workers")
+    arg_parser.add_argument("--bind", default="0.0.0.0:5000")
+    arg_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    arg_parser.add_argument("--threads", type=int, default=4, help="request threads per worker")
+    arg_parser.add_argument("--routing-threads", type=int, default=4, help="routing pool threads per worker")
+    arg_parser.add_argument("--budget-ms", type=float, default=300,
+                            help="routing time budget per request; past it the euclidean estimate is used")
+    arg_parser.add_argument("--timeout", type=int, default=60, help="gunicorn worker timeout (seconds)")
+    run(arg_parser.parse_args())
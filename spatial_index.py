@@ -0,0 +1,172 @@
+import logging
+import os
+import threading
+import weakref
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from connectivity import get_connectivity
+from graph_snapshot import GraphSnapshot
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6371009
+
+# Snap only onto nodes of the graph's main strongly connected component
+# (SNAP_MAIN_COMPONENT=1), so every snapped pair has a route
+SNAP_MAIN_COMPONENT = os.environ.get("SNAP_MAIN_COMPONENT", "0").lower() in ("1", "true", "yes")
+
+# One index per graph object (and per node set), built on first use and kept for the graph's lifetime
+_indexes = weakref.WeakKeyDictionary()
+_main_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+def get_node_index(G, main_component=None):
+    """
+    Return the (cached) NodeIndex of a networkx graph or GraphSnapshot.
+    With `main_component` (default SNAP_MAIN_COMPONENT) the index only
+    holds nodes of the main strongly connected component.
+    """
+    if main_component is None:
+        main_component = SNAP_MAIN_COMPONENT
+    indexes = _main_indexes if main_component else _indexes
+    index = indexes.get(G)
+    if index is None:
+        with _indexes_lock:
+            index = indexes.get(G)
+            if index is None:
+                index = _indexes.get(G) or NodeIndex.from_graph(G)
+                _indexes[G] = index
+                if main_component:
+                    index = index.subset(get_connectivity(G).in_main_component(index.node_ids))
+                    _main_indexes[G] = index
+    return index
+
+def register_node_index(G, index):
+    """Use a graph-specific index (anything with nearest_nodes / snap_pair / subset) for G"""
+    with _indexes_lock:
+        _indexes[G] = index
+
+class NodeIndex:
+    """
+    KD-tree over the graph nodes on a local equirectangular projection
+    (meters), for vectorized nearest-node and nearest-edge snapping.
+    """
+
+    def __init__(self, node_ids, node_x, node_y, edge_u=None, edge_v=None):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.node_x = np.asarray(node_x, dtype=np.float64)
+        self.node_y = np.asarray(node_y, dtype=np.float64)
+        self.lat0 = float(np.mean(self.node_y)) if len(self.node_y) else 0.0
+        self._cos_lat0 = np.cos(np.deg2rad(self.lat0))
+        self.tree = cKDTree(self._project(self.node_x, self.node_y))
+
+        # Edges as positions into node_ids; the edge tree is built on first use
+        self.edge_u = edge_u
+        self.edge_v = edge_v
+        self._edge_tree = None
+        self._edge_lock = threading.Lock()
+
+    @classmethod
+    def from_graph(cls, G):
+        if isinstance(G, GraphSnapshot):
+            degree = np.diff(G.indptr)
+            edge_u = np.repeat(np.arange(len(G.node_ids)), degree)
+            return cls(G.node_ids, G.node_x, G.node_y, edge_u, np.asarray(G.indices, dtype=np.int64))
+
+        node_ids = list(G.nodes)
+        position = {n: i for i, n in enumerate(node_ids)}
+        node_x = [G.nodes[n]['x'] for n in node_ids]
+        node_y = [G.nodes[n]['y'] for n in node_ids]
+        pairs = {(position[u], position[v]) for u, v in G.edges()}
+        edge_u = np.fromiter((u for u, _ in pairs), dtype=np.int64, count=len(pairs))
+        edge_v = np.fromiter((v for _, v in pairs), dtype=np.int64, count=len(pairs))
+        return cls(node_ids, node_x, node_y, edge_u, edge_v)
+
+    def subset(self, mask):
+        """NodeIndex over the nodes where `mask` is True (and the edges between them)"""
+        mask = np.asarray(mask, dtype=bool)
+        edge_u = edge_v = None
+        if self.edge_u is not None:
+            keep = mask[self.edge_u] & mask[self.edge_v]
+            new_position = np.cumsum(mask) - 1
+            edge_u, edge_v = new_position[self.edge_u[keep]], new_position[self.edge_v[keep]]
+        logger.info(f"Node index restricted to {int(mask.sum())}/{len(mask)} nodes")
+        return NodeIndex(self.node_ids[mask], self.node_x[mask], self.node_y[mask], edge_u, edge_v)
+
+    def _project(self, X, Y):
+        X = np.atleast_1d(np.asarray(X, dtype=np.float64))
+        Y = np.atleast_1d(np.asarray(Y, dtype=np.float64))
+        return np.column_stack([
+            np.deg2rad(X) * EARTH_RADIUS_M * self._cos_lat0,
+            np.deg2rad(Y) * EARTH_RADIUS_M,
+        ])
+
+    def nearest_nodes(self, X, Y, return_dist=False):
+        """
+        Nearest node id for each (X=lon, Y=lat) point in one tree query.
+        Optionally also return the snap distances in meters.
+        """
+        dist, pos = self.tree.query(self._project(X, Y), k=1)
+        nodes = self.node_ids[pos]
+        if return_dist:
+            return nodes, dist
+        return nodes
+
+    def nearest_edges(self, X, Y, candidates=8):
+        """
+        Nearest directed edge for each point, as (u ids, v ids, distance m).
+        Candidate edges come from a KD-tree over edge midpoints and are
+        ranked by exact point-to-segment distance.
+        """
+        if self.edge_u is None or len(self.edge_u) == 0:
+            raise ValueError("Graph has no edges to snap to")
+        tree, a, b = self._edges()
+        points = self._project(X, Y)
+        k = min(candidates, len(self.edge_u))
+        _, cand = tree.query(points, k=k)
+        cand = cand.reshape(len(points), k)
+
+        # Project each point onto each candidate segment
+        pa, pb = a[cand], b[cand]
+        seg = pb - pa
+        seg_len2 = np.einsum('ijk,ijk->ij', seg, seg)
+        t = np.einsum('ijk,ijk->ij', points[:, None, :] - pa, seg)
+        t = np.clip(np.divide(t, seg_len2, out=np.zeros_like(t), where=seg_len2 > 0), 0, 1)
+        closest = pa + t[..., None] * seg
+        dist = np.linalg.norm(points[:, None, :] - closest, axis=2)
+
+        best = np.argmin(dist, axis=1)
+        edge = cand[np.arange(len(points)), best]
+        return (self.node_ids[self.edge_u[edge]], self.node_ids[self.edge_v[edge]],
+                dist[np.arange(len(points)), best])
+
+    def snap_pair(self, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat, edge_fallback_m=None):
+        """
+        Snap pickup and dropoff in a single query. If `edge_fallback_m` is
+        set and a point is farther than that from every node, it is snapped
+        onto its nearest edge instead: a pickup continues to the edge's head
+        node, a dropoff is reached from the edge's tail node.
+        """
+        nodes, dist = self.nearest_nodes([pickup_lon, dropoff_lon], [pickup_lat, dropoff_lat],
+                                         return_dist=True)
+        pickup_node, dropoff_node = int(nodes[0]), int(nodes[1])
+        if edge_fallback_m is not None and np.any(dist > edge_fallback_m):
+            edge_u, edge_v, edge_dist = self.nearest_edges([pickup_lon, dropoff_lon], [pickup_lat, dropoff_lat])
+            if dist[0] > edge_fallback_m and edge_dist[0] < dist[0]:
+                pickup_node = int(edge_v[0])
+            if dist[1] > edge_fallback_m and edge_dist[1] < dist[1]:
+                dropoff_node = int(edge_u[1])
+        return pickup_node, dropoff_node
+
+    def _edges(self):
+        if self._edge_tree is None:
+            with self._edge_lock:
+                if self._edge_tree is None:
+                    a = self._project(self.node_x[self.edge_u], self.node_y[self.edge_u])
+                    b = self._project(self.node_x[self.edge_v], self.node_y[self.edge_v])
+                    self._edge_points = (a, b)
+                    self._edge_tree = cKDTree((a + b) / 2)
+                    logger.info(f"Edge index built over {len(self.edge_u)} edges")
+        return (self._edge_tree,) + self._edge_points
@@ -0,0 +1,171 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Micro-batch limits: a batch is quoted once it has STREAM_BATCH_SIZE trips
+# or its first trip has waited STREAM_BATCH_WAIT_MS, whichever comes first
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 64))
+STREAM_BATCH_WAIT_MS = float(os.environ.get("STREAM_BATCH_WAIT_MS", 50))
+
+# Longest accepted NDJSON line; longer lines are skipped and reported as errors
+MAX_LINE_BYTES = 64 * 1024
+
+_END = object()
+
+def read_lines(stream, max_line_bytes=MAX_LINE_BYTES):
+    """
+    Lines of a binary stream, read one at a time. A line longer than
+    max_line_bytes is consumed without being kept and yielded as None.
+    """
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            return
+        if len(line) > max_line_bytes and not line.endswith(b"\n"):
+            while line and not line.endswith(b"\n"):
+                line = stream.readline(max_line_bytes)
+            yield None
+        else:
+            yield line
+
+def micro_batches(lines, batch_size=STREAM_BATCH_SIZE, max_wait_s=STREAM_BATCH_WAIT_MS / 1000, max_queued=None):
+    """
+    Group (line number, line) pairs into lists of at most batch_size,
+    flushing a partial batch max_wait_s after its first line arrived.
+    A reader thread fills a queue of at most `max_queued` lines (default
+    4 batches) and blocks when it is full, so input is never read faster
+    than results are consumed and memory stays bounded.
+    """
+    pending = queue.Queue(maxsize=max_queued or batch_size * 4)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for item in enumerate(lines, 1):
+                if not put(item):
+                    return
+        except Exception as e:
+            logger.error(f"Stopped reading NDJSON input: {e}")
+        finally:
+            put(_END)
+
+    threading.Thread(target=reader, name="ndjson-reader", daemon=True).start()
+    try:
+        done = False
+        while not done:
+            item = pending.get()
+            if item is _END:
+                return
+            batch = [item]
+            flush_at = time.monotonic() + max_wait_s
+            while len(batch) < batch_size:
+                try:
+                    item = pending.get(timeout=max(0.0, flush_at - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _END:
+                    done = True
+                    break
+                batch.append(item)
+            yield batch
+    finally:
+        stop.set()
+
+def _parse_line(line):
+    """(trip mapping, None) of an NDJSON line, or (None, error)"""
+    if line is None:
+        return None, f"Line longer than {MAX_LINE_BYTES} bytes"
+    try:
+        return json.loads(line), None
+    except ValueError as e:
+        return None, f"Invalid JSON: {e}"
+
+def stream_quotes(lines, quote_batch, batch_size=STREAM_BATCH_SIZE, max_wait_s=STREAM_BATCH_WAIT_MS / 1000):
+    """
+    Quote an NDJSON stream of trips: yields one chunk of result lines per
+    micro-batch, as soon as the batch is quoted. Each result carries the
+    input line number (and the trip's "id" when it has one); blank lines
+    are skipped. quote_batch(trips) -> one quote dict per trip.
+    """
+    for batch in micro_batches(lines, batch_size, max_wait_s):
+        start = time.perf_counter()
+        results, trips, positions = [], [], []
+        for line_no, line in batch:
+            if line is not None and not line.strip():
+                continue
+            trip, error = _parse_line(line)
+            result = {"line": line_no}
+            if isinstance(trip, dict) and "id" in trip:
+                result["id"] = trip["id"]
+            if error:
+                result["error"] = error
+            else:
+                positions.append(len(results))
+                trips.append(trip)
+            results.append(result)
+
+        if trips:
+            try:
+                quotes = quote_batch(trips)
+            except Exception as e:
+                logger.exception(f"Stream batch error: {e}")
+                quotes = [{"error": f"Could not quote batch: {str(e)}"}] * len(trips)
+            for position, quote in zip(positions, quotes):
+                results[position].update(quote)
+
+        metrics.observe("stream_batch", time.perf_counter() - start)
+        metrics.count("stream_trips", len(trips))
+        if results:
+            yield "".join(json.dumps(result) + "\n" for result in results)
+
+# -----------------------------
+# Command line: NDJSON trips on stdin, NDJSON quotes on stdout
+#   python stream_quotes.py < trips.ndjson > quotes.ndjson
+# -----------------------------
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Quote an NDJSON stream of trips from stdin to stdout")
+    arg_parser.add_argument("--batch-size", type=int, default=STREAM_BATCH_SIZE, help="max trips per batch")
+    arg_parser.add_argument("--wait-ms", type=float, default=STREAM_BATCH_WAIT_MS,
+                            help="max time a trip waits for its batch to fill")
+    arg_parser.add_argument("--verbose", action="store_true", help="keep per-trip routing logs")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.verbose:
+        logging.getLogger("prepare_input").setLevel(logging.ERROR)
+
+    # Importing app loads the graph and the model; keep its output off stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        import app as fare_app
+    if fare_app.G is None or fare_app.xgb_model is None:
+        sys.exit("Road graph or model not available")
+
+    def quote_batch(trips):
+        return fare_app.quote_trips(trips, fare_app.request_deadline())
+
+    try:
+        for chunk in stream_quotes(read_lines(sys.stdin.buffer), quote_batch, args.batch_size,
+                                   args.wait_ms / 1000):
+            sys.stdout.write(chunk)
+            sys.stdout.flush()
+    except BrokenPipeError:
+        pass
@@ -0,0 +1,458 @@
+import argparse
+import heapq
+import json
+import logging
+import math
+import os
+import time
+
+import networkx as nx
+import numpy as np
+
+from artifacts import publish_dir, resolve_dir
+from connectivity import Connectivity, compute_connectivity, register_connectivity
+from graph_snapshot import (DEADLINE_CHECK_INTERVAL, _check_deadline, _NodeView, graph_to_snapshot,
+                            load_graph_snapshot)
+from metrics import process_rss_bytes
+from route_cache import LRUCache
+from spatial_index import EARTH_RADIUS_M, NodeIndex, register_node_index
+
+logger = logging.getLogger(__name__)
+
+TILED_GRAPH_VERSION = 1
+
+# Default tile edge in degrees (~2.2 km north-south, ~1.7 km east-west in NYC)
+DEFAULT_TILE_DEG = 0.02
+
+# Tiles kept in memory per process (TILE_CACHE_SIZE); least recently used ones are dropped
+TILE_CACHE_SIZE = int(os.environ.get("TILE_CACHE_SIZE", 256))
+
+# Always-resident arrays: node id lookup, position -> tile and tile -> node / edge ranges
+RESIDENT_ARRAYS = ("node_ids", "node_pos", "pos_tile", "tile_offsets", "tile_edge_offsets", "tile_cells")
+
+# Arrays read tile by tile (tiles/<name>.bin, raw, in position order) and their dtypes
+TILE_ARRAYS = {
+    "node_ids": np.int64,
+    "node_x": np.float64,
+    "node_y": np.float64,
+    "indptr": np.int32,
+    "indices": np.int32,
+    "lengths": np.float32,
+}
+
+# Straight-line distance is scaled down a little so the A* bound stays below every road length
+ASTAR_BOUND_SCALE = 0.995
+
+def compile_tiled_graph(G, out_dir, tile_deg=DEFAULT_TILE_DEG):
+    """
+    Compile a networkx road graph (or GraphSnapshot) into a tiled graph
+    directory. Nodes are grouped by grid cell and renumbered so every tile
+    holds a contiguous range of positions; node coordinates and outgoing
+    edges (CSR, float32 lengths, neighbours as global positions) are
+    written in position order, so a tile is one byte range per file.
+    Strongly connected components are stored too, so loading never needs
+    the whole edge list.
+    """
+    snapshot = graph_to_snapshot(G)
+    node_x, node_y = np.asarray(snapshot.node_x), np.asarray(snapshot.node_y)
+    indptr, indices = np.asarray(snapshot.indptr), np.asarray(snapshot.indices)
+    south, west = float(node_y.min()), float(node_x.min())
+    rows = np.floor((node_y - south) / tile_deg).astype(np.int64)
+    cols = np.floor((node_x - west) / tile_deg).astype(np.int64)
+    num_cols = int(cols.max()) + 1
+    cell = rows * num_cols + cols
+
+    # order[p] = snapshot index of the node at position p, tiles in cell order
+    order = np.lexsort((np.asarray(snapshot.node_ids), cell))
+    node_pos = np.empty(len(order), dtype=np.int32)
+    node_pos[order] = np.arange(len(order), dtype=np.int32)
+    tile_cells, tile_starts = np.unique(cell[order], return_index=True)
+    tile_offsets = np.append(tile_starts, len(order)).astype(np.int64)
+    pos_tile = np.repeat(np.arange(len(tile_cells), dtype=np.int32), np.diff(tile_offsets))
+
+    # Edges re-laid out in position order
+    degree = np.diff(indptr)[order]
+    new_indptr = np.concatenate([[0], np.cumsum(degree)])
+    edge_index = np.repeat(indptr[order] - new_indptr[:-1], degree) + np.arange(new_indptr[-1])
+    new_indices = node_pos[indices[edge_index]]
+    new_lengths = np.asarray(snapshot.lengths)[edge_index].astype(np.float32)
+
+    tiled = {
+        "node_ids": np.asarray(snapshot.node_ids)[order],
+        "node_x": node_x[order],
+        "node_y": node_y[order],
+        "indptr": new_indptr,
+        "indices": new_indices,
+        "lengths": new_lengths,
+    }
+    resident = {"node_ids": np.asarray(snapshot.node_ids), "node_pos": node_pos, "pos_tile": pos_tile,
+                "tile_offsets": tile_offsets, "tile_edge_offsets": new_indptr[tile_offsets].astype(np.int64),
+                "tile_cells": tile_cells}
+    connectivity = compute_connectivity(snapshot)
+    meta = {
+        "version": TILED_GRAPH_VERSION,
+        "num_nodes": int(len(order)),
+        "num_edges": int(len(new_indices)),
+        "num_tiles": int(len(tile_cells)),
+        "tile_deg": tile_deg,
+        "south": south,
+        "west": west,
+        "north": float(node_y.max()),
+        "num_cols": num_cols,
+        "main_component": int(connectivity.main),
+        "crs": snapshot.meta.get("crs", "epsg:4326"),
+    }
+
+    # Published atomically, see artifacts.py
+    with publish_dir(out_dir) as version_dir:
+        os.makedirs(os.path.join(version_dir, "tiles"))
+        for name, dtype in TILE_ARRAYS.items():
+            tiled[name].astype(dtype).tofile(os.path.join(version_dir, "tiles", f"{name}.bin"))
+        for name, array in resident.items():
+            np.save(os.path.join(version_dir, f"{name}.npy"), array)
+        np.savez(os.path.join(version_dir, "components.npz"), labels=connectivity.labels.astype(np.int32),
+                 from_main=connectivity.from_main, reaches_main=connectivity.reaches_main,
+                 topo_order=connectivity.topo_order.astype(np.int32))
+        with open(os.path.join(version_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+    logger.info(f"Tiled graph written to {out_dir}: {meta['num_nodes']} nodes, {meta['num_edges']} edges, "
+                f"{meta['num_tiles']} tiles of {tile_deg} deg")
+    return out_dir
+
+def load_tiled_graph(path, max_tiles=TILE_CACHE_SIZE):
+    """
+    Open a tiled graph directory: only the small node lookup arrays are
+    read now, tiles are loaded when a search or snap first touches them.
+    The stored components and a tile-aware node index are registered for
+    get_connectivity / get_node_index.
+    """
+    path = resolve_dir(path)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != TILED_GRAPH_VERSION:
+        raise ValueError(f"Unsupported tiled graph version: {meta.get('version')}")
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy")) for name in RESIDENT_ARRAYS}
+    G = TiledGraph(path=path, meta=meta, max_tiles=max_tiles, **arrays)
+
+    with np.load(os.path.join(path, "components.npz")) as components:
+        register_connectivity(G, Connectivity(G.node_ids, components["labels"], meta["main_component"],
+                                              components["from_main"], components["reaches_main"],
+                                              components["topo_order"]))
+    register_node_index(G, TiledNodeIndex(G))
+    return G
+
+class Tile:
+    """Nodes (tile order) and outgoing edges of one grid cell"""
+
+    def __init__(self, offset, node_ids, node_x, node_y, indptr, indices, lengths):
+        self.offset = offset
+        self.node_ids = node_ids
+        self.node_x = node_x
+        self.node_y = node_y
+        self.indptr = indptr
+        self.indices = indices
+        self.lengths = lengths
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in TILE_ARRAYS)
+
+class _TiledNodeView(_NodeView):
+    def __getitem__(self, node):
+        x, y = self._snapshot.coords(node)
+        return {'x': x, 'y': y}
+
+class TiledGraph:
+    """
+    Read-only road graph split into spatial tiles. Nodes are addressed by
+    their position in tile order; a position's tile comes from `pos_tile`
+    and its data from the tile, which is loaded from disk on first use and
+    kept in a bounded LRU cache. Offers the GraphSnapshot operations the
+    routing code uses (shortest_path, shortest_path_lengths, G.nodes).
+    """
+
+    def __init__(self, node_ids, node_pos, pos_tile, tile_offsets, tile_edge_offsets, tile_cells, path, meta,
+                 max_tiles=TILE_CACHE_SIZE):
+        self.node_ids = node_ids
+        self.node_pos = node_pos
+        self.pos_tile = pos_tile
+        self.tile_offsets = tile_offsets
+        self.tile_edge_offsets = tile_edge_offsets
+        self.tile_cells = tile_cells
+        self.path = path
+        self.meta = meta
+        # Tile files stay open, so tiles keep coming from this version even after a newer one is published
+        self._files = {name: os.open(os.path.join(path, "tiles", f"{name}.bin"), os.O_RDONLY)
+                       for name in TILE_ARRAYS}
+        self.tiles = LRUCache("tiles", maxsize=max_tiles)
+        self.nodes = _TiledNodeView(self)
+        self.router = None
+        self.tile_deg = meta["tile_deg"]
+        self._cell_tile = dict(zip(tile_cells.tolist(), range(len(tile_cells))))
+        # Meters per degree; longitude uses the northern edge so distances are never overestimated
+        self.m_per_deg_y = math.radians(1) * EARTH_RADIUS_M
+        self.m_per_deg_x = self.m_per_deg_y * math.cos(math.radians(meta["north"]))
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __del__(self):
+        for fd in getattr(self, "_files", {}).values():
+            os.close(fd)
+
+    @property
+    def num_edges(self):
+        return self.meta["num_edges"]
+
+    def index_of(self, node):
+        """Position of an OSM node id in the sorted node_ids, KeyError if it is not in the graph"""
+        i = int(np.searchsorted(self.node_ids, node))
+        if i >= len(self.node_ids) or self.node_ids[i] != node:
+            raise KeyError(node)
+        return i
+
+    def has_node(self, node):
+        try:
+            self.index_of(node)
+            return True
+        except (KeyError, TypeError):
+            return False
+
+    def position_of(self, node):
+        return int(self.node_pos[self.index_of(node)])
+
+    def tile(self, t):
+        return self.tiles.get_or_compute(t, lambda: self._load_tile(t))
+
+    def _load_tile(self, t):
+        """Read tile t's ranges of every tiled array (node range, then its edge range)"""
+        a, b = int(self.tile_offsets[t]), int(self.tile_offsets[t + 1])
+        ea, eb = int(self.tile_edge_offsets[t]), int(self.tile_edge_offsets[t + 1])
+        ranges = {"node_ids": (a, b), "node_x": (a, b), "node_y": (a, b), "indptr": (a, b + 1),
+                  "indices": (ea, eb), "lengths": (ea, eb)}
+        arrays = {}
+        for name, dtype in TILE_ARRAYS.items():
+            start, stop = ranges[name]
+            itemsize = np.dtype(dtype).itemsize
+            arrays[name] = np.frombuffer(os.pread(self._files[name], (stop - start) * itemsize, start * itemsize),
+                                         dtype=dtype)
+        arrays["indptr"] = arrays["indptr"] - ea
+        logger.debug(f"Loaded tile {t} ({b - a} nodes, {eb - ea} edges)")
+        return Tile(a, **arrays)
+
+    def tile_at(self, row, col):
+        """Tile id of a grid cell, None for empty or out-of-grid cells"""
+        if row < 0 or col < 0 or col >= self.meta["num_cols"]:
+            return None
+        return self._cell_tile.get(row * self.meta["num_cols"] + col)
+
+    def cell_of(self, x, y):
+        return (math.floor((y - self.meta["south"]) / self.tile_deg),
+                math.floor((x - self.meta["west"]) / self.tile_deg))
+
+    def coords(self, node):
+        """(x, y) of a node id"""
+        p = self.position_of(node)
+        tile = self.tile(int(self.pos_tile[p]))
+        return float(tile.node_x[p - tile.offset]), float(tile.node_y[p - tile.offset])
+
+    def shortest_path(self, source, target, deadline=None):
+        """
+        A* on the tiles with the straight-line distance as lower bound, so
+        the search stays in a corridor around the route and only loads the
+        tiles along it. Returns (list of node ids, length in meters);
+        raises NetworkXNoPath, or RoutingTimeout once time.monotonic()
+        passes `deadline`.
+        """
+        s, t = self.position_of(source), self.position_of(target)
+        loaded = {}
+        tx, ty = self._xy(t, loaded)
+        kx, ky = self.m_per_deg_x * ASTAR_BOUND_SCALE, self.m_per_deg_y * ASTAR_BOUND_SCALE
+
+        def bound(p):
+            x, y = self._xy(p, loaded)
+            return math.hypot((x - tx) * kx, (y - ty) * ky)
+
+        dist = {s: 0.0}
+        parent = {s: -1}
+        heap = [(bound(s), 0.0, s)]
+        settled = set()
+        while heap:
+            _, d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if u == t:
+                return self._unwind(parent, t, loaded), d
+            settled.add(u)
+            if deadline is not None and len(settled) % DEADLINE_CHECK_INTERVAL == 0:
+                _check_deadline(deadline)
+            for v, w in self._edges(u, loaded):
+                nd = d + w
+                if v not in settled and nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    parent[v] = u
+                    heapq.heappush(heap, (nd + bound(v), nd, v))
+        raise nx.NetworkXNoPath(f"No path between {source} and {target}")
+
+    def shortest_path_lengths(self, source, targets, cutoff=None, deadline=None):
+        """
+        One-to-many Dijkstra (see GraphSnapshot.shortest_path_lengths);
+        with a `cutoff` only the tiles within that radius are loaded.
+        Returns a float64 array aligned with `targets` (inf = not reached).
+        """
+        s = self.position_of(source)
+        wanted = {}
+        for k, target in enumerate(targets):
+            wanted.setdefault(self.position_of(target), []).append(k)
+        lengths = np.full(len(targets), np.inf)
+        limit = float('inf') if cutoff is None else cutoff
+        loaded = {}
+        dist = {s: 0.0}
+        heap = [(0.0, s)]
+        settled = set()
+        while heap and wanted:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if d > limit:
+                break
+            settled.add(u)
+            if u in wanted:
+                lengths[wanted.pop(u)] = d
+            if deadline is not None and len(settled) % DEADLINE_CHECK_INTERVAL == 0:
+                _check_deadline(deadline)
+            for v, w in self._edges(u, loaded):
+                nd = d + w
+                if v not in settled and nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return lengths
+
+    def _tile_of(self, p, loaded):
+        """Tile holding position p; `loaded` keeps the tiles of one search alive and skips the cache lock"""
+        t = int(self.pos_tile[p])
+        tile = loaded.get(t)
+        if tile is None:
+            tile = loaded[t] = self.tile(t)
+        return tile
+
+    def _xy(self, p, loaded):
+        tile = self._tile_of(p, loaded)
+        return float(tile.node_x[p - tile.offset]), float(tile.node_y[p - tile.offset])
+
+    def _edges(self, p, loaded):
+        tile = self._tile_of(p, loaded)
+        a, b = tile.indptr[p - tile.offset], tile.indptr[p - tile.offset + 1]
+        return zip(tile.indices[a:b].tolist(), tile.lengths[a:b].tolist())
+
+    def _unwind(self, parent, t, loaded):
+        path = []
+        while t != -1:
+            tile = self._tile_of(t, loaded)
+            path.append(int(tile.node_ids[t - tile.offset]))
+            t = parent[t]
+        return path[::-1]
+
+    def memory_usage(self):
+        """Bytes held by the resident lookup arrays and the cached tiles, plus the process RSS"""
+        tiles = self.tiles.values()
+        return {
+            "resident_bytes": int(sum(getattr(self, name).nbytes for name in RESIDENT_ARRAYS)),
+            "tile_bytes": int(sum(tile.nbytes for tile in tiles)),
+            "tiles_cached": len(tiles),
+            "tiles_total": len(self.tile_cells),
+            "tile_cache": self.tiles.stats(),
+            "process_rss_bytes": process_rss_bytes(),
+        }
+
+class TiledNodeIndex:
+    """
+    Nearest-node lookups on a TiledGraph: KD-trees are built per tile
+    (kept while the tile is cached) and the search widens ring by ring
+    around the point's cell until no unvisited tile can hold a closer node.
+    """
+
+    def __init__(self, graph, mask=None):
+        self.graph = graph
+        self.node_ids = graph.node_ids
+        # Optional filter aligned with graph.node_ids (see subset)
+        self.mask = mask
+        self._indexes = LRUCache("tile_index", maxsize=graph.tiles.maxsize)
+        self.ring_m = graph.tile_deg * min(graph.m_per_deg_x, graph.m_per_deg_y)
+        self.num_cols = graph.meta["num_cols"]
+        self.num_rows = int(graph.tile_cells.max()) // self.num_cols + 1
+
+    def subset(self, mask):
+        """Index over the nodes where `mask` (aligned with node_ids) is True"""
+        return TiledNodeIndex(self.graph, np.asarray(mask, dtype=bool))
+
+    def _tile_index(self, t):
+        def build():
+            tile = self.graph.tile(t)
+            node_ids, node_x, node_y = tile.node_ids, tile.node_x, tile.node_y
+            if self.mask is not None:
+                keep = self.mask[np.searchsorted(self.graph.node_ids, node_ids)]
+                node_ids, node_x, node_y = node_ids[keep], node_x[keep], node_y[keep]
+            return NodeIndex(node_ids, node_x, node_y) if len(node_ids) else None
+        return self._indexes.get_or_compute(t, build)
+
+    def _nearest(self, x, y):
+        row, col = self.graph.cell_of(x, y)
+        max_ring = max(self.num_rows, self.num_cols) + max(0, -row, row - self.num_rows,
+                                                           -col, col - self.num_cols)
+        best_node, best_dist = None, float('inf')
+        for ring in range(max_ring + 1):
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    if max(abs(r - row), abs(c - col)) != ring:
+                        continue
+                    t = self.graph.tile_at(r, c)
+                    index = self._tile_index(t) if t is not None else None
+                    if index is None:
+                        continue
+                    nodes, dist = index.nearest_nodes(x, y, return_dist=True)
+                    if dist[0] < best_dist:
+                        best_node, best_dist = int(nodes[0]), float(dist[0])
+            # Unvisited tiles are at least `ring` cells away
+            if best_node is not None and best_dist <= ring * self.ring_m:
+                break
+        if best_node is None:
+            raise ValueError("Graph has no nodes to snap to")
+        return best_node, best_dist
+
+    def nearest_nodes(self, X, Y, return_dist=False):
+        """Nearest node id for each (X=lon, Y=lat) point (see NodeIndex.nearest_nodes)"""
+        found = [self._nearest(x, y) for x, y in zip(np.atleast_1d(X).tolist(), np.atleast_1d(Y).tolist())]
+        nodes = np.array([n for n, _ in found], dtype=np.int64)
+        if return_dist:
+            return nodes, np.array([d for _, d in found])
+        return nodes
+
+    def snap_pair(self, pickup_lon, pickup_lat, dropoff_lon, dropoff_lat, edge_fallback_m=None):
+        """Snap pickup and dropoff to their nearest nodes (edge snapping is not supported on tiles)"""
+        nodes = self.nearest_nodes([pickup_lon, dropoff_lon], [pickup_lat, dropoff_lat])
+        return int(nodes[0]), int(nodes[1])
+
+# -----------------------------
+# Command line: compile tiles + memory report
+#   python tiled_graph.py nyc_graph.snapshot nyc_graph.tiles [--tile-deg 0.02]
+# -----------------------------
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Compile a road graph into lazily loaded tiles")
+    arg_parser.add_argument("graph", help="snapshot directory or GraphML file")
+    arg_parser.add_argument("out_dir", nargs="?", default="nyc_graph.tiles")
+    arg_parser.add_argument("--tile-deg", type=float, default=DEFAULT_TILE_DEG, help="tile edge in degrees")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    if os.path.isdir(args.graph):
+        G = load_graph_snapshot(args.graph)
+    else:
+        import osmnx as ox
+        G = ox.load_graphml(args.graph)
+    compile_tiled_graph(G, args.out_dir, args.tile_deg)
+    print(f"Tiled graph compiled to {args.out_dir} in {time.perf_counter() - start:.1f}s")
+
+    tiled = load_tiled_graph(args.out_dir)
+    print(f"Resident after load: {json.dumps(tiled.memory_usage())}")
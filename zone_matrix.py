@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from artifacts import publish_dir, resolve_dir
+from graph_snapshot import NYC_BBOX, graph_to_snapshot, load_graph_snapshot
+from spatial_index import EARTH_RADIUS_M, get_node_index
+
+logger = logging.getLogger(__name__)
+
+ZONE_MATRIX_VERSION = 1
+
+ZONE_ARRAYS = ("distances", "zone_x", "zone_y")
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters (vectorized)"""
+    lat1, lon1, lat2, lon2 = (np.deg2rad(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+def zone_grid(bbox=NYC_BBOX, zone_size_m=1000):
+    """Rows / columns of a regular lat-lon grid with roughly zone_size_m cells"""
+    north, south, east, west = bbox
+    mid_lat = (north + south) / 2
+    rows = max(1, int(np.ceil(haversine_m(south, west, north, west) / zone_size_m)))
+    cols = max(1, int(np.ceil(haversine_m(mid_lat, west, mid_lat, east) / zone_size_m)))
+    return rows, cols
+
+def build_zone_matrix(G, bbox=NYC_BBOX, zone_size_m=1000, chunk_size=64):
+    """
+    Split the bounding box into a grid of zones, snap each zone centroid
+    to its nearest graph node and compute the road distance (meters)
+    between every pair of those nodes with multi-source Dijkstra.
+    Unreachable pairs are stored as inf.
+    """
+    snapshot = graph_to_snapshot(G)
+    north, south, east, west = bbox
+    rows, cols = zone_grid(bbox, zone_size_m)
+    lat = south + (np.arange(rows) + 0.5) * (north - south) / rows
+    lon = west + (np.arange(cols) + 0.5) * (east - west) / cols
+    centroid_lon, centroid_lat = (a.ravel() for a in np.meshgrid(lon, lat))
+
+    zone_nodes = get_node_index(snapshot).nearest_nodes(centroid_lon, centroid_lat)
+    positions = np.searchsorted(snapshot.node_ids, zone_nodes)
+
+    # csgraph drops explicit zeros, keep zero-length edges as (almost) free edges
+    lengths = np.maximum(np.asarray(snapshot.lengths, dtype=np.float64), 1e-9)
+    n = len(snapshot)
+    graph = csr_matrix((lengths, np.asarray(snapshot.indices), np.asarray(snapshot.indptr)), shape=(n, n))
+
+    unique_positions, inverse = np.unique(positions, return_inverse=True)
+    distances = np.empty((len(positions), len(positions)), dtype=np.float32)
+    start = time.perf_counter()
+    for first in range(0, len(unique_positions), chunk_size):
+        sources = unique_positions[first:first + chunk_size]
+        dist = dijkstra(graph, directed=True, indices=sources)[:, unique_positions]
+        for k, source in enumerate(range(first, first + len(sources))):
+            distances[inverse == source] = dist[k, inverse]
+    logger.info(f"Zone matrix {rows}x{cols} zones ({len(unique_positions)} distinct nodes) "
+                f"computed in {time.perf_counter() - start:.1f}s")
+
+    zone_x = np.asarray(snapshot.node_x)[positions]
+    zone_y = np.asarray(snapshot.node_y)[positions]
+    meta = {"version": ZONE_MATRIX_VERSION, "bbox": list(bbox), "rows": rows, "cols": cols,
+            "zone_size_m": zone_size_m}
+    return ZoneMatrix(distances, zone_x, zone_y, meta)
+
+def save_zone_matrix(zones, out_dir):
+    """Write the matrix as .npy files plus meta.json (published atomically, see artifacts.py)"""
+    with publish_dir(out_dir) as version_dir:
+        for name in ZONE_ARRAYS:
+            np.save(os.path.join(version_dir, f"{name}.npy"), getattr(zones, name))
+        with open(os.path.join(version_dir, "meta.json"), "w") as f:
+            json.dump(zones.meta, f, indent=2)
+    return out_dir
+
+def load_zone_matrix(path, mmap=True):
+    """Load a saved zone matrix, memory-mapped by default"""
+    path = resolve_dir(path)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != ZONE_MATRIX_VERSION:
+        raise ValueError(f"Unsupported zone matrix version: {meta.get('version')}")
+    mmap_mode = "r" if mmap else None
+    arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in ZONE_ARRAYS]
+    return ZoneMatrix(*arrays, meta=meta)
+
+class ZoneMatrix:
+    """
+    Zone-to-zone road distances. A trip is estimated as
+    pickup -> pickup zone node -> (matrix) -> dropoff zone node -> dropoff,
+    with the two snap offsets measured as straight lines.
+    """
+
+    def __init__(self, distances, zone_x, zone_y, meta):
+        self.distances = distances
+        self.zone_x = zone_x
+        self.zone_y = zone_y
+        self.meta = meta
+        self.north, self.south, self.east, self.west = meta["bbox"]
+        self.rows, self.cols = meta["rows"], meta["cols"]
+
+    def zone_of(self, lat, lon):
+        """Zone index of each point (points outside the box use the edge zone)"""
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        row = np.clip(((lat - self.south) / (self.north - self.south) * self.rows).astype(np.int64), 0, self.rows - 1)
+        col = np.clip(((lon - self.west) / (self.east - self.west) * self.cols).astype(np.int64), 0, self.cols - 1)
+        return row * self.cols + col
+
+    def estimate_km(self, pickup_lat, pickup_lon, dropoff_lat, dropoff_lon):
+        """
+        Approximate road distance in km for each trip (vectorized, constant
+        time per trip). NaN where the zones are not connected.
+        """
+        pz = self.zone_of(pickup_lat, pickup_lon)
+        dz = self.zone_of(dropoff_lat, dropoff_lon)
+        between = np.asarray(self.distances[pz, dz], dtype=np.float64)
+        offsets = (haversine_m(pickup_lat, pickup_lon, self.zone_y[pz], self.zone_x[pz])
+                   + haversine_m(self.zone_y[dz], self.zone_x[dz], dropoff_lat, dropoff_lon))
+        estimate = (between + offsets) / 1000
+        return np.where(np.isfinite(between), estimate, np.nan)
+
+def measure_zone_error(zones, G, num_trips=500, seed=0):
+    """
+    Compare zone estimates with exact graph routing on random trips whose
+    endpoints lie on the road network inside the zone box (random nodes,
+    jittered by up to ~50 m). Pairs with no road connection are skipped.
+    Returns absolute / relative error statistics, which are stored with the
+    matrix and reported with preview quotes.
+    """
+    from prepare_input import find_nearest_nodes_safe, search_route
+
+    snapshot = graph_to_snapshot(G)
+    node_x, node_y = np.asarray(snapshot.node_x), np.asarray(snapshot.node_y)
+    inside = np.flatnonzero((node_y >= zones.south) & (node_y <= zones.north)
+                            & (node_x >= zones.west) & (node_x <= zones.east))
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(inside, size=(2, num_trips))
+    lat = node_y[picks] + rng.uniform(-4.5e-4, 4.5e-4, size=picks.shape)
+    lon = node_x[picks] + rng.uniform(-6e-4, 6e-4, size=picks.shape)
+    estimates = zones.estimate_km(lat[0], lon[0], lat[1], lon[1])
+
+    abs_err, rel_err = [], []
+    for i in range(num_trips):
+        if not np.isfinite(estimates[i]):
+            continue
+        pickup_node, dropoff_node = find_nearest_nodes_safe(G, lon[0, i], lat[0, i], lon[1, i], lat[1, i])
+        route = search_route(G, pickup_node, dropoff_node)
+        if route is None:
+            continue
+        exact_km = max(0.1, route[1] / 1000)
+        abs_err.append(abs(estimates[i] - exact_km))
+        rel_err.append(abs(estimates[i] - exact_km) / exact_km)
+
+    abs_err, rel_err = np.array(abs_err), np.array(rel_err)
+    if len(abs_err) == 0:
+        return {"trips": 0}
+    return {
+        "trips": int(len(abs_err)),
+        "mae_km": round(float(abs_err.mean()), 3),
+        "median_rel_error": round(float(np.median(rel_err)), 4),
+        "p90_rel_error": round(float(np.percentile(rel_err, 90)), 4),
+        "p99_rel_error": round(float(np.percentile(rel_err, 99)), 4),
+    }
+
+# -----------------------------
+# Command line: offline build + error measurement
+#   python zone_matrix.py [snapshot_dir] [zone_dir] [zone_size_m]
+# -----------------------------
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    snapshot_dir = sys.argv[1] if len(sys.argv) > 1 else "nyc_graph.snapshot"
+    zone_dir = sys.argv[2] if len(sys.argv) > 2 else "nyc_zones.matrix"
+    zone_size_m = float(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    G = load_graph_snapshot(snapshot_dir)
+    if os.path.exists("nyc_graph.ch"):
+        from ch_router import load_ch_router
+        G.router = load_ch_router("nyc_graph.ch", G)
+
+    start = time.perf_counter()
+    zones = build_zone_matrix(G, zone_size_m=zone_size_m)
+    zones.meta["error"] = measure_zone_error(zones, G)
+    save_zone_matrix(zones, zone_dir)
+    print(f"Zone matrix written to {zone_dir} in {time.perf_counter() - start:.1f}s")
+    print(f"Measured error against exact routing: {zones.meta['error']}")